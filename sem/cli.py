@@ -388,6 +388,39 @@ def merge(move, output_dir, sources):
                 shutil.rmtree(s)
 
 
+##########
+# Worker #
+##########
+
+@cli.command()
+@click.option("--ns-3-path",
+              type=click.Path(exists=True, resolve_path=True),
+              prompt='ns-3 installation directory',
+              help='Path to ns-3 installation')
+@click.option("--address",
+              prompt='Runner address',
+              help='Address of the DistributedRunner, either in the host:port'
+              ' form or as the path of a Unix socket')
+@click.option("--authkey",
+              envvar='SEM_AUTHKEY',
+              prompt='Authentication key',
+              hide_input=True,
+              help='Secret shared with the DistributedRunner (can also be '
+              'specified through the SEM_AUTHKEY environment variable)')
+@click.option("--max-processes",
+              type=click.INT,
+              default=1,
+              show_default=True,
+              help="The maximum number of parallel simulations to run")
+def worker(ns_3_path, address, authkey, max_processes):
+    """
+    Run simulations on behalf of a DistributedRunner.
+    """
+    sem.distributedrunner.run_worker(
+        sem.distributedrunner.parse_address(address), authkey, ns_3_path,
+        max_parallel_processes=max_processes)
+
+
 def get_params_and_defaults(param_list, db):
     """
     Deduce [parameter, default] pairs from simulations available in the db.
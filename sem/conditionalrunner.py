@@ -1,5 +1,11 @@
 from .runner import SimulationRunner
-from multiprocessing import Pool, Queue, Lock, Array, cpu_count
+from .lptrunner import have_same_combination
+from .utils import compute_ocba_allocation
+# Simulations are separate processes: threads are enough to run them in
+# parallel, and avoid forking this (possibly large) process
+from multiprocessing.pool import ThreadPool as Pool
+from queue import Queue
+from threading import Lock
 import queue
 import copy
 import numpy as np
@@ -9,25 +15,49 @@ from tqdm import tqdm
 
 
 class ConditionalRunner(SimulationRunner):
-    # TODO Update documentation
     """
-    A Runner which can perform simulations in parallel on the current machine,
-    prioritizing longest tasks as to minimize the makespan time.
-
-    Due to inheritance and code cleanliness reasons, as of now this runner does
-    not query the database to get running statistics from previous runs, and
-    only creates its statistics as it performs simulations.
+    A Runner which performs simulations in parallel on the current machine,
+    deciding which runs to perform based on the results obtained so far.
+
+    In the default convergence mode, new runs of each parameter combination
+    are started until the stopping_function attribute, which takes a
+    parameter combination and returns whether enough results are available
+    for it, returns True for all combinations.
+
+    If the budget attribute is set, the runner instead performs budget runs,
+    allocated among parameter combinations to identify the best one (see
+    run_simulations). In this mode, the samples_function attribute returns
+    the metric values currently available for a parameter combination,
+    initial_runs is the number of runs each combination receives before
+    allocation starts, and maximize specifies whether the best combination
+    has the highest or the lowest metric.
+
+    In both modes, the next_runs attribute is an iterator over the RngRun
+    values to assign to new runs.
     """
 
-    def __init__(self, path, script, optimized, skip_configuration=False, max_parallel_processes=None):
+    def __init__(self, path, script, optimized, skip_configuration=False, max_parallel_processes=None,
+                 **kwargs):
         SimulationRunner.__init__(self, path, script, optimized,
-                                  skip_configuration, max_parallel_processes)
+                                  skip_configuration, max_parallel_processes,
+                                  **kwargs)
         self.parameter_runtime_map = {}
+        self.budget = None
+        self.initial_runs = 2
+        self.maximize = True
 
     def run_simulations(self, parameter_list, data_folder, stop_on_errors=True):
         """
         This function runs multiple simulations in parallel.
 
+        If the budget attribute is set, a fixed number of runs is distributed
+        among the parameter combinations according to the Optimal Computing
+        Budget Allocation (OCBA) procedure, instead of running combinations
+        until they converge. In this case, the samples_function attribute must
+        return the list of metric values that are currently available for a
+        parameter combination, and initial_runs specifies how many runs each
+        combination receives before OCBA kicks in.
+
         Args:
             parameter_list (list): list of parameter combinations to simulate.
             data_folder (str): folder in which to create output folders.
@@ -50,11 +80,16 @@ class ConditionalRunner(SimulationRunner):
                     break
                 # with iolock:
                     # print("processing", next_sim)
-                result = next(
-                    SimulationRunner.run_simulations(self,
-                                                     [next_sim],
-                                                     self.data_folder,
-                                                     stop_on_errors=False))
+                try:
+                    result = next(
+                        SimulationRunner.run_simulations(self,
+                                                         [next_sim],
+                                                         self.data_folder,
+                                                         stop_on_errors=False))
+                except Exception as e:
+                    # The exception is raised by run_simulations, which
+                    # would otherwise wait for this run forever
+                    result = e
                 outq.put(result)
 
         # Create queue and processing pool
@@ -65,52 +100,125 @@ class ConditionalRunner(SimulationRunner):
                     initializer=process,
                     initargs=(q, iolock, outq))
 
-        progress = tqdm(total=len(param_list_with_check),
-                        unit='parameter combination',
-                        desc='Running Simulations')
+        if self.budget is not None:
+            progress = tqdm(total=self.budget,
+                            unit='simulation',
+                            desc='Running Simulations')
+            # Runs that were submitted but are not finished yet, for each
+            # parameter combination
+            in_flight = [0 for _ in unique_param_list]
 
-        # This generates the tasks and adds them to the queue
-        while True:
-            # print("Checking for new results")
+        else:
+            progress = tqdm(total=len(param_list_with_check),
+                            unit='parameter combination',
+                            desc='Running Simulations')
+
+        # Whether no run can be started until a running one finishes
+        waiting = False
+
+        try:
+            # This generates the tasks and adds them to the queue
             while True:
-                try:
-                    yield outq.get_nowait()
-                except queue.Empty:
+                # print("Checking for new results")
+                while True:
+                    try:
+                        result = outq.get(block=waiting)
+                    except queue.Empty:
+                        break
+                    waiting = False
+                    if isinstance(result, Exception):
+                        raise result
+                    if self.budget is not None:
+                        for idx, p in enumerate(unique_param_list):
+                            if have_same_combination(p, result['params']):
+                                in_flight[idx] -= 1
+                    yield result
+
+                if self.budget is not None:
+                    if progress.n == self.budget:
+                        break
+                    idx = self.get_next_allocation(unique_param_list, in_flight)
+                    if idx is None:
+                        if not any(in_flight):
+                            # No result can arrive to make a decision possible
+                            break
+                        # Wait for some of the runs to finish
+                        waiting = True
+                        continue
+                    new_simulation = copy.deepcopy(unique_param_list[idx])
+                    new_simulation['RngRun'] = next(self.next_runs)
+                    in_flight[idx] += 1
+                    progress.update()
+                    q.put(new_simulation, block=True)
+                    continue
+
+                # Update which simulations converged
+                for idx, item in enumerate(param_list_with_check):
+                    if not item[1]:
+                        param_list_with_check[idx][1] = self.stopping_function(item[0])
+
+                # print("Converged: %s" % sum(list(zip(*param_list_with_check))[1]))
+                progress.n = sum(list(zip(*param_list_with_check))[1]) - 1
+                progress.update()
+
+                if all(list(zip(*param_list_with_check))[1]):
                     break
-
-            # Update which simulations converged
-            for idx, item in enumerate(param_list_with_check):
-                if not item[1]:
-                    param_list_with_check[idx][1] = self.stopping_function(item[0])
-
-            # print("Converged: %s" % sum(list(zip(*param_list_with_check))[1]))
-            progress.n = sum(list(zip(*param_list_with_check))[1]) - 1
-            progress.update()
-
-            if all(list(zip(*param_list_with_check))[1]):
-                break
-            else:
-                # Push simulations that still haven't converged in the queue
-                new_simulations = [copy.deepcopy(p)
-                                   for p, converged in param_list_with_check
-                                   if not converged]
-                # Assign an RngRun value to all the simulations we need to
-                # run.
-                for s in new_simulations:
-                    s['RngRun'] = next(self.next_runs)
-                for p in new_simulations:
-                    q.put(p, block=True)
-
-        progress.close()
-
-        # This closes everything
-        for _ in range(pool._processes):
-            q.put(None, True)
-        pool.close()
-        pool.join()
+                else:
+                    # Push simulations that still haven't converged in the queue
+                    new_simulations = [copy.deepcopy(p)
+                                       for p, converged in param_list_with_check
+                                       if not converged]
+                    # Assign an RngRun value to all the simulations we need to
+                    # run.
+                    for s in new_simulations:
+                        s['RngRun'] = next(self.next_runs)
+                    for p in new_simulations:
+                        q.put(p, block=True)
+        finally:
+            progress.close()
+
+            # This closes everything
+            for _ in range(pool._processes):
+                q.put(None, True)
+            pool.close()
+            pool.join()
 
         while True:
             try:
-                yield outq.get_nowait()
+                result = outq.get_nowait()
             except queue.Empty:
                 return
+            if isinstance(result, Exception):
+                raise result
+            yield result
+
+    def get_next_allocation(self, parameter_list, in_flight):
+        """
+        Return the index of the parameter combination that should receive the
+        next run, according to OCBA, or None if more results are needed
+        before a decision can be made.
+
+        Args:
+            parameter_list (list): list of parameter combinations, without the
+                RngRun key.
+            in_flight (list): number of runs of each combination that were
+                already started but did not finish yet.
+        """
+        samples = [self.samples_function(p) for p in parameter_list]
+        runs = [len(s) + i for s, i in zip(samples, in_flight)]
+
+        # Make sure every combination has the initial number of runs first
+        for idx, r in enumerate(runs):
+            if r < self.initial_runs:
+                return idx
+
+        # We need at least two samples to estimate each variance
+        if any(len(s) < 2 for s in samples):
+            return None
+
+        allocation = compute_ocba_allocation([np.mean(s) for s in samples],
+                                             [np.std(s, ddof=1) for s in samples],
+                                             sum(runs) + 1,
+                                             maximize=self.maximize)
+
+        return int(np.argmax(np.array(allocation) - np.array(runs)))
@@ -1,4 +1,9 @@
 import os
+import json
+import pickle
+import socket
+import time
+import hashlib
 from functools import reduce
 import itertools
 from operator import and_, or_
@@ -8,6 +13,7 @@ import re
 import shutil
 import collections
 import glob
+from contextlib import contextmanager
 from pprint import pformat
 from tinydb import TinyDB, where
 from tinydb.storages import JSONStorage
@@ -15,6 +21,16 @@ from tinydb.middlewares import CachingMiddleware
 
 REUSE_RNGRUN_VALUES = False
 
+# Maximum size, in bytes, of the cache of parsed results kept in the campaign
+# directory. When the cache grows larger, the outputs of the least recently
+# used parsing functions are evicted.
+PARSE_CACHE_MAX_SIZE = 1024 ** 3
+
+# Seconds after which the lock protecting the database file of shared
+# campaigns, which is only held while the file is written, is assumed to
+# belong to a host that died
+DATABASE_LOCK_TIMEOUT = 60
+
 class DatabaseManager(object):
     """
     This serves as an interface with the simulation campaign database.
@@ -39,6 +55,11 @@ class DatabaseManager(object):
         self.campaign_dir = campaign_dir
         self.db = db
 
+        # Path of the journal new results are saved to, if any, and ids of
+        # the results deleted since journaling was enabled
+        self.journal_path = None
+        self.deleted_ids = set()
+
     @classmethod
     def new(cls, script, commit, params, campaign_dir, overwrite=False):
         """
@@ -141,14 +162,63 @@ class DatabaseManager(object):
             os.remove(filepath)
             raise ValueError("Specified campaign directory seems corrupt")
 
-        return cls(tinydb, campaign_dir)
+        db = cls(tinydb, campaign_dir)
+
+        # Include results saved by other hosts working on the same campaign
+        db.merge_journals()
+
+        return db
 
     ###################
     # Database access #
     ###################
 
     def write_to_disk(self):
-        self.db.storage.flush()
+        if self.journal_path is None:
+            self.db.storage.flush()
+            return
+
+        # When journaling, other hosts could be writing the database file at
+        # the same time: the results they saved in the file and in their
+        # journals are included before overwriting it, after which the
+        # results of this host's journal are in the file
+        with self.lock_database_file():
+            self.add_results(self.load_saved_results())
+            self.db.storage.flush()
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+
+    def get_database_path(self):
+        """
+        Return the path of the database file, which is named after the
+        campaign directory.
+        """
+        return os.path.join(self.campaign_dir, '%s.json' %
+                            os.path.basename(self.campaign_dir))
+
+    @contextmanager
+    def lock_database_file(self):
+        """
+        Context manager preventing other hosts journaling on the same campaign
+        from writing the database file.
+        """
+        lock_path = os.path.join(self.campaign_dir, '.journals', 'lock')
+        while True:
+            try:
+                os.close(os.open(lock_path,
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                if DatabaseManager.is_stale(lock_path, DATABASE_LOCK_TIMEOUT):
+                    DatabaseManager.remove_stale_file(lock_path)
+                else:
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
 
     def get_config(self):
         """
@@ -189,24 +259,71 @@ class DatabaseManager(object):
         """
         return self.get_config()['params']
 
-    def get_next_rngruns(self):
+    def get_build_fingerprint(self):
+        """
+        Return the fingerprint of the last ns-3 build used to run simulations
+        in this campaign, or None if it was never saved.
+        """
+        build = self.db.table('build').all()
+        if not build:
+            return None
+        return build[0]['fingerprint']
+
+    def set_build_fingerprint(self, fingerprint):
+        """
+        Save the fingerprint of the ns-3 build used to run simulations in this
+        campaign.
+        """
+        self.db.drop_table('build')
+        self.db.table('build').insert({'fingerprint': fingerprint})
+        self.write_to_disk()
+
+    def get_retention_policy(self):
+        """
+        Return the retention policy deciding which output files of the
+        simulations of this campaign are kept, or None if all files are kept.
+        """
+        retention = self.db.table('retention').all()
+        if not retention:
+            return None
+        return retention[0]['policy']
+
+    def set_retention_policy(self, policy):
+        """
+        Save the retention policy deciding which output files of the
+        simulations of this campaign are kept, so that analysis code knows
+        which files are available.
+        """
+        self.db.drop_table('retention')
+        self.db.table('retention').insert({'policy': policy})
+        self.write_to_disk()
+
+    def get_next_rngruns(self, used_runs=None):
         """
         Yield the next RngRun values that can be used in this campaign.
+
+        Args:
+            used_runs (list): additional RngRun values that should not be
+                used (e.g., because they belong to simulations that are
+                currently running).
         """
         available_runs = [result['params']['RngRun'] for result in
                           self.get_results()]
+        if used_runs is not None:
+            available_runs += list(used_runs)
         yield from DatabaseManager.get_next_values(self, available_runs)
 
     def insert_results(self, results):
 
-        # This dictionary serves as a model for how the keys in the newly
-        # inserted result should be structured.
-        example_result = {
-            'params': {k: ['...'] for k in list(self.get_params().keys()) + ['RngRun']},
-            'meta': {k: ['...'] for k in ['elapsed_time', 'id', 'exitcode']},
-        }
-
         for result in results:
+            # This dictionary serves as a model for how the keys in the newly
+            # inserted result should be structured.
+            example_result = {
+                'params': {k: ['...'] for k in list(self.get_params().keys()) + ['RngRun']},
+                'meta': DatabaseManager.get_example_meta(
+                    result, ['elapsed_time', 'id', 'exitcode']),
+            }
+
             # Verify result format is correct
             if not(DatabaseManager.have_same_structure(result, example_result)):
                 raise ValueError(
@@ -217,6 +334,7 @@ class DatabaseManager(object):
 
         # Insert results
         self.db.table('results').insert_multiple(results)
+        self.write_to_journal(results)
 
     def insert_result(self, result):
         """
@@ -242,7 +360,8 @@ class DatabaseManager(object):
         Where elapsed time is a float representing the seconds the simulation
         execution took, and id is a UUID uniquely identifying the result, and
         which is used to locate the output files in the campaign_dir/data
-        folder.
+        folder. Additional entries describing the run (e.g., its exitcode or
+        its resource usage) can also be stored in meta.
         """
 
         # This dictionary serves as a model for how the keys in the newly
@@ -250,7 +369,8 @@ class DatabaseManager(object):
         example_result = {
             'params': {k: ['...'] for k in list(self.get_params().keys()) +
                        ['RngRun']},
-            'meta': {k: ['...'] for k in ['elapsed_time', 'id']},
+            'meta': DatabaseManager.get_example_meta(result,
+                                                     ['elapsed_time', 'id']),
         }
 
         # Verify result format is correct
@@ -263,6 +383,16 @@ class DatabaseManager(object):
 
         # Insert result
         self.db.table('results').insert(deepcopy(result))
+        self.write_to_journal([result])
+
+    def update_result_meta(self, result):
+        """
+        Replace the meta of a result that is already in the database, based
+        on its id.
+        """
+        self.db.table('results').update(
+            {'meta': deepcopy(result['meta'])},
+            where('meta')['id'] == result['meta']['id'])
 
     def get_results(self, params=None, result_id=None):
         """
@@ -407,20 +537,36 @@ class DatabaseManager(object):
             results = deepcopy(self.get_results(params))
 
         for r in results:
-            r['output'] = {}
-            available_files = self.get_result_files(r['meta']['id'])
-            for name, filepath in available_files.items():
-                if ((isinstance(files_to_load, str) and re.search(files_to_load, name)) or
-                    (isinstance(files_to_load, list) and name in files_to_load)):
-                    with open(filepath, 'r') as file_contents:
-                        try:
-                            r['output'][name] = file_contents.read()
-                        except UnicodeDecodeError:
-                            # If this is not decodable, we leave this output alone
-                            # (but still insert its name in the result)
-                            r['output'][name] = 'RAW'
+            r['output'] = DatabaseManager.load_output_files(
+                os.path.join(self.get_data_dir(), r['meta']['id']),
+                files_to_load)
         return results
 
+    @staticmethod
+    def load_output_files(result_data_dir, files_to_load=r'.*'):
+        """
+        Return a dictionary of filename: file_contents entries for the output
+        files in result_data_dir.
+
+        Args:
+            result_data_dir (str): the folder containing the output files of a
+                result.
+            files_to_load (str, list): either a regular expression matching
+                the names of the files to load, or a list of file names.
+        """
+        output = {}
+        for name in next(os.walk(result_data_dir))[2]:
+            if ((isinstance(files_to_load, str) and re.search(files_to_load, name)) or
+                (isinstance(files_to_load, list) and name in files_to_load)):
+                with open(os.path.join(result_data_dir, name), 'r') as file_contents:
+                    try:
+                        output[name] = file_contents.read()
+                    except UnicodeDecodeError:
+                        # If this is not decodable, we leave this output alone
+                        # (but still insert its name in the result)
+                        output[name] = 'RAW'
+        return output
+
     def wipe_results(self):
         """
         Remove all results from the database.
@@ -428,9 +574,13 @@ class DatabaseManager(object):
         This also removes all output files, and cannot be undone.
         """
         # Clean results table
+        self.deleted_ids.update(r['meta']['id'] for r in self.get_results())
         self.db.drop_table('results')
         self.write_to_disk()
 
+        # Parsed outputs are not valid anymore
+        shutil.rmtree(self.get_parse_cache_dir(), ignore_errors=True)
+
         # Get rid of contents of data dir
         map(shutil.rmtree, glob.glob(os.path.join(self.get_data_dir(), '*.*')))
 
@@ -441,8 +591,316 @@ class DatabaseManager(object):
         # Get rid of contents of data dir
         shutil.rmtree(os.path.join(self.get_data_dir(), result['meta']['id']))
         # Remove entry from results table
+        self.deleted_ids.add(result['meta']['id'])
         self.db.table('results').remove(where('meta')['id'] == result['meta']['id'])
         self.write_to_disk()
+        # Remove any parsed output of this result
+        self.invalidate_parse_cache([result['meta']['id']])
+
+    ####################
+    # Shared campaigns #
+    ####################
+
+    def enable_journal(self):
+        """
+        Save new results in a journal file that is specific to this host and
+        process, instead of in the database file.
+
+        This allows multiple hosts to add results to the same campaign
+        directory at the same time: journals are merged into the database
+        when it is loaded, and by merge_journals. Once write_to_disk saves the
+        results of this host in the database file, they are removed from its
+        journal.
+        """
+        journals_dir = os.path.join(self.campaign_dir, '.journals')
+        os.makedirs(journals_dir, exist_ok=True)
+        self.journal_path = os.path.join(journals_dir, '%s-%s.jsonl' % (
+            socket.gethostname(), os.getpid()))
+
+    def write_to_journal(self, results):
+        """
+        Append results to this process' journal, if journaling is enabled.
+        """
+        if self.journal_path is None or not results:
+            return
+        with open(self.journal_path, 'a') as journal:
+            for result in results:
+                journal.write(json.dumps(result) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def merge_journals(self):
+        """
+        Add the results saved by all hosts, in their journals or in the
+        database file, to the database.
+        """
+        if not os.path.isdir(os.path.join(self.campaign_dir, '.journals')):
+            # No host ever journaled results on this campaign
+            return
+        with self.lock_database_file():
+            self.add_results(self.load_saved_results())
+
+    def load_saved_results(self):
+        """
+        Return the results saved in the database file and in the journals of
+        all hosts. The database file must be locked with lock_database_file.
+        """
+        try:
+            with open(self.get_database_path(), 'r') as database_file:
+                results = list(json.load(database_file).get('results',
+                                                             {}).values())
+        except (OSError, ValueError):
+            results = []
+        for journal_path in glob.glob(os.path.join(self.campaign_dir,
+                                                   '.journals', '*.jsonl')):
+            with open(journal_path, 'r') as journal:
+                for line in journal:
+                    try:
+                        results.append(json.loads(line))
+                    except ValueError:
+                        # The line is still being written
+                        continue
+        return results
+
+    def add_results(self, results):
+        """
+        Add the results saved by other hosts to the database, skipping those
+        that are already in it or that were deleted by this host.
+        """
+        known_ids = set(r['meta']['id'] for r in self.get_results())
+        known_ids.update(self.deleted_ids)
+        new_results = []
+        for result in results:
+            if result['meta']['id'] not in known_ids:
+                known_ids.add(result['meta']['id'])
+                new_results.append(result)
+        self.db.table('results').insert_multiple(new_results)
+
+    def get_claim_path(self, params):
+        """
+        Return the path of the claim file of a parameter combination.
+        """
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.campaign_dir, '.claims', '%s.json' % key)
+
+    def claim_simulation(self, params, stale_timeout):
+        """
+        Try to claim a simulation, so that no other host runs it, and return
+        whether the claim was successful.
+
+        Claims are files that are created atomically in the campaign
+        directory. Claims that were not refreshed for more than stale_timeout
+        seconds are assumed to belong to hosts that died, and are taken over.
+
+        Args:
+            params (dict): the parameter combination of the simulation,
+                including the RngRun value.
+            stale_timeout (float): seconds after which a claim is stale.
+        """
+        claim_path = self.get_claim_path(params)
+        os.makedirs(os.path.dirname(claim_path), exist_ok=True)
+        claim = {'params': params,
+                 'host': socket.gethostname(),
+                 'pid': os.getpid()}
+
+        try:
+            claim_file = os.open(claim_path,
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self.take_over_claim(claim_path, claim, stale_timeout)
+        with os.fdopen(claim_file, 'w') as claim_file:
+            json.dump(claim, claim_file)
+        return True
+
+    def take_over_claim(self, claim_path, claim, stale_timeout):
+        """
+        Replace a stale claim with a claim of this host, and return whether
+        the claim was taken over.
+
+        Takeovers are serialized through a lock file, so that the claim is
+        checked again once the lock is held: a stale claim is thus only taken
+        over by one host, and claims that were just taken over are never
+        replaced. The claim is replaced atomically, so that other hosts never
+        find it missing and create their own.
+
+        Args:
+            claim_path (str): the path of the claim.
+            claim (dict): the contents of the claim of this host.
+            stale_timeout (float): seconds after which a claim is stale.
+        """
+        if not DatabaseManager.is_stale(claim_path, stale_timeout):
+            return False
+
+        lock_path = '%s.lock' % claim_path
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # Locks are only held for a moment, unless their host died
+            if DatabaseManager.is_stale(lock_path, stale_timeout):
+                DatabaseManager.remove_stale_file(lock_path)
+            return False
+
+        try:
+            if not DatabaseManager.is_stale(claim_path, stale_timeout):
+                return False
+            temp_path = '%s.%s-%s' % (claim_path, socket.gethostname(),
+                                      os.getpid())
+            with open(temp_path, 'w') as claim_file:
+                json.dump(claim, claim_file)
+            os.replace(temp_path, claim_path)
+            return True
+        finally:
+            os.remove(lock_path)
+
+    @staticmethod
+    def is_stale(path, stale_timeout):
+        """
+        Return whether a file was not modified for more than stale_timeout
+        seconds. Missing files are not stale.
+        """
+        try:
+            return time.time() - os.path.getmtime(path) > stale_timeout
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def remove_stale_file(path):
+        """
+        Remove a stale file. Only one of the hosts trying to remove the file
+        at the same time succeeds.
+        """
+        stale_path = '%s.%s-%s.stale' % (path, socket.gethostname(),
+                                         os.getpid())
+        try:
+            os.rename(path, stale_path)
+            os.remove(stale_path)
+        except OSError:
+            pass
+
+    def get_claimed_simulations(self, stale_timeout):
+        """
+        Return the parameter combinations of the simulations that are
+        currently claimed by some host, excluding stale claims.
+        """
+        claimed = []
+        for claim_path in glob.glob(os.path.join(self.campaign_dir, '.claims',
+                                                 '*.json')):
+            try:
+                if time.time() - os.path.getmtime(claim_path) > stale_timeout:
+                    continue
+                with open(claim_path, 'r') as claim_file:
+                    claimed.append(json.load(claim_file)['params'])
+            except (OSError, ValueError):
+                # The claim was just released, or is still being written
+                continue
+        return claimed
+
+    def refresh_claims(self, params_list):
+        """
+        Mark the claims of the specified simulations as still valid.
+        """
+        for params in params_list:
+            try:
+                os.utime(self.get_claim_path(params))
+            except OSError:
+                pass
+
+    def release_claims(self, params_list):
+        """
+        Remove the claims of the specified simulations, unless they were
+        taken over by another host in the meantime.
+        """
+        for params in params_list:
+            claim_path = self.get_claim_path(params)
+            try:
+                with open(claim_path, 'r') as claim_file:
+                    claim = json.load(claim_file)
+                if (claim['host'], claim['pid']) == (socket.gethostname(),
+                                                     os.getpid()):
+                    os.remove(claim_path)
+            except (OSError, ValueError):
+                pass
+
+    ###############
+    # Parse cache #
+    ###############
+
+    def get_parse_cache_dir(self):
+        """
+        Return the directory containing the cache of parsed results, which is
+        campaign_directory/.parse_cache.
+        """
+        return os.path.join(self.campaign_dir, '.parse_cache')
+
+    def load_parse_cache(self, key):
+        """
+        Return a dictionary containing the cached outputs of a parsing
+        function, indexed by result id.
+
+        Args:
+            key (str): a string identifying the parsing function and the way
+                it is applied to results, or None if outputs should not be
+                cached.
+        """
+        if key is None:
+            return {}
+        cache_path = os.path.join(self.get_parse_cache_dir(),
+                                  '%s.pickle' % key)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                outputs = pickle.load(cache_file)
+            # Keep track of when the cache was last used, for eviction
+            os.utime(cache_path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+        return outputs
+
+    def save_parse_cache(self, key, outputs):
+        """
+        Save the outputs of a parsing function, indexed by result id, and
+        evict the least recently used outputs of other parsing functions if
+        the cache exceeds PARSE_CACHE_MAX_SIZE.
+
+        Args:
+            key (str): the key identifying the parsing function, as passed to
+                load_parse_cache.
+            outputs (dict): the outputs to save, indexed by result id.
+        """
+        if key is None:
+            return
+        cache_dir = self.get_parse_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, '%s.pickle' % key)
+        temporary_path = '%s.%s.tmp' % (cache_path, os.getpid())
+        try:
+            with open(temporary_path, 'wb') as cache_file:
+                pickle.dump(outputs, cache_file)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            # Some outputs cannot be cached
+            os.remove(temporary_path)
+            return
+        os.replace(temporary_path, cache_path)
+
+        cache_files = sorted(glob.glob(os.path.join(cache_dir, '*.pickle')),
+                             key=os.path.getmtime, reverse=True)
+        total_size = 0
+        for cache_file in cache_files:
+            total_size += os.path.getsize(cache_file)
+            if total_size > PARSE_CACHE_MAX_SIZE and cache_file != cache_path:
+                os.remove(cache_file)
+
+    def invalidate_parse_cache(self, result_ids):
+        """
+        Remove the cached outputs of the specified results.
+        """
+        result_ids = set(result_ids)
+        for cache_path in glob.glob(os.path.join(self.get_parse_cache_dir(),
+                                                 '*.pickle')):
+            key = os.path.splitext(os.path.basename(cache_path))[0]
+            outputs = self.load_parse_cache(key)
+            if result_ids & set(outputs):
+                self.save_parse_cache(key, {k: v for k, v in outputs.items()
+                                            if k not in result_ids})
 
     #############
     # Utilities #
@@ -511,6 +969,22 @@ class DatabaseManager(object):
 
         return True
 
+    def get_example_meta(result, mandatory_keys):
+        """
+        Return a model of the meta dictionary of a result, containing the
+        mandatory keys plus any optional key the result already features.
+
+        This is used to validate results before inserting them in the
+        database: keys describing the run (e.g., its resource usage) are
+        allowed, but the mandatory ones must always be present.
+        """
+        meta = result.get('meta') if isinstance(result.get('meta'), dict) else {}
+        example_meta = {k: ['...'] for k in set(mandatory_keys) | set(meta)}
+        # Optional entries can also be dictionaries (e.g., parsed outputs)
+        example_meta.update({k: v for k, v in meta.items() if k not in
+                             mandatory_keys and isinstance(v, dict)})
+        return example_meta
+
     def get_all_values_of_all_params(self):
         """
         Return a dictionary containing all values that are taken by all
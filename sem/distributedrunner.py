@@ -0,0 +1,390 @@
+from .runner import SimulationRunner
+from .utils import CallbackBase
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+# Address the DistributedRunner listens on, if none is specified. This can
+# either be a (host, port) tuple or the path of a Unix socket.
+DEFAULT_ADDRESS = ('localhost', 9042)
+
+# Seconds between heartbeats sent by workers while running a simulation
+HEARTBEAT_INTERVAL = 5
+
+# Connections from workers that can wait to be accepted, since workers open
+# one connection for each simulation they run at the same time
+CONNECTION_BACKLOG = 64
+
+
+class DistributedRunner(SimulationRunner):
+    """
+    A Runner which distributes simulations to workers running on other
+    machines, over a TCP or Unix socket.
+
+    Workers are started with the `sem worker` command on each host: they
+    connect to the runner, receive one parameter combination at a time, run
+    it on their own ns-3 installation and send back the result together with
+    its output files. While a simulation is running, workers periodically
+    send a heartbeat: simulations assigned to workers that disconnect or stop
+    sending heartbeats are assigned to another worker.
+    """
+
+    settings: [str] = ['authkey', 'heartbeat_timeout', 'worker_timeout']
+
+    def __init__(self, path, script, optimized=True, skip_configuration=False,
+                 max_parallel_processes=None, address=DEFAULT_ADDRESS,
+                 authkey=None, heartbeat_timeout=30, worker_timeout=600,
+                 **kwargs):
+        """
+        Initialization function.
+
+        Args:
+            address (tuple, str): either a (host, port) tuple specifying where
+                to listen for TCP connections from workers, or the path of a
+                Unix socket. The runner starts listening when simulations are
+                first run, or when listen is called. Use port 0 to pick a free
+                port, which is then available in the address attribute. To
+                accept workers running on other machines, use the address of
+                a network interface of this machine, or 0.0.0.0 for all of
+                them.
+            authkey (str): secret workers need to know in order to connect.
+            heartbeat_timeout (float): seconds after which a worker that did
+                not send any message is considered lost, and its simulation
+                is assigned to another worker.
+            worker_timeout (float): seconds after which run_simulations raises
+                an exception if no worker is connected while simulations are
+                pending, or None to wait indefinitely.
+        """
+        if not authkey:
+            raise ValueError("An authkey is needed to authenticate workers")
+        SimulationRunner.__init__(self, path, script, optimized,
+                                  skip_configuration, max_parallel_processes,
+                                  **kwargs)
+        self.authkey = authkey
+        self.heartbeat_timeout = heartbeat_timeout
+        self.worker_timeout = worker_timeout
+
+        # Simulations waiting for a worker, and results sent back by workers
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+
+        # Each call to run_simulations is a new batch, so that results of
+        # simulations belonging to an interrupted batch can be discarded
+        self.batch = 0
+
+        # Connections to the workers that are currently being served
+        self.connections = set()
+
+        self.address = address
+        self.listener = None
+        self.listener_lock = threading.Lock()
+
+    def listen(self):
+        """
+        Start accepting connections from workers, unless the runner is
+        already doing so.
+        """
+        with self.listener_lock:
+            if self.listener is not None:
+                return
+            self.listener = Listener(self.address, backlog=CONNECTION_BACKLOG,
+                                     authkey=self.authkey.encode())
+            self.address = self.listener.address
+        threading.Thread(target=self.accept_workers, daemon=True).start()
+
+    def run_simulations(self, parameter_list, data_folder,
+                        callbacks: [CallbackBase] = None,
+                        stop_on_errors=False):
+        """
+        Distribute simulations to the connected workers, and yield results as
+        they are sent back.
+
+        Args:
+            parameter_list (list): list of parameter combinations to simulate.
+            data_folder (str): folder in which to save the output folders.
+            callbacks (list): list of callbacks to be triggered.
+            stop_on_errors (bool): whether to stop if a simulation outputs an
+                error.
+        """
+        self.listen()
+
+        if callbacks is not None:
+            for cb in callbacks:
+                cb.on_simulation_start(len(parameter_list))
+                cb.controlled_by_parent = True
+
+        self.batch += 1
+        for parameter in parameter_list:
+            self.jobs.put({'batch': self.batch,
+                           'parameter': parameter,
+                           'data_folder': data_folder})
+
+        try:
+            for _ in parameter_list:
+                result = self.get_result()
+                while result['batch'] != self.batch:
+                    result = self.get_result()
+                if 'error' in result:
+                    raise Exception('\nSimulation could not be run.\n'
+                                    'Params: %s\n'
+                                    'Worker: %s\n'
+                                    '%s' % (result['parameter'],
+                                            result['worker'],
+                                            result['error']))
+                result = result['result']
+
+                # Runs are only known to the runner once they are complete
+                if callbacks is not None:
+                    for cb in callbacks:
+                        cb.on_run_start(result['params'], result['meta']['id'])
+                        cb.on_run_end(result['meta']['id'],
+                                      result['meta']['exitcode'],
+                                      result['meta']['elapsed_time'])
+
+                stopped = (result['meta'].get('timed_out', False) or
+                           result['meta'].get('killed_by_limit', False))
+                if (stop_on_errors and not stopped and
+                        result['meta']['exitcode'] != 0):
+                    with open(os.path.join(data_folder, result['meta']['id'],
+                                           'stderr'), 'r') as stderr_file:
+                        raise Exception('\nSimulation exited with an error.\n'
+                                        'Params: %s\n'
+                                        'Worker: %s\n'
+                                        'Stderr: %s' %
+                                        (result['params'],
+                                         result['meta']['worker'],
+                                         stderr_file.read()))
+
+                self.update_run_statistics(result)
+                yield result
+        finally:
+            # Simulations that were not assigned yet are not needed anymore
+            while True:
+                try:
+                    self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+
+        if callbacks is not None:
+            for cb in callbacks:
+                cb.on_simulation_end()
+
+    def get_result(self):
+        """
+        Wait for a worker to send back a result, and return it.
+
+        Raise an exception if no worker is connected for longer than
+        worker_timeout, since no result can be sent back in that case.
+        """
+        waiting_since = time.time()
+        while True:
+            try:
+                return self.results.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                pass
+            if self.connections:
+                waiting_since = time.time()
+            elif (self.worker_timeout is not None and
+                  time.time() - waiting_since > self.worker_timeout):
+                raise Exception("No worker connected to %s in the last %s "
+                                "seconds" % (self.address,
+                                             self.worker_timeout))
+
+    def accept_workers(self):
+        """
+        Accept connections from workers, serving each in a separate thread.
+        """
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError):
+                # Failed handshake with a worker
+                continue
+            except OSError:
+                # The listener was closed
+                return
+            threading.Thread(target=self.serve_worker, args=(connection,),
+                             daemon=True).start()
+
+    def serve_worker(self, connection):
+        """
+        Send simulations to a worker and collect its results, until the
+        worker disconnects or stops sending heartbeats.
+
+        Args:
+            connection (Connection): the connection to the worker.
+        """
+        self.connections.add(connection)
+        job = None
+        try:
+            connection.send({'script': self.script,
+                             'optimized': self.optimized,
+                             'timeout': self.timeout,
+                             'cpu_time_limit': self.cpu_time_limit,
+                             'memory_limit': self.memory_limit,
+                             'stage_dir': self.stage_dir,
+                             'scratch_dir': self.scratch_dir,
+                             'retention_policy': self.retention_policy})
+            while True:
+                job = self.jobs.get()
+                if job['batch'] != self.batch:
+                    job = None
+                    continue
+                connection.send(('run', job['parameter']))
+
+                # Wait for the result, making sure the worker is alive
+                while True:
+                    if not connection.poll(self.heartbeat_timeout):
+                        raise TimeoutError("Worker stopped sending heartbeats")
+                    message = connection.recv()
+                    if message[0] in ['result', 'error']:
+                        break
+
+                if message[0] == 'error':
+                    # The simulation raised an exception, which would
+                    # likely happen on any other worker as well
+                    _, worker, error = message
+                    self.results.put({'batch': job['batch'],
+                                      'parameter': job['parameter'],
+                                      'worker': worker,
+                                      'error': error})
+                    job = None
+                    continue
+
+                _, result, files = message
+                if job['batch'] != self.batch:
+                    # The runner moved on while the simulation was running:
+                    # nobody will save the result, so its files are dropped
+                    job = None
+                    continue
+                result_folder = os.path.join(job['data_folder'],
+                                             result['meta']['id'])
+                os.makedirs(result_folder)
+                for filename, contents in files.items():
+                    with open(os.path.join(result_folder, filename),
+                              'wb') as output_file:
+                        output_file.write(contents)
+                self.results.put({'batch': job['batch'], 'result': result})
+                job = None
+        except (EOFError, OSError, TimeoutError):
+            # The simulation is assigned to another worker
+            if job is not None:
+                self.jobs.put(job)
+        finally:
+            self.connections.discard(connection)
+            connection.close()
+
+    def close(self):
+        """
+        Stop accepting connections from workers, and disconnect the connected
+        ones, which causes them to exit.
+        """
+        with self.listener_lock:
+            if self.listener is not None:
+                self.listener.close()
+        for connection in list(self.connections):
+            connection.close()
+
+
+def parse_address(address):
+    """
+    Convert an address in the host:port form into a (host, port) tuple.
+    Any other string is interpreted as the path of a Unix socket.
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def run_worker(address, authkey, ns_path, max_parallel_processes=1):
+    """
+    Connect to a DistributedRunner and run the simulations it sends, until
+    the runner closes the connection.
+
+    Args:
+        address (tuple, str): the address of the DistributedRunner.
+        authkey (str): the secret shared with the DistributedRunner.
+        ns_path (str): path to the ns-3 installation of this worker.
+        max_parallel_processes (int): number of simulations to run at the
+            same time.
+    """
+    connections = [Client(address, authkey=authkey.encode()) for _ in
+                   range(max_parallel_processes)]
+    # The runner sends its settings over each connection
+    for connection in connections:
+        settings = connection.recv()
+    runner = SimulationRunner(ns_path, settings['script'],
+                              optimized=settings['optimized'],
+                              timeout=settings['timeout'],
+                              cpu_time_limit=settings['cpu_time_limit'],
+                              memory_limit=settings['memory_limit'],
+                              stage_dir=settings['stage_dir'],
+                              scratch_dir=settings['scratch_dir'],
+                              retention_policy=settings['retention_policy'])
+
+    threads = [threading.Thread(target=serve_runner,
+                                args=(connection, runner))
+               for connection in connections]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def serve_runner(connection, runner):
+    """
+    Run the simulations received over connection with runner, sending back
+    heartbeats while they run and their results once they are over.
+    Exceptions raised while running a simulation are sent back instead of its
+    result.
+    """
+    try:
+        while True:
+            try:
+                _, parameter = connection.recv()
+            except EOFError:
+                return
+
+            data_folder = tempfile.mkdtemp()
+            try:
+                outcome = {}
+
+                def run():
+                    try:
+                        outcome['result'] = next(runner.run_simulations(
+                            [parameter], data_folder))
+                    except Exception:
+                        outcome['error'] = traceback.format_exc()
+
+                simulation = threading.Thread(target=run)
+                simulation.start()
+                while simulation.is_alive():
+                    simulation.join(HEARTBEAT_INTERVAL)
+                    if simulation.is_alive():
+                        connection.send(('heartbeat',))
+                if 'error' in outcome:
+                    connection.send(('error', socket.gethostname(),
+                                     outcome['error']))
+                    continue
+
+                result = outcome['result']
+                result['meta']['worker'] = socket.gethostname()
+                result_folder = os.path.join(data_folder, result['meta']['id'])
+                files = {}
+                for filename in os.listdir(result_folder):
+                    with open(os.path.join(result_folder, filename),
+                              'rb') as output_file:
+                        files[filename] = output_file.read()
+                connection.send(('result', result, files))
+            finally:
+                shutil.rmtree(data_folder, ignore_errors=True)
+    finally:
+        connection.close()
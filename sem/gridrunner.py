@@ -1,8 +1,13 @@
 from .runner import SimulationRunner
+import atexit
 import os
 import re
+import shutil
+import signal
+import subprocess
+import threading
 import uuid
-from .utils import DRMAA_AVAILABLE
+from .utils import DRMAA_AVAILABLE, CallbackBase, apply_retention_policy
 if DRMAA_AVAILABLE:
     import drmaa
 import time
@@ -15,152 +20,500 @@ import time
 BUILD_GRID_PARAMS = "-l cputype=intel"
 SIMULATION_GRID_PARAMS = "-l cputype=intel"
 
+# Seconds to wait for a simulation to complete before checking again, and for
+# terminated simulations to be cleaned up
+WAIT_TIMEOUT = 10
+SYNCHRONIZE_TIMEOUT = 60
+
+# The DRMAA session of this process, see get_session
+session = None
+session_lock = threading.Lock()
+
+# Names used by DRMAA implementations for the resource usage of a job, and the
+# corresponding fields in the meta of results
+RESOURCE_USAGE_FIELDS = {
+    'ru_utime': 'user_time',
+    'ru_stime': 'system_time',
+    'ru_maxrss': 'max_rss',
+    'ru_inblock': 'block_input',
+    'ru_oublock': 'block_output',
+}
+
 class GridRunner(SimulationRunner):
     """
     A Runner which can perform simulations in parallel on a DRMAA-compatible
     cluster architecture.
     """
 
-    def run_simulations(self, parameter_list, data_folder):
+    settings: [str] = ['job_duration', 'job_parallelism']
+
+    def __init__(self, path, script, optimized=True, skip_configuration=False,
+                 max_parallel_processes=None, job_duration=None,
+                 job_parallelism=1, **kwargs):
         """
-        This function runs multiple simulations in parallel.
+        Initialization function.
+
+        Args:
+            job_duration (float): if not None, number of seconds each grid job
+                should last. Parameter combinations are then packed into jobs
+                based on the elapsed time of their previous runs, which is
+                useful when simulations are so short that the scheduling
+                latency of the grid would dominate their running time.
+            job_parallelism (int): number of simulations each grid job runs at
+                the same time. This should match the number of slots requested
+                through SIMULATION_GRID_PARAMS.
+
+        See SimulationRunner for the remaining arguments.
         """
+        SimulationRunner.__init__(self, path, script, optimized,
+                                  skip_configuration, max_parallel_processes,
+                                  **kwargs)
+        self.job_duration = job_duration
+        self.job_parallelism = job_parallelism
+
+    def run_simulations(self, parameter_list, data_folder,
+                        callbacks: [CallbackBase] = None,
+                        stop_on_errors=False):
+        """
+        This function runs multiple simulations in parallel.
 
-        # Open up a session
-        s = drmaa.Session()
-        s.initialize()
-
-        # Create a job template for each parameter combination
+        All simulations are submitted at once, as the tasks of a single bulk
+        job, and results are yielded as soon as the corresponding task is
+        complete. Each task runs one pack of simulations, as computed by
+        pack_simulations.
+
+        Args:
+            parameter_list (list): list of parameter combinations to simulate.
+            data_folder (str): folder in which to save subfolders containing
+                simulation output.
+            callbacks (list): list of callbacks to be triggered.
+            stop_on_errors (bool): whether to stop if a simulation outputs an
+                error.
+        """
+        parameter_list = list(parameter_list)
+        if not parameter_list:
+            return
+
+        if callbacks is not None:
+            for cb in callbacks:
+                if not cb.is_controlled_by_parent():
+                    cb.on_simulation_start(len(parameter_list))
+
+        # Each task of the bulk job runs the simulations listed in the runs
+        # file of the folder named after its index
+        tasks_dir = os.path.join(data_folder, '.tasks-%s' % uuid.uuid4())
+        tasks = [self.create_task(pack, os.path.join(tasks_dir, str(index)),
+                                  data_folder)
+                 for index, pack in enumerate(
+                     self.pack_simulations(parameter_list), start=1)]
+
+        s = get_session()
         jobs = {}
-        for parameter in parameter_list:
-            # Initialize result
-            current_result = {
-                'params': {},
-                'meta': {}
-            }
-            current_result['params'].update(parameter)
-
-            command = " ".join([self.script_executable] + ['--%s=%s' % (param,
-                                                                        value)
-                                                           for param, value in
-                                                           parameter.items()])
-
-            # Run from dedicated temporary folder
-            current_result['meta']['id'] = str(uuid.uuid4())
-            temp_dir = os.path.join(data_folder, current_result['meta']['id'])
-            if not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-
-            jt = s.createJobTemplate()
-            jt.remoteCommand = os.path.dirname(
-                os.path.abspath(__file__)) + '/run_program.sh'
-            jt.args = [command]
-            jt.jobEnvironment = self.environment
-            jt.workingDirectory = temp_dir
-            jt.nativeSpecification = SIMULATION_GRID_PARAMS
-            output_filename = os.path.join(temp_dir, 'stdout')
-            error_filename = os.path.join(temp_dir, 'stderr')
-            jt.outputPath = ':' + output_filename
-            jt.errorPath = ':' + error_filename
-
-            jobid = s.runJob(jt)
-
-            # Save the template in our dictionary
-            jobs[jobid] = {
-                'template': jt,
-                'result': current_result,
-                'output': output_filename,
-                'error': error_filename,
-                }
-
-        # Check for job completion, yield results when they are ready
         try:
+            jt = self.create_job_template(s, tasks_dir)
+            submission_time = time.time()
+            jobids = s.runBulkJobs(jt, 1, len(tasks), 1)
+            s.deleteJobTemplate(jt)
+
+            for jobid, task in zip(jobids, tasks):
+                task['submission_time'] = submission_time
+                jobs[jobid] = task
+                if callbacks is not None:
+                    for task_result in task['results']:
+                        for cb in callbacks:
+                            cb.on_run_start(task_result['params'],
+                                            task_result['meta']['id'])
+
+            # Wait for any task to complete, yield results when they are ready
+            while jobs:
+                try:
+                    info = s.wait(drmaa.Session.JOB_IDS_SESSION_ANY,
+                                  WAIT_TIMEOUT)
+                except drmaa.errors.ExitTimeoutException:
+                    continue
+                except drmaa.errors.DrmCommunicationException:
+                    time.sleep(WAIT_TIMEOUT)
+                    continue
+
+                task = jobs.pop(info.jobId, None)
+                if task is None:
+                    continue
+
+                for current_result in self.complete_task(task, info,
+                                                         data_folder):
+                    if callbacks is not None:
+                        for cb in callbacks:
+                            cb.on_run_end(current_result['meta']['id'],
+                                          current_result['meta']['exitcode'],
+                                          current_result['meta']['elapsed_time'])
+
+                    if stop_on_errors:
+                        self.check_for_errors(current_result, data_folder)
+
+                    self.update_run_statistics(current_result)
+                    yield current_result
 
-            while len(jobs):
-                found_done = False
-                for curjob in jobs.keys():
-                    try:
-                        status = s.jobStatus(curjob)
-                    except drmaa.errors.DrmCommunicationException:
-                        pass
-                    if status is drmaa.JobState.DONE:
-
-                        current_result = jobs[curjob]['result']
+        finally:
+            if jobs:
+                terminate_jobs(s, list(jobs))
+            shutil.rmtree(tasks_dir, ignore_errors=True)
 
-                        # TODO Actually compute time elapsed in the running
-                        # state
-                        current_result['meta']['elapsed_time'] = 0
+        if callbacks is not None:
+            for cb in callbacks:
+                if not cb.is_controlled_by_parent():
+                    cb.on_simulation_end()
 
-                        try:
-                            s.deleteJobTemplate(jobs[curjob]['template'])
-                        except drmaa.errors.DrmCommunicationException:
-                            pass
+    def create_task(self, pack, task_dir, data_folder):
+        """
+        Prepare the folder of a grid task running a pack of simulations, and
+        return a dictionary describing the task.
+
+        Args:
+            pack (list): the parameter combinations the task should run.
+            task_dir (str): the folder of the task.
+            data_folder (str): folder in which to save subfolders containing
+                simulation output.
+        """
+        os.makedirs(task_dir)
+        task_results = []
+        with open(os.path.join(task_dir, 'runs'), 'w') as runs_file:
+            for parameter in pack:
+                # Initialize result
+                current_result = {
+                    'params': {},
+                    'meta': {}
+                }
+                current_result['params'].update(parameter)
+
+                # With staging, the job script points SEM_EXECUTABLE to
+                # the copy of the executable on the node
+                executable = ('"$SEM_EXECUTABLE"' if self.stage_dir is not
+                              None else self.script_executable)
+                command = " ".join(
+                    [executable] +
+                    ['--%s=%s' % (param, value) for param, value in
+                     parameter.items()])
+                command = self.get_limits_prefix() + command
+
+                # Run from dedicated temporary folder
+                current_result['meta']['id'] = str(uuid.uuid4())
+                temp_dir = os.path.join(data_folder,
+                                        current_result['meta']['id'])
+                if not os.path.exists(temp_dir):
+                    os.makedirs(temp_dir)
+
+                runs_file.write('%s\t%s\n' % (temp_dir, command))
+                task_results.append(current_result)
+        return {'dir': task_dir, 'results': task_results}
+
+    def create_job_template(self, session, tasks_dir):
+        """
+        Return a job template running the task whose folder, inside
+        tasks_dir, is named after the parametric index of the job.
 
-                        del jobs[curjob]
+        If staging is enabled, the job first makes sure the build is staged
+        on its node, as described by the files written in the staging
+        subfolder of tasks_dir.
 
-                        found_done = True
+        If a scratch folder is used, simulations are run in a folder inside
+        it on their node, and their output files are then moved to their
+        folder in the campaign directory.
 
-                        yield current_result
+        Args:
+            session (Session): the DRMAA session to create the template in.
+            tasks_dir (str): the folder containing the folders of the tasks.
+        """
+        jt = session.createJobTemplate()
+        jt.remoteCommand = os.path.dirname(
+            os.path.abspath(__file__)) + '/run_task.sh'
+        jt.args = [str(self.job_parallelism)]
+        jt.jobEnvironment = self.environment
+
+        if self.stage_dir is not None:
+            # Describe the files to copy to each node, and their checksums
+            staging_dir = os.path.join(tasks_dir, 'staging')
+            os.makedirs(staging_dir, exist_ok=True)
+            manifest = self.get_staging_manifest()
+            with open(os.path.join(staging_dir, 'files'), 'w') as files:
+                for source, destination, _ in manifest:
+                    files.write('%s\t%s\n' % (source, destination))
+            with open(os.path.join(staging_dir, 'checksums'),
+                      'w') as checksums:
+                checksums.write(self.get_staging_checksums(manifest))
+            jt.args += [staging_dir, self.stage_dir]
+            jt.jobEnvironment = dict(self.environment,
+                                     SEM_EXECUTABLE=self.script_executable)
+        elif self.scratch_dir is not None:
+            jt.args += ['', '']
+
+        if self.scratch_dir is not None:
+            jt.args.append(self.scratch_dir)
+        jt.workingDirectory = os.path.join(
+            tasks_dir, drmaa.JobTemplate.PARAMETRIC_INDEX)
+        jt.nativeSpecification = SIMULATION_GRID_PARAMS
+        jt.outputPath = ':' + os.path.join(
+            tasks_dir, drmaa.JobTemplate.PARAMETRIC_INDEX, 'output')
+        jt.joinFiles = True
+        return jt
+
+    def complete_task(self, task, info, data_folder):
+        """
+        Return the results of a completed task, with their meta filled in.
+
+        Args:
+            task (dict): the task, as returned by create_task, with the time
+                it was submitted at in its submission_time entry.
+            info (JobInfo): the information returned by DRMAA about the job
+                that ran the task.
+            data_folder (str): folder containing the simulation output.
+        """
+        runs = self.read_task_status(task['dir'])
+        usage = self.get_job_usage(info, task['submission_time'], runs)
+        for current_result in task['results']:
+            temp_dir = os.path.join(data_folder, current_result['meta']['id'])
+            # Runs without a status were never completed, e.g., because their
+            # job was killed
+            exitcode, start, end = runs.get(temp_dir, (-1, 0, 0))
+            current_result['meta']['elapsed_time'] = end - start
+            current_result['meta']['exitcode'] = exitcode
+            current_result['meta'].update(self.get_limits_status(
+                temp_dir in runs, exitcode, end - start,
+                os.path.join(temp_dir, 'stderr')))
+            if self.retention_policy is not None and os.path.isdir(temp_dir):
+                apply_retention_policy(temp_dir, self.retention_policy)
+
+            # The resource usage of jobs running multiple simulations can't be
+            # attributed to each of them, but their peak memory is still an
+            # upper bound for every simulation
+            if len(task['results']) == 1:
+                current_result['meta'].update(usage)
+            else:
+                current_result['meta'].update(
+                    {k: v for k, v in usage.items() if k in
+                     ['queue_time', 'max_rss']})
+        return task['results']
+
+    def get_limits_status(self, completed, exitcode, elapsed_time,
+                          stderr_file_path):
+        """
+        Return whether a simulation run by a task timed out or was stopped
+        because it exceeded its resource limits, as the timed_out and
+        killed_by_limit fields of its meta.
+
+        Simulations are killed with a SIGKILL both by the timeout and the
+        CPU time limit enforced by get_limits_prefix, which the shell reports
+        as an exit code of 128 + the signal number: the two cases are thus
+        told apart through the elapsed time of the simulation.
+
+        Args:
+            completed (bool): whether the task reported the exit code of the
+                simulation.
+            exitcode (int): the exit code of the simulation, as reported by
+                the shell.
+            elapsed_time (float): the elapsed time of the simulation.
+            stderr_file_path (str): path to the standard error of the
+                simulation.
+        """
+        status = {'timed_out': False, 'killed_by_limit': False}
+        if not completed or exitcode == 0:
+            return status
+        if (self.timeout is not None and
+                exitcode in [124, 128 + signal.SIGKILL] and
+                elapsed_time >= self.timeout):
+            status['timed_out'] = True
+        elif os.path.exists(stderr_file_path):
+            # Negative exit codes indicate the signal that killed the
+            # simulation, as for local runs
+            status['killed_by_limit'] = self.was_killed_by_limit(
+                128 - exitcode if exitcode > 128 else exitcode,
+                stderr_file_path)
+        return status
+
+    @staticmethod
+    def check_for_errors(result, data_folder):
+        """
+        Raise an exception if a simulation exited with an error. Simulations
+        that timed out or exceeded their resource limits are not considered
+        errors.
+        """
+        if (result['meta'].get('timed_out') or
+                result['meta'].get('killed_by_limit')):
+            return
+        if result['meta']['exitcode'] != 0:
+            with open(os.path.join(data_folder, result['meta']['id'],
+                                   'stderr'), 'r') as stderr_file:
+                raise Exception('\nSimulation exited with an error.\n'
+                                'Params: %s\n'
+                                'Stderr: %s' %
+                                (result['params'], stderr_file.read()))
+
+    def pack_simulations(self, parameter_list):
+        """
+        Split a list of parameter combinations into packs, each of which is
+        run by a single grid job.
 
-                        break
-                if not found_done:  # Sleep if we can't find a completed task
-                    time.sleep(6)
+        If job_duration is None, each parameter combination is run by its own
+        job. Otherwise, packs are filled with parameter combinations until
+        their predicted duration reaches job_duration. The duration of
+        parameter combinations that were never run before is assumed to be
+        the median of the known ones, or job_duration if none is known.
 
-        finally:
+        Args:
+            parameter_list (list): list of parameter combinations to pack.
+        """
+        if self.job_duration is None:
+            return [[parameter] for parameter in parameter_list]
+
+        predictions = [self.predict(parameter, 'elapsed_time') for parameter
+                       in parameter_list]
+        known_predictions = sorted(p for p in predictions if p)
+        if known_predictions:
+            default_prediction = known_predictions[len(known_predictions) // 2]
+        else:
+            default_prediction = self.job_duration
+
+        packs = []
+        pack = []
+        pack_duration = 0
+        for parameter, prediction in zip(parameter_list, predictions):
+            duration = (prediction or default_prediction) / self.job_parallelism
+            if pack and pack_duration + duration > self.job_duration:
+                packs.append(pack)
+                pack = []
+                pack_duration = 0
+            pack.append(parameter)
+            pack_duration += duration
+        if pack:
+            packs.append(pack)
+        return packs
+
+    @staticmethod
+    def get_job_usage(info, submission_time, runs):
+        """
+        Return the time a job spent in the queue and the resources it used,
+        as fields for the meta of its results.
+
+        The queue time is computed from the start and submission times
+        reported by DRMAA, if available, or otherwise from the time the first
+        simulation of the job started.
+
+        Args:
+            info (JobInfo): the information returned by DRMAA about the
+                completed job.
+            submission_time (float): the time the job was submitted at.
+            runs (dict): the status of the runs of the job, as returned by
+                read_task_status.
+        """
+        resource_usage = getattr(info, 'resourceUsage', None) or {}
+        usage = {}
+        for name, field in RESOURCE_USAGE_FIELDS.items():
             try:
-                for v in jobs.values():
-                    s.deleteJobTemplate(v['template'])
-                s.control(drmaa.JOB_IDS_SESSION_ALL,
-                          drmaa.JobControlAction.TERMINATE)
-                s.synchronize([drmaa.JOB_IDS_SESSION_ALL], dispose=True)
-                s.exit()
-            except(drmaa.errors.NoActiveSessionException):
-                pass
+                usage[field] = float(resource_usage[name])
+            except (KeyError, ValueError):
+                continue
+        if 'max_rss' in usage:
+            usage['max_rss'] = int(usage['max_rss'])
+
+        try:
+            usage['queue_time'] = (float(resource_usage['start_time']) -
+                                   float(resource_usage['submission_time']))
+        except (KeyError, ValueError):
+            if runs:
+                usage['queue_time'] = max(0, min(
+                    start for _, start, _ in runs.values()) - submission_time)
+        return usage
+
+    @staticmethod
+    def read_task_status(task_dir):
+        """
+        Return the exit code, start time and end time of the completed runs of
+        a task, indexed by the folder they were run from.
+
+        Args:
+            task_dir (str): the folder of the task.
+        """
+        runs = {}
+        try:
+            with open(os.path.join(task_dir, 'status'), 'r') as status_file:
+                for line in status_file:
+                    exitcode, start, end, temp_dir = line.rstrip(
+                        '\n').split(' ', 3)
+                    runs[temp_dir] = (int(exitcode), float(start), float(end))
+        except OSError:
+            pass
+        return runs
+
+    def get_limits_prefix(self):
+        """
+        Return a shell prefix enforcing the time and resource limits of this
+        runner on the node where a simulation is executed.
+        """
+        prefix = ''
+        if self.cpu_time_limit is not None:
+            prefix += 'ulimit -t %d; ' % self.cpu_time_limit
+        if self.memory_limit is not None:
+            # ulimit takes the address space size in kilobytes
+            prefix += 'ulimit -v %d; ' % (self.memory_limit // 1024)
+        if self.timeout is not None:
+            prefix += 'timeout --signal=KILL %s ' % self.timeout
+        return prefix
 
     def configure_and_build(self, show_progress=True, optimized=True,
                             skip_configuration=False):
+        """
+        Configure and build ns-3 through a single grid job.
 
-        clean_before = False
-        if clean_before:
-            clean_command = 'python3 waf distclean'
-            self.run_program((clean_command), self.path,
-                             native_spec=BUILD_GRID_PARAMS)
+        See SimulationRunner.configure_and_build for a description of the
+        arguments.
+        """
+        build_program = ("./ns3" if os.path.exists(os.path.join(self.path,
+                                                                "ns3"))
+                         else "./waf")
 
+        commands = []
         if not skip_configuration:
-            configuration_command = 'python3 waf configure --enable-examples ' +\
-                '--disable-gtk --disable-python '
+            configuration_command = ('python3 %s configure --enable-examples '
+                                     '--disable-gtk --disable-werror' %
+                                     build_program)
             if optimized:
-                configuration_command += '--build-profile=optimized ' +\
-                    '--out=build/optimized'
-            self.run_program((configuration_command), self.path,
-                             native_spec=BUILD_GRID_PARAMS)
+                configuration_command += (' --build-profile=optimized '
+                                          '--out=build/optimized')
+            commands.append(configuration_command)
 
-        self.run_program(('python3 waf build'), self.path,
+        j_argument = ('-j %s ' % self.max_parallel_processes if
+                      self.max_parallel_processes else '')
+        commands.append('python3 %s %sbuild' % (build_program, j_argument))
+
+        self.run_program(' && '.join(commands), self.path,
                          native_spec=BUILD_GRID_PARAMS)
 
-    def get_available_parameters(self):
-        """
-        Return a list of the parameters made available by the script.
+    def discover_available_parameters(self):
         """
+        Find out which parameters the script makes available.
 
-        # At the moment, we rely on regex to extract the list of available
-        # parameters. A tighter integration with waf would allow for a more
-        # natural extraction of the information.
+        The script is run on the current machine if its executable can be
+        reached from here, and through the grid otherwise.
+        """
+        if os.access(self.script_executable, os.X_OK):
+            try:
+                return SimulationRunner.discover_available_parameters(self)
+            except (OSError, subprocess.CalledProcessError):
+                # The executable can't run on this machine
+                pass
 
-        stdout = self.run_program("%s %s" % (self.script_executable,
-                                             '--PrintHelp'),
+        separator = 'sem-%s' % uuid.uuid4()
+        stdout = self.run_program("%s --PrintHelp; echo %s; %s --PrintGlobals"
+                                  % (self.script_executable, separator,
+                                     self.script_executable),
                                   environment=self.environment,
                                   native_spec=BUILD_GRID_PARAMS)
+        help_output, _, global_options = stdout.partition(separator)
 
         options = re.findall(r'.*Program\s(?:Arguments|Options):(.*)'
                              r'General\sArguments.*',
-                             stdout, re.DOTALL)
+                             help_output, re.DOTALL)
 
-        if len(options):
-            args = re.findall(r'.*--(.*?):.*', options[0], re.MULTILINE)
-            return args
-        else:
-            return []
+        return self.parse_available_parameters(options, global_options)
 
     def run_program(self, command, working_directory=os.getcwd(),
                     environment=None, cleanup_files=True,
@@ -168,41 +521,90 @@ class GridRunner(SimulationRunner):
         """
         Run a program through the grid, capturing the standard output.
         """
+        s = get_session()
+        jt = s.createJobTemplate()
+        jt.remoteCommand = os.path.dirname(
+            os.path.abspath(__file__)) + '/run_program.sh'
+        jt.args = [command]
+
+        if environment is not None:
+            jt.jobEnvironment = environment
+
+        jt.workingDirectory = working_directory
+        jt.nativeSpecification = native_spec
+        output_filename = os.path.join(working_directory,
+                                       'output-%s.txt' % uuid.uuid4())
+        jt.outputPath = ':' + output_filename
+        jt.joinFiles = True
+
+        jobid = None
         try:
-            s = drmaa.Session()
-            s.initialize()
-            jt = s.createJobTemplate()
-            jt.remoteCommand = os.path.dirname(
-                os.path.abspath(__file__)) + '/run_program.sh'
-            jt.args = [command]
-
-            if environment is not None:
-                jt.jobEnvironment = environment
-
-            jt.workingDirectory = working_directory
-            jt.nativeSpecification = native_spec
-            output_filename = os.path.join(working_directory, 'output.txt')
-            jt.outputPath = ':' + output_filename
-            jt.joinFiles = True
-
             jobid = s.runJob(jt)
-
             s.wait(jobid, drmaa.Session.TIMEOUT_WAIT_FOREVER)
+            jobid = None
+        finally:
+            s.deleteJobTemplate(jt)
+            # Don't leave the job behind if we were interrupted
+            if jobid is not None:
+                terminate_jobs(s, [jobid])
 
-            with open(output_filename, 'r') as output:
-                stdout = output.read()
+        with open(output_filename, 'r') as output:
+            stdout = output.read()
 
-            # Clean up
-            if cleanup_files:
-                os.remove(output_filename)
+        # Clean up
+        if cleanup_files:
+            os.remove(output_filename)
 
-        finally:
+        return stdout
+
+
+def get_session():
+    """
+    Return the DRMAA session of this process, opening it on first use.
+
+    DRMAA only supports a single session per process: the session is shared
+    by all runners, and is closed when the interpreter exits.
+    """
+    global session
+    with session_lock:
+        if session is None:
+            session = drmaa.Session()
+            session.initialize()
+            atexit.register(close_session)
+        return session
+
+
+def close_session():
+    """
+    Close the DRMAA session of this process, if it is open.
+    """
+    global session
+    with session_lock:
+        if session is not None:
             try:
-                s.control(drmaa.JOB_IDS_SESSION_ALL,
-                          drmaa.JobControlAction.TERMINATE)
-                s.synchronize([drmaa.JOB_IDS_SESSION_ALL], dispose=True)
-                s.exit()
-            except(drmaa.errors.NoActiveSessionException):
+                session.exit()
+            except drmaa.errors.NoActiveSessionException:
                 pass
+            session = None
 
-        return stdout
+
+def terminate_jobs(s, jobids):
+    """
+    Terminate jobs, and wait for the grid to clean them up.
+
+    Args:
+        s (Session): the DRMAA session the jobs were submitted in.
+        jobids (list): the ids of the jobs to terminate.
+    """
+    for jobid in jobids:
+        try:
+            s.control(jobid, drmaa.JobControlAction.TERMINATE)
+        except (drmaa.errors.InvalidJobException,
+                drmaa.errors.DrmCommunicationException):
+            pass
+    try:
+        s.synchronize(list(jobids), SYNCHRONIZE_TIMEOUT, dispose=True)
+    except (drmaa.errors.ExitTimeoutException,
+            drmaa.errors.InvalidJobException,
+            drmaa.errors.DrmCommunicationException):
+        pass
@@ -0,0 +1,257 @@
+from .runner import SimulationRunner
+from .gridrunner import GridRunner, WAIT_TIMEOUT, get_session, terminate_jobs
+from .utils import DRMAA_AVAILABLE, CallbackBase
+if DRMAA_AVAILABLE:
+    import drmaa
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+# Seconds to wait for a grid job to complete before checking on local
+# simulations, and on grid jobs that could be run locally instead
+POLL_INTERVAL = 1
+
+
+class HybridRunner(GridRunner):
+    """
+    A Runner which runs simulations both on the current machine and on a
+    DRMAA-compatible cluster at the same time.
+
+    Simulations are taken from a single list of pending ones, sorted by their
+    predicted running time: the longest ones are submitted to the grid, while
+    the shortest ones are run locally. Whenever local processes are idle,
+    simulations that are still waiting in the grid queue are taken back and
+    run locally.
+    """
+
+    settings: [str] = ['max_grid_jobs']
+
+    def __init__(self, path, script, optimized=True, skip_configuration=False,
+                 max_parallel_processes=None, max_grid_jobs=None, **kwargs):
+        """
+        Initialization function.
+
+        Args:
+            max_parallel_processes (int): number of simulations to run at the
+                same time on the current machine. Defaults to the number of
+                available CPUs.
+            max_grid_jobs (int): maximum number of jobs submitted to the grid
+                at the same time, or None for no limit.
+
+        See GridRunner for the remaining arguments.
+        """
+        GridRunner.__init__(self, path, script, optimized, skip_configuration,
+                            max_parallel_processes, **kwargs)
+        self.max_grid_jobs = max_grid_jobs
+
+    def run_simulations(self, parameter_list, data_folder,
+                        callbacks: [CallbackBase] = None,
+                        stop_on_errors=False):
+        """
+        Run simulations locally and on the grid, yielding results as they are
+        completed.
+
+        Args:
+            parameter_list (list): list of parameter combinations to simulate.
+            data_folder (str): folder in which to save subfolders containing
+                simulation output.
+            callbacks (list): list of callbacks to be triggered.
+            stop_on_errors (bool): whether to stop if a simulation outputs an
+                error.
+        """
+        parameter_list = list(parameter_list)
+        if not parameter_list:
+            return
+
+        if callbacks is not None:
+            for cb in callbacks:
+                cb.on_simulation_start(len(parameter_list))
+                cb.controlled_by_parent = True
+
+        # Pending simulations, from the longest to the shortest
+        pending = self.sort_by_predicted_time(parameter_list)
+        local_processes = self.max_parallel_processes or os.cpu_count()
+        state = {'busy': 0, 'finished': False}
+        condition = threading.Condition()
+        results = queue.Queue()
+
+        def run_locally():
+            while True:
+                with condition:
+                    while not pending and not state['finished']:
+                        condition.wait()
+                    if state['finished']:
+                        return
+                    parameter = pending.pop()
+                    state['busy'] += 1
+                try:
+                    results.put(next(SimulationRunner.run_simulations(
+                        self, [parameter], data_folder, callbacks=callbacks)))
+                except Exception as e:
+                    results.put(e)
+                finally:
+                    with condition:
+                        state['busy'] -= 1
+
+        workers = [threading.Thread(target=run_locally, daemon=True) for _ in
+                   range(local_processes)]
+        for worker in workers:
+            worker.start()
+
+        tasks_dir = os.path.join(data_folder, '.tasks-%s' % uuid.uuid4())
+        os.makedirs(tasks_dir)
+        s = get_session()
+        jobs = {}
+        try:
+            jt = self.create_job_template(s, tasks_dir)
+            index = 0
+            remaining = len(parameter_list)
+            while remaining:
+                with condition:
+                    # Submit the longest simulations to the grid, leaving
+                    # enough of them to keep local processes busy
+                    while (len(pending) > local_processes - state['busy'] and
+                           (self.max_grid_jobs is None or
+                            len(jobs) < self.max_grid_jobs)):
+                        index += 1
+                        task = self.create_task(
+                            [pending.pop(0)],
+                            os.path.join(tasks_dir, str(index)), data_folder)
+                        task['submission_time'] = time.time()
+                        jobid = s.runBulkJobs(jt, index, index, 1)[0]
+                        jobs[jobid] = task
+                        if callbacks is not None:
+                            for cb in callbacks:
+                                cb.on_run_start(task['results'][0]['params'],
+                                                task['results'][0]['meta']['id'])
+
+                    # Take back simulations that are still queued, if local
+                    # processes are idle
+                    if not pending and state['busy'] < local_processes:
+                        self.take_back_queued_jobs(
+                            s, jobs, pending, local_processes - state['busy'],
+                            data_folder)
+                    condition.notify_all()
+
+                completed = []
+                try:
+                    while True:
+                        completed.append(results.get_nowait())
+                except queue.Empty:
+                    pass
+
+                if not completed:
+                    if jobs:
+                        try:
+                            info = s.wait(drmaa.Session.JOB_IDS_SESSION_ANY,
+                                          POLL_INTERVAL)
+                        except drmaa.errors.ExitTimeoutException:
+                            continue
+                        except drmaa.errors.DrmCommunicationException:
+                            time.sleep(WAIT_TIMEOUT)
+                            continue
+                        task = jobs.pop(info.jobId, None)
+                        if task is None:
+                            continue
+                        for current_result in self.complete_task(task, info,
+                                                                 data_folder):
+                            if callbacks is not None:
+                                for cb in callbacks:
+                                    cb.on_run_end(
+                                        current_result['meta']['id'],
+                                        current_result['meta']['exitcode'],
+                                        current_result['meta']['elapsed_time'])
+                            self.update_run_statistics(current_result)
+                            completed.append(current_result)
+                    else:
+                        try:
+                            completed.append(results.get(
+                                timeout=POLL_INTERVAL))
+                        except queue.Empty:
+                            continue
+
+                for current_result in completed:
+                    if isinstance(current_result, Exception):
+                        raise current_result
+                    if stop_on_errors:
+                        self.check_for_errors(current_result, data_folder)
+                    remaining -= 1
+                    yield current_result
+
+        finally:
+            with condition:
+                state['finished'] = True
+                condition.notify_all()
+            # Stop the simulations that are still running locally
+            for sim_uuid in list(self.running):
+                self.cancel_simulation(sim_uuid)
+            if jobs:
+                terminate_jobs(s, list(jobs))
+            shutil.rmtree(tasks_dir, ignore_errors=True)
+
+        if callbacks is not None:
+            for cb in callbacks:
+                cb.on_simulation_end()
+
+    def take_back_queued_jobs(self, session, jobs, pending, number,
+                              data_folder):
+        """
+        Remove up to number of the shortest simulations that are still queued
+        on the grid from jobs, and add them back to the pending ones.
+
+        Jobs can start between the status check and their termination: they
+        are only taken back if they are still queued, or were terminated,
+        after their termination was requested. Otherwise, or if their status
+        cannot be retrieved, they are left on the grid.
+
+        Args:
+            session (Session): the DRMAA session the jobs were submitted in.
+            jobs (dict): the tasks submitted to the grid, indexed by job id.
+            pending (list): the pending simulations.
+            number (int): the maximum number of simulations to take back.
+            data_folder (str): folder containing the simulation output.
+        """
+        for jobid in reversed(list(jobs)):
+            if number == 0:
+                break
+            try:
+                if (session.jobStatus(jobid) !=
+                        drmaa.JobState.QUEUED_ACTIVE):
+                    continue
+                session.control(jobid, drmaa.JobControlAction.TERMINATE)
+                if session.jobStatus(jobid) not in [
+                        drmaa.JobState.QUEUED_ACTIVE, drmaa.JobState.FAILED]:
+                    continue
+            except (drmaa.errors.DrmCommunicationException,
+                    drmaa.errors.InvalidJobException):
+                continue
+            task = jobs.pop(jobid)
+            for task_result in task['results']:
+                shutil.rmtree(os.path.join(data_folder,
+                                           task_result['meta']['id']),
+                              ignore_errors=True)
+                pending.append(task_result['params'])
+            number -= 1
+
+    def sort_by_predicted_time(self, parameter_list):
+        """
+        Return the parameter combinations sorted from the one with the longest
+        predicted running time to the one with the shortest. Parameter
+        combinations that were never run are assumed to take the median of
+        the known running times.
+
+        Args:
+            parameter_list (list): list of parameter combinations to sort.
+        """
+        predictions = [self.predict(parameter, 'elapsed_time') for parameter
+                       in parameter_list]
+        known_predictions = sorted(p for p in predictions if p)
+        default_prediction = (known_predictions[len(known_predictions) // 2]
+                              if known_predictions else 0)
+        order = sorted(range(len(parameter_list)),
+                       key=lambda i: predictions[i] or default_prediction,
+                       reverse=True)
+        return [parameter_list[i] for i in order]
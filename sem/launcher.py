@@ -0,0 +1,282 @@
+"""
+A small helper process spawning simulations on behalf of runners.
+
+Forking a Python process that loaded a large campaign (and possibly pandas or
+xarray) to start each simulation is slow, and on Linux the peak memory of the
+forked process is accounted in the peak RSS of the simulation. The launcher is
+instead a separate Python interpreter that only uses the standard library:
+runners send it the simulations to start over a pipe, and it spawns them with
+posix_spawn, reaps them and sends back their exit code and resource usage.
+
+This module is both imported by runners, which use the Launcher client, and
+run as a script to start the launcher process: it must thus only depend on the
+standard library.
+"""
+import errno
+import itertools
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+
+# Launcher used by the runners of this process, and lock protecting it
+launcher = None
+launcher_lock = threading.Lock()
+
+
+def get_launcher():
+    """
+    Return the launcher of this process, starting it if it is not running.
+
+    Processes forked from the one that started the launcher start their own.
+    """
+    global launcher
+    with launcher_lock:
+        if (launcher is None or launcher.owner != os.getpid() or
+                not launcher.is_alive()):
+            launcher = Launcher()
+        return launcher
+
+
+class LaunchedProcess(object):
+    """
+    A simulation process spawned by the launcher.
+    """
+
+    def __init__(self, launcher, request_id):
+        self.launcher = launcher
+        self.request_id = request_id
+        self.pid = None
+        self.returncode = None
+        self.rusage = None
+        self.error = None
+        self.started = threading.Event()
+        self.exited = threading.Event()
+
+    def wait(self):
+        """
+        Wait for the process to exit, and return its exit code together with
+        its resource usage, as a resource.struct_rusage.
+        """
+        self.exited.wait()
+        if self.error is not None:
+            raise OSError(*self.error)
+        return self.returncode, self.rusage
+
+    def kill(self):
+        """
+        Kill the process with SIGKILL, unless it already exited.
+        """
+        try:
+            self.launcher.send({'op': 'kill', 'id': self.request_id})
+        except OSError:
+            # The launcher exited, and so did its processes
+            pass
+
+
+class Launcher(object):
+    """
+    Client of a launcher process.
+    """
+
+    def __init__(self):
+        """
+        Start the launcher process.
+        """
+        self.process = subprocess.Popen([sys.executable, '-I',
+                                         os.path.abspath(__file__)],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True)
+        self.owner = os.getpid()
+        self.write_lock = threading.Lock()
+        # Processes that were not reaped yet, indexed by their request id
+        self.processes = {}
+        self.ids = itertools.count()
+        threading.Thread(target=self.read_replies, daemon=True).start()
+
+    def is_alive(self):
+        """
+        Return whether the launcher process is still running.
+        """
+        return self.process.poll() is None
+
+    def send(self, message):
+        """
+        Send a request to the launcher process.
+        """
+        with self.write_lock:
+            self.process.stdin.write((json.dumps(message) + '\n').encode())
+            self.process.stdin.flush()
+
+    def spawn(self, command, cwd, env, stdout_path, stderr_path, cpus=None,
+              limits=None):
+        """
+        Start a simulation, and return it as a LaunchedProcess.
+
+        Args:
+            command (list): the executable, followed by its arguments.
+            cwd (str): the folder to run the simulation in.
+            env (dict): the environment of the simulation.
+            stdout_path (str): the file to redirect the standard output to.
+            stderr_path (str): the file to redirect the standard error to.
+            cpus (list): the CPUs to pin the simulation to, or None.
+            limits (list): the (resource, soft, hard) limits to set, as
+                accepted by resource.prlimit.
+        """
+        # The launcher runs in a different folder than this process: paths
+        # are made absolute so that they resolve as they would here
+        if os.sep in command[0]:
+            command = [os.path.abspath(command[0])] + list(command[1:])
+        process = LaunchedProcess(self, next(self.ids))
+        self.processes[process.request_id] = process
+        try:
+            self.send({'op': 'spawn', 'id': process.request_id,
+                       'command': command, 'cwd': os.path.abspath(cwd),
+                       'env': env, 'stdout': os.path.abspath(stdout_path),
+                       'stderr': os.path.abspath(stderr_path),
+                       'cpus': cpus, 'limits': limits or []})
+        except OSError:
+            self.processes.pop(process.request_id, None)
+            raise
+        process.started.wait()
+        if process.error is not None:
+            self.processes.pop(process.request_id, None)
+            raise OSError(*process.error)
+        return process
+
+    def read_replies(self):
+        """
+        Read the replies of the launcher process, until it exits.
+        """
+        for line in self.process.stdout:
+            reply = json.loads(line)
+            process = self.processes.get(reply['id'])
+            if process is None:
+                continue
+            if 'error' in reply:
+                process.error = reply['error']
+                process.started.set()
+            elif 'pid' in reply:
+                process.pid = reply['pid']
+                process.started.set()
+            else:
+                process.returncode = reply['returncode']
+                process.rusage = resource.struct_rusage(reply['rusage'])
+                del self.processes[reply['id']]
+                process.exited.set()
+
+        # The launcher exited: nothing will happen to the processes it was
+        # tracking anymore
+        for process in list(self.processes.values()):
+            process.error = (0, 'The launcher process exited')
+            process.started.set()
+            process.exited.set()
+        self.processes.clear()
+
+
+def serve():
+    """
+    Serve the requests of a Launcher client, read from the standard input,
+    until it is closed.
+    """
+    output = sys.stdout
+    output_lock = threading.Lock()
+    # Request ids of the spawned processes that were not reaped yet,
+    # indexed by their pid
+    children = {}
+    lock = threading.Condition()
+
+    def send(message):
+        with output_lock:
+            output.write(json.dumps(message) + '\n')
+            output.flush()
+
+    def reap():
+        while True:
+            with lock:
+                while not children:
+                    lock.wait()
+            # Wait for a child to exit without reaping it, so that kill
+            # requests never signal a recycled process id
+            try:
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
+            except ChildProcessError:
+                continue
+            with lock:
+                _, status, rusage = os.wait4(info.si_pid, 0)
+                request_id = children.pop(info.si_pid)
+            send({'id': request_id,
+                  'returncode': os.waitstatus_to_exitcode(status),
+                  'rusage': list(rusage)})
+
+    threading.Thread(target=reap, daemon=True).start()
+
+    # Simulations should not read from the pipe of the launcher
+    sys.stdin = None
+    for line in os.fdopen(0, 'r'):
+        request = json.loads(line)
+        if request['op'] == 'kill':
+            with lock:
+                for pid, request_id in children.items():
+                    if request_id == request['id']:
+                        os.kill(pid, signal.SIGKILL)
+            continue
+
+        # Holding the lock until the pid is sent makes sure the exit of the
+        # process is reported after its start
+        with lock:
+            try:
+                # posix_spawn doesn't change folder: since processes are only
+                # spawned from this thread, we can change the folder of the
+                # launcher itself. Paths are thus required to be absolute, so
+                # that they don't depend on the folder of the last simulation
+                paths = [request['cwd'], request['stdout'], request['stderr']]
+                if os.sep in request['command'][0]:
+                    paths.append(request['command'][0])
+                for path in paths:
+                    if not os.path.isabs(path):
+                        raise OSError(errno.EINVAL, 'Path is not absolute',
+                                      path)
+                os.chdir(request['cwd'])
+                write_flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+                pid = os.posix_spawn(
+                    request['command'][0], request['command'],
+                    request['env'] if request['env'] is not None else
+                    os.environ,
+                    file_actions=[
+                        (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                        (os.POSIX_SPAWN_OPEN, 1, request['stdout'],
+                         write_flags, 0o644),
+                        (os.POSIX_SPAWN_OPEN, 2, request['stderr'],
+                         write_flags, 0o644)],
+                    setsigdef=[signal.SIGPIPE, signal.SIGXFSZ])
+            except OSError as e:
+                send({'id': request['id'], 'error': [e.errno, e.strerror,
+                                                     e.filename]})
+                continue
+            children[pid] = request['id']
+            lock.notify()
+
+            # Limits are set as soon as the simulation is started: the time
+            # it runs unconstrained is negligible
+            try:
+                if request['cpus'] is not None:
+                    os.sched_setaffinity(pid, request['cpus'])
+                for limit, soft, hard in request['limits']:
+                    resource.prlimit(pid, limit, (soft, hard))
+            except OSError:
+                # The process already exited
+                pass
+            send({'id': request['id'], 'pid': pid})
+
+
+if __name__ == '__main__':
+    # Replies are the only output of the launcher
+    stdout = os.fdopen(os.dup(1), 'w')
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    sys.stdout = stdout
+    serve()
@@ -1,5 +1,10 @@
 from .runner import SimulationRunner
-from multiprocessing import Pool, Queue, Lock, Array, cpu_count
+from multiprocessing import Array
+# Simulations are separate processes: threads are enough to run them in
+# parallel, and avoid forking this (possibly large) process
+from multiprocessing.pool import ThreadPool as Pool
+from queue import Queue
+from threading import Lock
 import queue
 import numpy as np
 from copy import deepcopy
@@ -21,17 +26,25 @@ class LptRunner(SimulationRunner):
     only creates its statistics as it performs simulations.
     """
 
-    def __init__(self, path, script, optimized, max_parallel_processes=None):
-        SimulationRunner.__init__(self, path, script, optimized, max_parallel_processes)
+    def __init__(self, path, script, optimized=True, skip_configuration=False,
+                 max_parallel_processes=None, **kwargs):
+        SimulationRunner.__init__(self, path, script, optimized,
+                                  skip_configuration, max_parallel_processes,
+                                  **kwargs)
         self.parameter_runtime_map = {}
 
-    def run_simulations(self, parameter_list, data_folder):
+    def run_simulations(self, parameter_list, data_folder, callbacks=None,
+                        stop_on_errors=False):
         """
         This function runs multiple simulations in parallel.
 
         Args:
             parameter_list (list): list of parameter combinations to simulate.
             data_folder (str): folder in which to create output folders.
+            callbacks (list): list of callbacks to be triggered. Callbacks
+                are currently not supported by this runner and are ignored.
+            stop_on_errors (bool): ignored by this runner, which never stops
+                on errors.
         """
         self.data_folder = data_folder
 
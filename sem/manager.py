@@ -1,7 +1,13 @@
 import collections
 import gc
+import hashlib
+import json
 import os
+import pickle
 import shutil
+import threading
+import time
+import warnings
 from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
@@ -18,18 +24,47 @@ from .database import DatabaseManager
 from .lptrunner import LptRunner
 from .parallelrunner import ParallelRunner
 from .conditionalrunner import ConditionalRunner
+from .distributedrunner import DistributedRunner
 from .runner import SimulationRunner
-from .utils import DRMAA_AVAILABLE, list_param_combinations
+from .utils import (DRMAA_AVAILABLE, list_param_combinations, is_repo_dirty,
+                    get_parser_identity)
 import pandas as pd
 
 if DRMAA_AVAILABLE:
     from .gridrunner import GridRunner
+    from .hybridrunner import HybridRunner
 
-def parse_result(param):
-    result, function_yields_multiple_results, result_parsing_function, param_columns = param
+def run_parsing_function(param):
+    result, result_parsing_function, function_yields_multiple_results = param
+    output = result_parsing_function(result)
+    # Generators are consumed, so that their output can be cached
+    if function_yields_multiple_results:
+        output = list(output)
+    return output
+
+def get_parse_cache_key(identity, files_to_load=r'.*',
+                        extract_complete_results=True):
+    """
+    Return the key identifying the outputs of a parsing function in the
+    campaign's parse cache, or None if the outputs should not be cached.
+
+    Args:
+        identity (str): the identity of the parsing function, as returned by
+            get_parser_identity.
+        files_to_load (str, list): the output files passed to the function.
+        extract_complete_results (bool): whether the function receives the
+            contents of the output files, or their paths.
+    """
+    if identity is None:
+        return None
+    return hashlib.sha1(repr((identity, files_to_load,
+                              extract_complete_results)).encode()).hexdigest()
+
+def format_parsed_result(result, parsed, function_yields_multiple_results,
+                         param_columns):
     data = []
     if function_yields_multiple_results:
-        for r in result_parsing_function(result):
+        for r in parsed:
             param_values = list(deepcopy(result['params']).values())
             if param_columns != 'all':
                 param_keys = list(deepcopy(result['params']).keys())
@@ -45,11 +80,78 @@ def parse_result(param):
             param_values_to_keep = list([v for k, v in list(zip(param_keys, param_values)) if k in param_columns])
         else:
             param_values_to_keep = param_values
-        parsed = result_parsing_function(result)
         param_values_to_keep += [parsed] if not isinstance(parsed, list) else parsed
         data += [param_values_to_keep]
     return data
 
+def parse_completed_result(param):
+    """
+    Run each of the result parsing functions on a result, and return a
+    dictionary containing their outputs, indexed by their key in the parse
+    cache (see get_parse_cache_key), which identifies both the function that
+    computed them and the output files it received.
+
+    Only outputs that can be stored in the database without being altered are
+    returned.
+    """
+    result, result_data_dir, result_parsing_functions = param
+    parsed = {}
+    for function in result_parsing_functions:
+        files_to_load = function.__dict__.get('files_to_load', None) or r'.*'
+        key = get_parse_cache_key(get_parser_identity(function), files_to_load)
+        if key is None:
+            continue
+        complete_result = deepcopy(result)
+        complete_result['output'] = DatabaseManager.load_output_files(
+            result_data_dir, files_to_load)
+        output = function(complete_result)
+        if function.__dict__.get('yields_multiple_results', None) is not None:
+            output = list(output)
+        try:
+            if json.loads(json.dumps(output)) == output:
+                parsed[key] = output
+        except (TypeError, ValueError):
+            pass
+    return parsed
+
+def collect_parsed_results(parsing, wait=False):
+    """
+    Remove the results whose parsing is over from parsing, a list of
+    [result, AsyncResult] pairs, and return them with their parsed outputs
+    stored in the parsed meta entry.
+
+    Args:
+        parsing (list): results currently being parsed.
+        wait (bool): whether to wait for all results to be parsed.
+    """
+    collected = []
+    for entry in list(parsing):
+        result, parsed = entry
+        if not wait and not parsed.ready():
+            continue
+        try:
+            outputs = parsed.get()
+        except Exception as e:
+            warnings.warn("Parsing of result %s failed: %s" %
+                          (result['meta']['id'], e))
+            outputs = {}
+        if outputs:
+            result['meta']['parsed'] = outputs
+        parsing.remove(entry)
+        collected.append(result)
+    return collected
+
+def get_stored_output(result, key):
+    """
+    Return a list containing the output stored in result for the parsing
+    function and output files identified by key, as returned by
+    get_parse_cache_key, or an empty list if no output is available.
+    """
+    parsed = result['meta'].get('parsed', {})
+    if key is not None and key in parsed:
+        return [parsed[key]]
+    return []
+
 class CampaignManager(object):
     """
     This Simulation Execution Manager class can be used as an interface to
@@ -64,7 +166,8 @@ class CampaignManager(object):
     # Campaign initialization and loading #
     #######################################
 
-    def __init__(self, campaign_db, campaign_runner, check_repo=True):
+    def __init__(self, campaign_db, campaign_runner, check_repo=True,
+                 repo_check_paths=None):
         """
         Initialize the Simulation Execution Manager, using the provided
         CampaignManager and SimulationRunner instances.
@@ -77,10 +180,17 @@ class CampaignManager(object):
                 associate to this campaign.
             campaign_runner (SimulationRunner): the SimulationRunner object to
                 associate to this campaign.
+            check_repo (bool): whether to make sure that the ns-3 repository
+                is clean and on the campaign's commit.
+            repo_check_paths (list): paths, relative to the root of the ns-3
+                repository, to limit the search for modified and untracked
+                files to (e.g., ['src', 'contrib', 'scratch']). If None, the
+                whole repository is checked.
         """
         self.db = campaign_db
         self.runner = campaign_runner
         self.check_repo = check_repo
+        self.repo_check_paths = repo_check_paths
 
         # Check that the current repo commit corresponds to the one specified
         # in the campaign
@@ -90,7 +200,8 @@ class CampaignManager(object):
     @classmethod
     def new(cls, ns_path, script, campaign_dir, runner_type='Auto',
             overwrite=False, optimized=True, check_repo=True,
-            skip_configuration=False, max_parallel_processes=None):
+            skip_configuration=False, max_parallel_processes=None,
+            repo_check_paths=None, **runner_kwargs):
         """
         Create a new campaign from an ns-3 installation and a campaign
         directory.
@@ -122,7 +233,10 @@ class CampaignManager(object):
                 Value can be: SimulationRunner (for running sequential
                 simulations locally), ParallelRunner (for running parallel
                 simulations locally), GridRunner (for running simulations using
-                a DRMAA-compatible parallel task scheduler). Use Auto to
+                a DRMAA-compatible parallel task scheduler), HybridRunner (for
+                running simulations both locally and through a DRMAA-compatible
+                task scheduler), DistributedRunner (for running simulations on
+                sem workers connected over the network). Use Auto to
                 automatically pick the best runner.
             overwrite (bool): whether to overwrite already existing
                 campaign_dir folders. This deletes the directory if and only if
@@ -133,6 +247,12 @@ class CampaignManager(object):
                 and only perform compilation.
                 NOTE: if skip_configuration=True and optimized=True, the build
                 folder should be manually set to --out=build/optimized.
+            repo_check_paths (list): paths, relative to ns_path, to limit the
+                search for modified and untracked files to. If None, the whole
+                repository is checked.
+            runner_kwargs: additional keyword arguments to pass to the
+                SimulationRunner constructor (e.g., timeout, cpu_time_limit
+                and memory_limit).
         """
         # Convert paths to be absolute
         ns_path = os.path.abspath(ns_path)
@@ -146,7 +266,9 @@ class CampaignManager(object):
                                            optimized=optimized,
                                            check_repo=check_repo,
                                            skip_configuration=skip_configuration,
-                                           max_parallel_processes=max_parallel_processes)
+                                           max_parallel_processes=max_parallel_processes,
+                                           repo_check_paths=repo_check_paths,
+                                           **runner_kwargs)
 
             if manager.db.get_script() == script:
                 return manager
@@ -158,7 +280,8 @@ class CampaignManager(object):
                                                runner_type=runner_type,
                                                optimized=optimized,
                                                skip_configuration=skip_configuration,
-                                               max_parallel_processes=max_parallel_processes)
+                                               max_parallel_processes=max_parallel_processes,
+                                               **runner_kwargs)
 
         # Get list of parameters to save in the DB
         params = runner.get_available_parameters()
@@ -169,7 +292,7 @@ class CampaignManager(object):
             from git import Repo, exc
             repo = Repo(ns_path)
             commit = repo.head.commit.hexsha
-            if repo.is_dirty(untracked_files=True):
+            if is_repo_dirty(repo, repo_check_paths):
                 raise Exception("ns-3 repository is not clean")
 
         # Create a database manager from the configuration
@@ -178,13 +301,16 @@ class CampaignManager(object):
                                  commit=commit,
                                  campaign_dir=campaign_dir,
                                  overwrite=overwrite)
+        db.set_build_fingerprint(runner.get_build_fingerprint())
+        db.set_retention_policy(runner.retention_policy)
 
-        return cls(db, runner, check_repo)
+        return cls(db, runner, check_repo, repo_check_paths)
 
     @classmethod
     def load(cls, campaign_dir, ns_path=None, runner_type='Auto',
              optimized=True, check_repo=True, skip_configuration=False,
-             max_parallel_processes=None):
+             max_parallel_processes=None, repo_check_paths=None,
+             **runner_kwargs):
         """
         Load an existing simulation campaign.
 
@@ -202,11 +328,18 @@ class CampaignManager(object):
                 Value can be: SimulationRunner (for running sequential
                 simulations locally), ParallelRunner (for running parallel
                 simulations locally), GridRunner (for running simulations using
-                a DRMAA-compatible parallel task scheduler).
+                a DRMAA-compatible parallel task scheduler), HybridRunner (for
+                running simulations both locally and through a DRMAA-compatible
+                task scheduler).
             optimized (bool): whether to configure the runner to employ an
                 optimized ns-3 build.
             skip_configuration (bool): whether to skip the configuration step,
                 and only perform compilation.
+            repo_check_paths (list): paths, relative to ns_path, to limit the
+                search for modified and untracked files to. If None, the whole
+                repository is checked.
+            runner_kwargs: additional keyword arguments to pass to the
+                SimulationRunner constructor.
         """
         # Convert paths to be absolute
         if ns_path is not None:
@@ -219,16 +352,23 @@ class CampaignManager(object):
 
         runner = None
         if ns_path is not None:
+            # The build is skipped if nothing changed since the last one
+            runner_kwargs.setdefault('build_fingerprint',
+                                     db.get_build_fingerprint())
+            # Keep the same output files as the previous simulations
+            runner_kwargs.setdefault('retention_policy',
+                                     db.get_retention_policy())
             runner = CampaignManager.create_runner(ns_path, script,
                                                    runner_type, optimized,
                                                    skip_configuration,
-                                                   max_parallel_processes=max_parallel_processes)
+                                                   max_parallel_processes=max_parallel_processes,
+                                                   **runner_kwargs)
 
-        return cls(db, runner, check_repo)
+        return cls(db, runner, check_repo, repo_check_paths)
 
     def create_runner(ns_path, script, runner_type='Auto',
                       optimized=True, skip_configuration=False,
-                      max_parallel_processes=None):
+                      max_parallel_processes=None, **runner_kwargs):
         """
         Create a SimulationRunner from a string containing the desired
         class implementation, and return it.
@@ -241,13 +381,17 @@ class CampaignManager(object):
                 Value can be: SimulationRunner (for running sequential
                 simulations locally), ParallelRunner (for running parallel
                 simulations locally), GridRunner (for running simulations using
-                a DRMAA-compatible parallel task scheduler). If Auto,
+                a DRMAA-compatible parallel task scheduler), HybridRunner (for
+                running simulations both locally and through a DRMAA-compatible
+                task scheduler). If Auto,
                 automatically pick the best available runner (GridRunner if
                 DRMAA is available, ParallelRunner otherwise).
             optimized (bool): whether to configure the runner to employ an
                 optimized ns-3 build.
             skip_configuration (bool): whether to skip the configuration step,
                 and only perform compilation.
+            runner_kwargs: additional keyword arguments to pass to the
+                SimulationRunner constructor.
         """
         # locals() contains a dictionary pairing class names with class
         # objects: we can create the object using the desired class starting
@@ -261,7 +405,28 @@ class CampaignManager(object):
                             globals().get(runner_type))(
                                 ns_path, script, optimized=optimized,
                                 skip_configuration=skip_configuration,
-                                max_parallel_processes=max_parallel_processes)
+                                max_parallel_processes=max_parallel_processes,
+                                **runner_kwargs)
+
+    def set_runner_type(self, runner_type, **runner_kwargs):
+        """
+        Replace the campaign's runner with one of a different type, reusing the
+        ns-3 build and settings of the current runner.
+
+        Args:
+            runner_type (str): implementation of the SimulationRunner to use
+                (e.g., SimulationRunner, ParallelRunner or LptRunner).
+            runner_kwargs: additional keyword arguments to pass to the
+                SimulationRunner constructor.
+        """
+        if self.runner is None:
+            raise Exception("No runner available: load the campaign "
+                            "specifying an ns-3 installation first")
+        runner_class = globals().get(runner_type)
+        if not (isinstance(runner_class, type) and
+                issubclass(runner_class, SimulationRunner)):
+            raise ValueError("Unknown runner type: %s" % runner_type)
+        self.runner = runner_class.from_runner(self.runner, **runner_kwargs)
 
     def check_and_fill_parameters(self, param_list, needs_rngrun):
         # Check all parameter combinations fully specify the desired simulation
@@ -290,7 +455,8 @@ class CampaignManager(object):
     # Simulation running #
     ######################
 
-    def run_simulations(self, param_list, show_progress=True, callbacks: list = [], stop_on_errors=True):
+    def run_simulations(self, param_list, show_progress=True, callbacks: list = [], stop_on_errors=True,
+                        result_parsing_functions=None):
         """
         Run several simulations specified by a list of parameter combinations.
 
@@ -309,6 +475,10 @@ class CampaignManager(object):
                 triggered during the run.
             stop_on_errors (bool): whether or not to stop the execution of the simulations 
                 if an error occurs.
+            result_parsing_functions (list): result parsing functions to run
+                on each result as soon as its simulation is over. Outputs are
+                stored in the result's meta, and are then used by the
+                get_results_as_* methods instead of parsing the result again.
         """
 
         # Make sure we have a runner to run simulations with.
@@ -329,9 +499,25 @@ class CampaignManager(object):
         if self.check_repo:
             self.check_repo_ok()
 
-        # Build ns-3 before running any simulations
-        # At this point, we can assume the project was already configured
-        self.runner.configure_and_build(skip_configuration=True)
+        # Build ns-3 before running any simulations, unless nothing changed
+        # since the last build. At this point, we can assume the project was
+        # already configured.
+        source_status = self.runner.get_source_status()
+        build_fingerprint = self.runner.get_build_fingerprint(source_status)
+        if (build_fingerprint is None or
+                build_fingerprint != self.db.get_build_fingerprint()):
+            self.runner.configure_and_build(skip_configuration=True)
+            # Building only changes the script executable
+            self.db.set_build_fingerprint(
+                self.runner.get_build_fingerprint(source_status))
+
+        # Record which output files are kept, for analysis code
+        if self.runner.retention_policy != self.db.get_retention_policy():
+            self.db.set_retention_policy(self.runner.retention_policy)
+
+        # Let the runner predict the behavior of simulations from the
+        # previous runs of this campaign
+        self.runner.set_run_statistics(self.db.get_results())
 
         # Shuffle simulations
         # This mixes up long and short simulations, and gives better time
@@ -355,9 +541,11 @@ class CampaignManager(object):
         else:
             result_generator = results
 
-        self.run_and_save_results(result_generator)
+        self.run_and_save_results(result_generator,
+                                  result_parsing_functions=result_parsing_functions)
 
-    def run_and_save_results(self, result_generator, batch_results=True):
+    def run_and_save_results(self, result_generator, batch_results=True,
+                             result_parsing_functions=None):
         # Insert result object in db. Using the generator here ensures we
         # save results as they are finalized by the SimulationRunner, and
         # that they are kept even if execution is terminated abruptly by
@@ -365,25 +553,85 @@ class CampaignManager(object):
         results_batch = []
         last_save_time = datetime.now()
 
-        for result in result_generator:
-
-            results_batch += [result]
-
-            # Save results to disk once every 60 seconds
-            if not batch_results:
-                self.db.insert_results(results_batch)
-                results_batch = []
-            elif (batch_results and
-                  (datetime.now() - last_save_time).total_seconds() > 60):
-                self.db.insert_results(results_batch)
-                self.db.write_to_disk()
-                results_batch = []
-                last_save_time = datetime.now()
+        # If parsing functions are specified, each result is parsed in a
+        # separate process as soon as it is available, while simulations keep
+        # running. Results are saved without waiting for their parsing, and
+        # their outputs are added once it is over.
+        parsing = []
+        pool = None
+        if result_parsing_functions:
+            # Functions need to be sent to the parsing processes
+            picklable_functions = []
+            for function in result_parsing_functions:
+                try:
+                    pickle.dumps(function)
+                    picklable_functions.append(function)
+                except (pickle.PicklingError, AttributeError, TypeError):
+                    warnings.warn("Function %s cannot be sent to a separate "
+                                  "process, so it will not be run on results "
+                                  "as they are completed" % function)
+            result_parsing_functions = picklable_functions
+        if result_parsing_functions:
+            pool = Pool(processes=self.runner.max_parallel_processes)
+
+        try:
+            for result in result_generator:
+
+                results_batch += [result]
+                if pool is not None:
+                    result_data_dir = os.path.join(self.db.get_data_dir(),
+                                                   result['meta']['id'])
+                    parsing.append([result, pool.apply_async(
+                        parse_completed_result,
+                        [[result, result_data_dir, result_parsing_functions]])])
+
+                # Save results to disk once every 60 seconds
+                if not batch_results:
+                    self.db.insert_results(results_batch)
+                    results_batch = []
+                elif (batch_results and
+                      (datetime.now() - last_save_time).total_seconds() > 60):
+                    self.db.insert_results(results_batch)
+                    self.db.write_to_disk()
+                    results_batch = []
+                    last_save_time = datetime.now()
+
+                self.save_parsed_outputs(collect_parsed_results(parsing),
+                                         results_batch)
+
+            self.save_parsed_outputs(collect_parsed_results(parsing,
+                                                            wait=True),
+                                     results_batch)
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                # If execution was interrupted, results that were still being
+                # parsed are saved without their outputs
+                if parsing:
+                    self.db.insert_results(results_batch)
+                    self.db.write_to_disk()
 
         self.db.insert_results(results_batch)
         self.db.write_to_disk()
 
-    def get_missing_simulations(self, param_list, runs=None, with_time_estimate=False):
+    def save_parsed_outputs(self, results, unsaved_results):
+        """
+        Save the parsed outputs of results whose parsing is over.
+
+        Args:
+            results (list): results with their outputs in the parsed meta
+                entry, as returned by collect_parsed_results.
+            unsaved_results (list): results that were not inserted in the
+                database yet, and that will be saved with their outputs.
+        """
+        for result in results:
+            if ('parsed' in result['meta'] and
+                    not any(result is r for r in unsaved_results)):
+                self.db.update_result_meta(result)
+
+    def get_missing_simulations(self, param_list, runs=None, with_time_estimate=False,
+                                in_progress=None):
         """
         Return a list of the simulations among the required ones that are not
         available in the database.
@@ -395,6 +643,9 @@ class CampaignManager(object):
                 for each parameter combination, None if the dictionaries in
                 param_list already feature the desired RngRun value.
             with_time_estimate (bool): a boolean representing ...
+            in_progress (list): parameter combinations, including RngRun, of
+                simulations that are currently running and should thus be
+                considered as available.
         """
 
         params_to_simulate = []
@@ -405,9 +656,14 @@ class CampaignManager(object):
         else:
             self.check_and_fill_parameters (param_list, needs_rngrun=False)
 
+        if in_progress is None:
+            in_progress = []
+
         if runs is not None:  # Get next available runs from the database
-            next_runs = self.db.get_next_rngruns()
+            next_runs = self.db.get_next_rngruns(
+                [p['RngRun'] for p in in_progress])
             available_results = [r for r in self.db.get_results()]
+            available_results += [{'params': p} for p in in_progress]
             for param_comb in param_list:
                 # Count how many param combinations we found, and remove them
                 # from the list of available_results for faster searching in the
@@ -419,7 +675,7 @@ class CampaignManager(object):
                     if param_comb == {k: r['params'][k] for k in
                                       r['params'].keys() if k != "RngRun"}:
                         needed_runs -= 1
-                        if with_time_estimate:
+                        if with_time_estimate and 'meta' in r:
                             time_prediction = float(r['meta']['elapsed_time'])
                 new_param_combs = []
                 for needed_run in range(needed_runs):
@@ -438,7 +694,7 @@ class CampaignManager(object):
         else:
             for param_comb in param_list:
                 previous_results = self.db.get_results(param_comb)
-                if not previous_results:
+                if not previous_results and param_comb not in in_progress:
                     if with_time_estimate:
                         # Try and find results with different RngRun to provide
                         # a time prediction
@@ -458,7 +714,14 @@ class CampaignManager(object):
     def run_missing_simulations(self, param_list, runs=None,
                                 condition_checking_function=None,
                                 callbacks=[],
-                                stop_on_errors=True):
+                                stop_on_errors=True,
+                                budget=None,
+                                metric_function=None,
+                                maximize=True,
+                                result_parsing_functions=None,
+                                shared=False,
+                                claim_batch_size=None,
+                                stale_claim_timeout=600):
         """
         Run the simulations from the parameter list that are not yet available
         in the database.
@@ -470,29 +733,103 @@ class CampaignManager(object):
         parameter combinations or a dictionary containing multiple values for
         each parameter, to be expanded into a list.
 
+        If a budget is specified, this function instead runs budget new
+        simulations in total, and allocates them to the parameter combinations
+        following the Optimal Computing Budget Allocation (OCBA) procedure:
+        more runs are spent on the combinations for which the ranking given by
+        metric_function is still uncertain.
+
         Args:
             param_list (list, dict): either a list of parameter combinations or
                 a dictionary to be expanded into a list through the
                 list_param_combinations function.
             runs (int): the number of runs to perform for each parameter
                 combination. This parameter is only allowed if the param_list
-                specification doesn't feature an 'RngRun' key already.
+                specification doesn't feature an 'RngRun' key already. If a
+                budget is specified, this is the minimum number of runs each
+                combination receives before OCBA starts (at least 2).
             callbacks (list): list of objects extending CallbackBase to be 
                 triggered during the run.
             stop_on_errors (bool): whether or not to stop the execution of the simulations 
                 if an error occurs.
+            budget (int): total number of new simulations to run, allocated
+                using OCBA.
+            metric_function (function): function taking a complete result as
+                input and returning the scalar metric used to rank parameter
+                combinations. Required if budget is specified.
+            maximize (bool): whether the best parameter combination is the one
+                with the highest (True) or lowest (False) metric.
+            result_parsing_functions (list): result parsing functions to run
+                on each result as soon as its simulation is over, in parallel
+                with the simulations that are still running. Their outputs are
+                stored alongside the result, and are used by the
+                get_results_as_* methods instead of parsing the result again.
+            shared (bool): whether other hosts mounting the same campaign
+                directory may be running this same function at the same time.
+                In this case, hosts claim batches of missing simulations, so
+                that each simulation is only run once, and save their results
+                in per-host journals. To scale out a sweep, it's thus enough
+                to run the same script on multiple hosts.
+            claim_batch_size (int): number of simulations to claim at a time
+                in shared mode. Defaults to the maximum number of parallel
+                processes of the runner.
+            stale_claim_timeout (float): seconds after which the claims of a
+                host that stopped refreshing them (e.g., because it crashed)
+                can be taken over by other hosts, in shared mode.
         """
         # Expand the parameter specification
         param_list = list_param_combinations(param_list)
 
+        if shared:
+            if budget is not None or condition_checking_function is not None:
+                raise ValueError("Shared campaigns only support a fixed "
+                                 "number of runs")
+            self.run_shared_simulations(param_list, runs, callbacks,
+                                        stop_on_errors, claim_batch_size,
+                                        stale_claim_timeout,
+                                        result_parsing_functions)
+            return
+
+        if budget is not None:
+            if metric_function is None:
+                raise ValueError("A metric_function is needed to allocate a"
+                                 " simulation budget")
+
+            # Metric values are computed only once per result
+            metrics = {}
+
+            def get_samples(params):
+                samples = []
+                for r in self.db.get_results(params):
+                    if r['meta']['id'] not in metrics:
+                        complete_result = self.db.get_complete_results(
+                            result_id=r['meta']['id'])[0]
+                        metrics[r['meta']['id']] = metric_function(complete_result)
+                    samples.append(metrics[r['meta']['id']])
+                return samples
+
+            cr = ConditionalRunner.from_runner(self.runner)
+            cr.budget = budget
+            cr.samples_function = get_samples
+            cr.initial_runs = max(runs, 2) if runs is not None else 2
+            cr.maximize = maximize
+            cr.next_runs = self.db.get_next_rngruns()
+
+            # Fill up a possibly impartial parameter definition with defaults
+            self.check_and_fill_parameters(param_list, needs_rngrun=False)
+
+            self.run_and_save_results(cr.run_simulations(param_list,
+                                                         self.db.get_data_dir(),
+                                                         stop_on_errors=stop_on_errors),
+                                      batch_results=False,
+                                      result_parsing_functions=result_parsing_functions)
+            return
+
         # In this case, we need to run simulations in batches
         if runs is None and condition_checking_function:
             next_runs = self.db.get_next_rngruns()
             # Create a ConditionalRunner
-            cr = ConditionalRunner(self.runner.path,
-                                   self.runner.script,
-                                   self.runner.optimized,
-                                   max_parallel_processes=self.runner.max_parallel_processes)
+            cr = ConditionalRunner.from_runner(self.runner)
             # Set up the runner's stopping condition function
             cr.stopping_function = lambda x: condition_checking_function(self, x)
             # Set up the runner's iterator for next runs
@@ -504,7 +841,8 @@ class CampaignManager(object):
             self.run_and_save_results(cr.run_simulations(param_list,
                                                          self.db.get_data_dir(),
                                                          stop_on_errors=stop_on_errors),
-                                      batch_results=False)
+                                      batch_results=False,
+                                      result_parsing_functions=result_parsing_functions)
 
         # Otherwise, we just run all required runs for each combination
         if condition_checking_function is None:
@@ -515,12 +853,96 @@ class CampaignManager(object):
                                                  runs,
                                                  with_time_estimate=True),
                     callbacks=callbacks,
-                    stop_on_errors=stop_on_errors)
+                    stop_on_errors=stop_on_errors,
+                    result_parsing_functions=result_parsing_functions)
             else:
                 self.run_simulations(
                     self.get_missing_simulations(param_list, runs),
                     callbacks=callbacks,
-                    stop_on_errors=stop_on_errors)
+                    stop_on_errors=stop_on_errors,
+                    result_parsing_functions=result_parsing_functions)
+
+    def run_shared_simulations(self, param_list, runs=None, callbacks=[],
+                               stop_on_errors=True, claim_batch_size=None,
+                               stale_claim_timeout=600,
+                               result_parsing_functions=None):
+        """
+        Run the missing simulations from the parameter list, cooperating with
+        other hosts doing the same on this campaign directory.
+
+        Missing simulations are claimed in batches through claim files in the
+        campaign directory, and results are saved in a journal specific to
+        this host. Claims are refreshed while simulations run: if a host
+        dies, its claims become stale and are taken over by the other hosts.
+        This function only returns once all the required simulations are
+        available.
+
+        See run_missing_simulations for a description of the arguments.
+        """
+        self.db.enable_journal()
+        if claim_batch_size is None:
+            claim_batch_size = (self.runner.max_parallel_processes or
+                                os.cpu_count())
+        with_time_estimate = isinstance(self.runner, LptRunner)
+        poll_interval = min(stale_claim_timeout / 10, 10)
+
+        def strip_rngrun(params):
+            return {k: v for k, v in params.items() if k != 'RngRun'}
+
+        while True:
+            # Include the results saved by other hosts in the meantime. Hosts
+            # save results before releasing their claims: reading the claims
+            # first guarantees that simulations that are neither claimed nor
+            # merged are actually missing
+            claimed = self.db.get_claimed_simulations(stale_claim_timeout)
+            self.db.merge_journals()
+            missing = self.get_missing_simulations(param_list, runs,
+                                                   with_time_estimate,
+                                                   in_progress=claimed)
+
+            batch = []
+            for simulation in missing:
+                params = simulation[0] if with_time_estimate else simulation
+                if self.db.claim_simulation(params, stale_claim_timeout):
+                    batch.append(simulation)
+                if len(batch) == claim_batch_size:
+                    break
+
+            if not batch:
+                if missing:
+                    # Other hosts claimed these simulations first
+                    time.sleep(poll_interval)
+                    continue
+                # Wait for other hosts to complete the simulations they
+                # claimed, or for their claims to become stale
+                if runs is not None:
+                    pending = [c for c in claimed if strip_rngrun(c) in
+                               param_list]
+                else:
+                    pending = [c for c in claimed if c in param_list]
+                if not pending:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            # Refresh claims while simulations are running
+            batch_params = [s[0] if with_time_estimate else s for s in batch]
+            done = threading.Event()
+
+            def refresh_claims():
+                while not done.wait(stale_claim_timeout / 4):
+                    self.db.refresh_claims(batch_params)
+
+            refresher = threading.Thread(target=refresh_claims, daemon=True)
+            refresher.start()
+            try:
+                self.run_simulations(
+                    batch, callbacks=callbacks, stop_on_errors=stop_on_errors,
+                    result_parsing_functions=result_parsing_functions)
+            finally:
+                done.set()
+                refresher.join()
+                self.db.release_claims(batch_params)
 
     #####################
     # Result management #
@@ -584,30 +1006,56 @@ class CampaignManager(object):
 
         data = []
 
+        # Results that were parsed while running simulations, or by previous
+        # calls of this function, don't need to be parsed again
+        identity = get_parser_identity(result_parsing_function)
+        cache_key = get_parse_cache_key(identity, files_to_load)
+        cached_outputs = self.db.load_parse_cache(cache_key)
+        outputs = {}
+        results_to_parse = []
+        for result in results_list:
+            result_id = result['meta']['id']
+            stored_output = get_stored_output(result, cache_key)
+            if stored_output:
+                outputs[result_id] = stored_output[0]
+            elif result_id in cached_outputs:
+                outputs[result_id] = cached_outputs[result_id]
+            else:
+                results_to_parse.append(result)
+
+        arguments = ([self.db.get_complete_results(result_id=result['meta']['id'],
+                                                   files_to_load=files_to_load)[0],
+                      result_parsing_function,
+                      function_yields_multiple_results] for result in results_to_parse)
         if parallel_parsing:
             with Pool(processes=self.runner.max_parallel_processes) as pool:
-                for parsed_result in tqdm(pool.imap_unordered(parse_result,
-                                                              ([self.db.get_complete_results(result_id=result['meta']['id'],
-                                                                                             files_to_load=files_to_load)[0],
-                                                                function_yields_multiple_results,
-                                                                result_parsing_function,
-                                                                param_columns] for result in results_list)),
-                                          total=len(results_list),
-                                          unit='result',
-                                          desc='Parsing Results',
-                                          disable=not verbose):
-                    data += parsed_result
+                for result, output in zip(results_to_parse,
+                                          tqdm(pool.imap(run_parsing_function,
+                                                         arguments),
+                                               total=len(results_to_parse),
+                                               unit='result',
+                                               desc='Parsing Results',
+                                               disable=not verbose)):
+                    outputs[result['meta']['id']] = output
         else:
-            for parsed_result in tqdm((parse_result([self.db.get_complete_results(result_id=result['meta']['id'],
-                                                                                  files_to_load=files_to_load)[0],
-                                                     function_yields_multiple_results,
-                                                     result_parsing_function,
-                                                     param_columns]) for result in results_list),
-                                      total=len(results_list),
-                                      unit='result',
-                                      desc='Parsing Results',
-                                      disable=not verbose):
-                data += parsed_result
+            for result, output in zip(results_to_parse,
+                                      tqdm(map(run_parsing_function, arguments),
+                                           total=len(results_to_parse),
+                                           unit='result',
+                                           desc='Parsing Results',
+                                           disable=not verbose)):
+                outputs[result['meta']['id']] = output
+
+        if results_to_parse:
+            cached_outputs.update({result['meta']['id']:
+                                   outputs[result['meta']['id']] for result in
+                                   results_to_parse})
+            self.db.save_parse_cache(cache_key, cached_outputs)
+
+        for result in results_list:
+            data += format_parsed_result(result, outputs[result['meta']['id']],
+                                         function_yields_multiple_results,
+                                         param_columns)
 
         if param_columns == 'all':
             param_columns = list(self.db.get_results()[0]['params'].keys())
@@ -639,11 +1087,8 @@ class CampaignManager(object):
             runs (int): number of runs to gather for each parameter
                 combination.
         """
-        data = self.get_space(
-            self.db.get_results(), {},
-            collections.OrderedDict([(k, v) for k, v in
-                                     parameter_space.items()]),
-            result_parsing_function, runs, extract_complete_results)
+        data = self.get_cached_space(parameter_space, result_parsing_function,
+                                     runs, extract_complete_results)
         return np.array(data)
 
     def save_to_mat_file(self, parameter_space,
@@ -769,11 +1214,8 @@ class CampaignManager(object):
         if isinstance(output_labels, list):
             clean_parameter_space['metrics'] = output_labels
 
-        data = self.get_space(
-            self.db.get_results(), {},
-            collections.OrderedDict([(k, v) for k, v in
-                                     parameter_space.items()]),
-            result_parsing_function, runs)
+        data = self.get_cached_space(parameter_space, result_parsing_function,
+                                     runs)
         xr_array = xr.DataArray(data, coords=clean_parameter_space,
                                 dims=list(clean_parameter_space.keys()))
 
@@ -786,10 +1228,36 @@ class CampaignManager(object):
         """
         return result['output']
 
+    def get_cached_space(self, parameter_space, result_parsing_function,
+                         runs=None, extract_complete_results=True):
+        """
+        Return the output of get_space on all the results of the campaign,
+        reusing and updating the outputs saved in the campaign's parse cache.
+        """
+        cache_key = None
+        if result_parsing_function is not None:
+            cache_key = get_parse_cache_key(
+                get_parser_identity(result_parsing_function),
+                extract_complete_results=extract_complete_results)
+        parse_cache = self.db.load_parse_cache(cache_key)
+        cached_outputs = len(parse_cache)
+
+        data = self.get_space(
+            self.db.get_results(), {},
+            collections.OrderedDict([(k, v) for k, v in
+                                     parameter_space.items()]),
+            result_parsing_function, runs, extract_complete_results,
+            parse_cache if cache_key is not None else None)
+
+        if len(parse_cache) > cached_outputs:
+            self.db.save_parse_cache(cache_key, parse_cache)
+        return data
+
     def get_space(self, current_result_list, current_query, param_space,
                   result_parsing_function,
                   runs=None,
-                  extract_complete_results=True):
+                  extract_complete_results=True,
+                  parse_cache=None):
         """
         Convert a parameter space specification to a nested array structure
         representing the space. In other words, if the parameter space is::
@@ -824,6 +1292,9 @@ class CampaignManager(object):
                 metrics.
             runs (int): the number of runs to query for each parameter
                 combination.
+            parse_cache (dict): outputs of result_parsing_function computed
+                previously, indexed by result id. Newly computed outputs are
+                added to it.
         """
         if result_parsing_function is None:
             result_parsing_function = CampaignManager.files_in_dictionary
@@ -834,8 +1305,23 @@ class CampaignManager(object):
             results = [r for r in current_result_list if
                        self.satisfies_query(r, current_query)]
             parsed = []
+            # Outputs computed while running simulations are only valid if
+            # the function received the contents of all output files
+            stored_key = None
+            if extract_complete_results:
+                stored_key = get_parse_cache_key(
+                    get_parser_identity(result_parsing_function))
             for r in results[:runs]:
 
+                # Use the output computed while running simulations, if any
+                stored_output = get_stored_output(r, stored_key)
+                if stored_output:
+                    parsed.append(stored_output[0])
+                    continue
+                if parse_cache is not None and r['meta']['id'] in parse_cache:
+                    parsed.append(parse_cache[r['meta']['id']])
+                    continue
+
                 # Make results complete, by reading the output from file
                 # TODO Extract this into a function
                 r['output'] = {}
@@ -846,7 +1332,10 @@ class CampaignManager(object):
                             r['output'][name] = file_contents.read()
                     else:
                         r['output'][name] = filepath
-                parsed.append(result_parsing_function(r))
+                output = result_parsing_function(r)
+                if parse_cache is not None:
+                    parse_cache[r['meta']['id']] = output
+                parsed.append(output)
                 del r
             del results
 
@@ -870,7 +1359,8 @@ class CampaignManager(object):
             space.append(self.get_space(temp_result_list, next_query,
                                         next_param_space,
                                         result_parsing_function, runs,
-                                        extract_complete_results))
+                                        extract_complete_results,
+                                        parse_cache))
         return space
 
     def satisfies_query(self, result, query):
@@ -899,7 +1389,8 @@ class CampaignManager(object):
         """
         Make sure that the ns-3 repository's HEAD commit is the same as the one
         saved in the campaign database, and that the ns-3 repository is clean
-        (i.e., no untracked or modified files exist).
+        (i.e., no untracked or modified files exist, possibly limited to the
+        paths in repo_check_paths).
         """
         from git import Repo, exc
         # Check that git is at the expected commit and that the repo is not
@@ -916,7 +1407,7 @@ class CampaignManager(object):
             current_commit = repo.head.commit.hexsha
             campaign_commit = self.db.get_commit()
 
-            if repo.is_dirty(untracked_files=True):
+            if is_repo_dirty(repo, self.repo_check_paths):
                 raise Exception("ns-3 repository is not clean")
 
             if current_commit != campaign_commit:
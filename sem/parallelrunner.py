@@ -1,7 +1,14 @@
 from .runner import SimulationRunner
-from .utils import CallbackBase
-from multiprocessing.pool import ThreadPool as Pool
-# We use ThreadPool to share the process memory among the different simulations to enable the use of callbacks.
+from .utils import (CallbackBase, get_available_memory, get_process_rss,
+                    get_total_memory)
+from collections import deque
+import itertools
+import os
+import queue
+import shutil
+import threading
+import time
+# We use threads to share the process memory among the different simulations to enable the use of callbacks.
 # This may be improved eventually using a grain-fined solution that checks the presence or not of callbacks
 
 class ParallelRunner(SimulationRunner):
@@ -12,46 +19,535 @@ class ParallelRunner(SimulationRunner):
     data_folder: str = None
     stop_on_errors: bool = False
     callbacks: [CallbackBase] = []
+    # Set once run_simulations doesn't need more results
+    finished: threading.Event = None
+
+    settings: [str] = ['memory_aware', 'adaptive_parallelism',
+                       'speculative_factor']
+
+    # Fraction of the available memory that is never committed to simulations
+    memory_margin: float = 0.1
+
+    # Target duration, in seconds, of the batches of simulations each thread
+    # takes at once
+    batch_duration: float = 0.5
+
+    # Seconds between adjustments of the number of simulations running at the
+    # same time, if adaptive_parallelism is True
+    adaptation_interval: float = 30
+
+    # Relative decrease in throughput that reverts the last adjustment of the
+    # number of simulations running at the same time
+    throughput_tolerance: float = 0.05
+
+    # Seconds between checks for simulations to speculatively run again, if
+    # speculative_factor is not None
+    speculation_interval: float = 1
+
+    def __init__(self, path, script, optimized=True, skip_configuration=False,
+                 max_parallel_processes=None, memory_aware=False,
+                 adaptive_parallelism=False, speculative_factor=None,
+                 **kwargs):
+        """
+        Initialization function.
+
+        Args:
+            memory_aware (bool): whether to only start a new simulation when
+                the memory available on this machine is enough to accommodate
+                its predicted peak memory usage. Predictions are based on the
+                peak memory of previous runs of the same parameter
+                combination, which does not include the memory used by this
+                process (see SimulationRunner.wait_for_process).
+            adaptive_parallelism (bool): whether to periodically adjust the
+                number of simulations running at the same time, up to
+                max_parallel_processes, so as to maximize the amount of work
+                completed per second. The number of simulations is also
+                reduced when other processes load the CPUs of this machine,
+                or when its available memory runs low.
+            speculative_factor (float): if not None, once all simulations
+                were started, idle threads run a copy of the simulations that
+                have been running for longer than speculative_factor times
+                their predicted running time. The result of the copy that
+                finishes first is kept, and the other copy is killed. Since
+                simulations with the same RngRun are deterministic, both
+                copies produce the same output.
+
+        See SimulationRunner for the remaining arguments.
+        """
+        SimulationRunner.__init__(self, path, script, optimized,
+                                  skip_configuration, max_parallel_processes,
+                                  **kwargs)
+        self.memory_aware = memory_aware
+        self.admission = threading.Condition()
+        # Predicted peak memory of the admitted simulations, indexed by the
+        # thread running them
+        self.reservations = {}
+
+        self.adaptive_parallelism = adaptive_parallelism
+        # Number of simulations that can currently run at the same time, and
+        # that are running, if adaptive_parallelism is True
+        self.parallelism = None
+        self.active = 0
+        self.slots = threading.Condition()
+        # Predicted running time of the simulations completed so far
+        self.completed_work = 0
+
+        self.speculative_factor = speculative_factor
+        # Simulations that have a speculative copy, indexed by their id, with
+        # the thread running the copy and whether either copy finished
+        self.speculations = {}
+        self.speculation_lock = threading.Lock()
 
     def run_simulations(self, parameter_list, data_folder, callbacks: [CallbackBase] = None, stop_on_errors=False):
         """
         This function runs multiple simulations in parallel.
 
+        Each thread takes a batch of simulations at a time, and runs them one
+        after the other. Batches are sized so that they take about
+        batch_duration seconds, based on the running time of the simulations
+        completed so far, which limits the overhead of dispatching very short
+        simulations. Results are still yielded as soon as each simulation is
+        completed.
+
         Args:
             parameter_list (list): list of parameter combinations to simulate.
             data_folder (str): folder in which to create output folders.
             callbacks (list): list of callbacks to be triggered
             stop_on_errors (bool): check whether simulation has to stop on errors or not
         """
-        
+        parameter_list = list(parameter_list)
+
         if callbacks is not None:
             for cb in callbacks:
-                cb.on_simulation_start(len(list(enumerate(parameter_list))))
+                cb.on_simulation_start(len(parameter_list))
                 cb.controlled_by_parent = True
 
         self.data_folder = data_folder
         self.stop_on_errors = stop_on_errors
         self.callbacks = callbacks
-        with Pool(processes=self.max_parallel_processes) as pool:
-            for result in pool.imap_unordered(self.launch_simulation,
-                                              parameter_list):
+
+        pending = deque(parameter_list)
+        results = queue.Queue()
+        lock = threading.Lock()
+        # Number and total wall-clock time of the simulations completed so
+        # far, including the time spent setting them up
+        state = {'completed': 0, 'time': 0}
+        processes = self.max_parallel_processes or os.cpu_count()
+        finished = threading.Event()
+        self.finished = finished
+        self.speculations = {}
+
+        def run_batches():
+            while True:
+                with lock:
+                    batch = [pending.popleft() for _ in
+                             range(min(len(pending),
+                                       self.get_batch_size(pending,
+                                                           processes,
+                                                           state)))]
+                if not batch:
+                    if self.speculative_factor is None or finished.is_set():
+                        return
+                    # Use the idle thread to run a copy of a straggler
+                    straggler = self.find_straggler()
+                    if straggler is None:
+                        finished.wait(self.speculation_interval)
+                        continue
+                    original, parameter = straggler
+                    try:
+                        self.launch_batch([parameter], results, original)
+                    except Exception as e:
+                        results.put(e)
+                        return
+                    continue
+                start = time.time()
+                try:
+                    self.launch_batch(batch, results)
+                except Exception as e:
+                    results.put(e)
+                    return
+                finally:
+                    with lock:
+                        state['completed'] += len(batch)
+                        state['time'] += time.time() - start
+
+        # Threads left without simulations to start are only useful to run
+        # speculative copies
+        threads = [threading.Thread(target=run_batches, daemon=True) for _ in
+                   range(processes if self.speculative_factor is not None
+                         else min(processes, len(parameter_list)))]
+
+        def adapt():
+            adaptation = {'parallelism': self.parallelism, 'direction': 1,
+                          'throughput': None}
+            last_work = self.completed_work
+            while not finished.wait(self.adaptation_interval):
+                throughput = ((self.completed_work - last_work) /
+                              self.adaptation_interval)
+                last_work = self.completed_work
+                self.adapt_parallelism(adaptation, throughput, processes)
+                with self.slots:
+                    self.parallelism = adaptation['parallelism']
+                    self.slots.notify_all()
+
+        if self.adaptive_parallelism:
+            self.parallelism = self.get_parallelism_cap(processes)
+            threads.append(threading.Thread(target=adapt, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            for _ in parameter_list:
+                result = results.get()
+                if isinstance(result, Exception):
+                    raise result
+                # Output files may still be moving from the scratch folder,
+                # while the thread already runs the next simulation
+                self.wait_for_outputs(result)
                 yield result
+        finally:
+            # Simulations that were not started are not needed anymore, and
+            # neither are running ones if the caller stopped early
+            with lock:
+                pending.clear()
+            finished.set()
+            idents = set(thread.ident for thread in threads)
+            while any(thread.is_alive() for thread in threads):
+                for sim_uuid, simulation in list(self.running.items()):
+                    if simulation['thread'] in idents:
+                        self.cancel_simulation(sim_uuid)
+                for thread in threads:
+                    thread.join(0.1)
+
+            # Results that were not yielded are never saved
+            while True:
+                try:
+                    result = results.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(result, Exception):
+                    continue
+                self.wait_for_outputs(result)
+                shutil.rmtree(os.path.join(data_folder, result['meta']['id']),
+                              ignore_errors=True)
 
         if callbacks is not None:
             for cb in callbacks:
                 cb.on_simulation_end()
 
+    def get_batch_size(self, pending, processes, state):
+        """
+        Return how many of the pending simulations a thread should take at
+        once.
+
+        Simulations are taken until their predicted running times add up to
+        batch_duration seconds. Running times are predicted from the previous
+        runs of the same parameter combination or, for combinations that
+        were never run, from the average time the simulations completed so
+        far took. Simulations whose running time is unknown or longer than
+        batch_duration are thus taken one at a time. Batches never contain
+        more than half of the share of the remaining simulations of each
+        thread, so that all threads finish at about the same time.
+
+        Args:
+            pending (deque): the simulations that were not started yet, in
+                the order they are taken.
+            processes (int): number of threads running simulations.
+            state (dict): number of simulations completed so far, in the
+                completed entry, and the time they took, in the time entry.
+        """
+        average = (state['time'] / state['completed'] if state['completed']
+                   and state['time'] else None)
+        size = 0
+        duration = 0
+        for parameter in itertools.islice(pending, max(
+                1, len(pending) // (2 * processes))):
+            predicted = self.predict(parameter, 'elapsed_time') or average
+            if predicted is None:
+                break
+            duration += predicted
+            if duration > self.batch_duration:
+                break
+            size += 1
+        return max(size, 1)
+
+    def launch_batch(self, batch, results, original=None):
+        """
+        Run a batch of simulations one after the other, using
+        SimulationRunner's facilities, and put each result in a queue as soon
+        as it is available.
+
+        If memory_aware is True, the batch is admitted as a whole, reserving
+        the predicted peak memory of its most demanding simulation.
+
+        Args:
+            batch (list): the parameter combinations to simulate.
+            results (Queue): the queue to put results in.
+            original (str): if not None, the id of the running simulation the
+                only one in the batch is a speculative copy of.
+        """
+        if self.memory_aware:
+            self.admit(max(batch, key=self.predict_peak_memory))
+        try:
+            build = self.get_executable_and_environment()
+            for parameter in batch:
+                if self.finished is not None and self.finished.is_set():
+                    # The rest of the batch is not needed anymore
+                    break
+                if not self.adaptive_parallelism:
+                    self.deliver_result(self.run_simulation(
+                        parameter, self.data_folder, callbacks=self.callbacks,
+                        stop_on_errors=self.stop_on_errors, build=build),
+                        results, original)
+                    continue
+                cost = self.predict_running_time(parameter)
+                self.acquire_slot()
+                try:
+                    self.deliver_result(self.run_simulation(
+                        parameter, self.data_folder, callbacks=self.callbacks,
+                        stop_on_errors=self.stop_on_errors, build=build),
+                        results, original)
+                finally:
+                    self.release_slot(cost)
+        finally:
+            if self.memory_aware:
+                self.release()
+
     def launch_simulation(self, parameter):
         """
         Launch a single simulation, using SimulationRunner's facilities.
 
-        This function is used by ParallelRunner's run_simulations to map
-        simulation running over the parameter list.
+        Args:
+            parameter (dict): the parameter combination to simulate.
+        """
+        if self.memory_aware:
+            self.admit(parameter)
+        try:
+            return self.run_simulation(parameter, self.data_folder,
+                                       callbacks=self.callbacks,
+                                       stop_on_errors=self.stop_on_errors)
+        finally:
+            if self.memory_aware:
+                self.release()
+
+    def find_straggler(self):
+        """
+        Return the id and parameter combination of the running simulation
+        that exceeded its predicted running time by the largest factor, if
+        that factor is larger than speculative_factor, and record that the
+        current thread runs a copy of it. Return None if no simulation needs
+        a copy.
+        """
+        now = time.time()
+        with self.speculation_lock:
+            copies = [s['thread'] for s in self.speculations.values()]
+            straggler = None
+            largest_factor = self.speculative_factor
+            for sim_uuid, simulation in list(self.running.items()):
+                if (sim_uuid in self.speculations or
+                        simulation['thread'] in copies):
+                    continue
+                predicted = self.predict(simulation['parameter'],
+                                         'elapsed_time')
+                if not predicted:
+                    continue
+                factor = (now - simulation['start']) / predicted
+                if factor > largest_factor:
+                    straggler = (sim_uuid, simulation['parameter'])
+                    largest_factor = factor
+            if straggler is not None:
+                self.speculations[straggler[0]] = {
+                    'thread': threading.get_ident(), 'finished': False}
+            return straggler
+
+    def deliver_result(self, result, results, original=None):
+        """
+        Put the result of a simulation in a queue, unless another copy of the
+        same simulation already finished, in which case it's discarded
+        together with its output files. If another copy is still running, it
+        is killed.
+
+        Args:
+            result (dict): the result of the simulation.
+            results (Queue): the queue to put results in.
+            original (str): if not None, the id of the simulation this one is
+                a speculative copy of.
+        """
+        with self.speculation_lock:
+            speculation = self.speculations.get(
+                original if original is not None else result['meta']['id'])
+            discard = speculation is not None and speculation['finished']
+            if speculation is not None and not discard:
+                speculation['finished'] = True
+                if original is not None:
+                    self.cancel_simulation(original)
+                else:
+                    for sim_uuid, simulation in list(self.running.items()):
+                        if simulation['thread'] == speculation['thread']:
+                            self.cancel_simulation(sim_uuid)
+
+        if discard:
+            self.wait_for_outputs(result)
+            shutil.rmtree(os.path.join(self.data_folder, result['meta']['id']),
+                          ignore_errors=True)
+        else:
+            results.put(result)
+
+    def acquire_slot(self):
+        """
+        Block until fewer simulations than the current parallelism are
+        running, and account for a new one.
+        """
+        with self.slots:
+            while self.active >= self.parallelism:
+                self.slots.wait()
+            self.active += 1
+
+    def release_slot(self, cost):
+        """
+        Account for the end of a simulation started after acquire_slot.
+
+        Args:
+            cost (float): the predicted running time of the simulation.
+        """
+        with self.slots:
+            self.active -= 1
+            self.completed_work += cost
+            self.slots.notify_all()
+
+    def predict_running_time(self, parameter):
+        """
+        Predict the running time of a simulation when it runs alone, which is
+        used to weigh completed simulations when measuring throughput.
+
+        Parameter combinations that were never run are assumed to take the
+        average of the known running times, or one second if none is known.
+
+        Args:
+            parameter (dict): the parameter combination to simulate.
+        """
+        predicted = self.predict(parameter, 'elapsed_time')
+        if predicted is None:
+            known = [s['elapsed_time'] for s in self.run_statistics.values()
+                     if s['elapsed_time'] is not None]
+            predicted = sum(known) / len(known) if known else 1
+        return predicted
+
+    def get_parallelism_cap(self, processes):
+        """
+        Return the maximum number of simulations that should run at the same
+        time, given the CPUs used by other processes on this machine.
+
+        The load due to other processes is estimated as the difference
+        between the 1-minute load average and the number of simulations this
+        runner is running.
+
+        Args:
+            processes (int): the maximum number of simulations this runner
+                can run at the same time.
+        """
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            return processes
+        external_load = max(load - self.active, 0)
+        # Runners asked to run more simulations than CPUs (e.g., because
+        # simulations are I/O-bound) may keep doing so
+        return max(1, min(processes, int(round(
+            max(processes, os.cpu_count()) - external_load))))
+
+    def adapt_parallelism(self, adaptation, throughput, processes):
+        """
+        Adjust the number of simulations to run at the same time, based on
+        the throughput measured during the last interval.
+
+        The number of simulations is changed by one at each interval, in the
+        same direction as the last change unless throughput decreased, in
+        which case the direction is reversed. It is always decreased when the
+        available memory is less than memory_margin of the total one, and
+        never exceeds the cap returned by get_parallelism_cap.
+
+        Args:
+            adaptation (dict): the current number of simulations, in the
+                parallelism entry, the direction of the last change and the
+                throughput measured in the previous interval. It is updated
+                in place.
+            throughput (float): the predicted running time of the simulations
+                completed during the last interval, per second.
+            processes (int): the maximum number of simulations this runner
+                can run at the same time.
+        """
+        available_memory = get_available_memory()
+        total_memory = get_total_memory()
+        if (available_memory is not None and total_memory is not None and
+                available_memory < total_memory * self.memory_margin):
+            adaptation['direction'] = -1
+        elif (adaptation['throughput'] is not None and throughput <
+              adaptation['throughput'] * (1 - self.throughput_tolerance)):
+            adaptation['direction'] = -adaptation['direction']
+
+        adaptation['parallelism'] = max(1, min(
+            adaptation['parallelism'] + adaptation['direction'],
+            self.get_parallelism_cap(processes)))
+        adaptation['throughput'] = throughput
+
+    def predict_peak_memory(self, parameter):
+        """
+        Predict the peak memory usage of a simulation, in kilobytes.
+
+        Parameter combinations that were never run are assumed to use as much
+        memory as the most demanding combination seen so far. Runs whose peak
+        memory is unknown, because they never used more memory than this
+        process, are ignored.
 
         Args:
             parameter (dict): the parameter combination to simulate.
         """
-        return next(SimulationRunner.run_simulations(self, [parameter],
-                                                     self.data_folder,
-                                                     callbacks=self.callbacks,
-                                                     stop_on_errors=self.stop_on_errors))
+        predicted = self.predict(parameter, 'max_rss')
+        if predicted is None:
+            known = [s['max_rss'] for s in self.run_statistics.values()
+                     if s['max_rss'] is not None]
+            predicted = max(known) if known else 0
+        return predicted
+
+    def admit(self, parameter):
+        """
+        Block until there is enough memory to run a simulation, and reserve
+        its predicted peak memory.
+
+        The memory that is still needed by the simulations that are running
+        is computed as the difference between their predicted peak and their
+        current memory usage. A simulation is always admitted if no other
+        simulation is running, or if the available memory cannot be read
+        from /proc/meminfo.
+
+        Args:
+            parameter (dict): the parameter combination to simulate.
+        """
+        predicted = self.predict_peak_memory(parameter)
+        with self.admission:
+            while self.reservations:
+                available = get_available_memory()
+                if available is None:
+                    break
+                pids = {r['thread']: r['pid'] for r in
+                        list(self.running.values())}
+                committed = sum(max(reserved -
+                                    (get_process_rss(pids[thread]) if
+                                     thread in pids else 0), 0)
+                                for thread, reserved in
+                                self.reservations.items())
+                if predicted + committed <= available * (1 - self.memory_margin):
+                    break
+                # Memory usage changes over time, so we check periodically
+                # even if no simulation finishes
+                self.admission.wait(timeout=1)
+            self.reservations[threading.get_ident()] = predicted
+
+    def release(self):
+        """
+        Release the memory reserved by the current thread with admit.
+        """
+        with self.admission:
+            del self.reservations[threading.get_ident()]
+            self.admission.notify_all()
@@ -0,0 +1,70 @@
+#!/bin/bash
+# Template for running the tasks of DRMAA bulk jobs. Each task is started in
+# a folder containing a runs file, where each line specifies the folder to
+# run a simulation from and its command, separated by a tab. Up to $1
+# simulations are run at the same time, and the exit code, start time and end
+# time of each of them are appended to the status file.
+#
+# If a staging folder ($2) and a node-local folder ($3) are specified, the
+# files listed in the staging folder are first copied to the node-local
+# folder, unless a validated copy is already there, and simulations run the
+# copy of the executable pointed to by SEM_EXECUTABLE.
+#
+# If a scratch folder ($4) is specified, simulations are run in a folder
+# inside it, and their output files are moved to their folder once they are
+# over.
+parallelism=${1:-1}
+staging_dir=$2
+stage_dir=$3
+scratch_dir=$4
+task_dir=$(pwd)
+
+stage() {
+    key=$(sha1sum < "$staging_dir/checksums" | cut -c1-40)
+    staged="$stage_dir/sem-$key"
+    if [ ! -d "$staged" ]; then
+        mkdir -p "$stage_dir" || return 1
+        temp_dir=$(mktemp -d "$stage_dir/.sem-XXXXXX") || return 1
+        while IFS=$'\t' read -r source destination; do
+            mkdir -p "$temp_dir/$(dirname "$destination")" &&
+                cp -p "$source" "$temp_dir/$destination" ||
+                { rm -rf "$temp_dir"; return 1; }
+        done < "$staging_dir/files"
+        (cd "$temp_dir" && sha1sum --quiet --check "$staging_dir/checksums") ||
+            { rm -rf "$temp_dir"; return 1; }
+        # Another task may have staged the same files in the meantime
+        mv -T "$temp_dir" "$staged" 2> /dev/null || rm -rf "$temp_dir"
+    fi
+    export SEM_EXECUTABLE="$staged/bin/$(basename "$SEM_EXECUTABLE")"
+    export LD_LIBRARY_PATH="$staged/lib"
+    export DYLD_LIBRARY_PATH="$staged/lib"
+}
+
+if [ -n "$stage_dir" ]; then
+    stage || echo "Could not stage the build in $stage_dir" >&2
+fi
+
+run() {
+    run_dir=$1
+    if [ -n "$scratch_dir" ]; then
+        mkdir -p "$scratch_dir" &&
+            run_dir=$(mktemp -d "$scratch_dir/sem-XXXXXX") || run_dir=$1
+    fi
+    start=$(date +%s.%N)
+    (cd "$run_dir" && eval "$2" > stdout 2> stderr)
+    status=$?
+    end=$(date +%s.%N)
+    if [ "$run_dir" != "$1" ]; then
+        find "$run_dir" -mindepth 1 -maxdepth 1 -exec mv -t "$1" {} + &&
+            rmdir "$run_dir"
+    fi
+    echo "$status $start $end $1" >> "$task_dir/status"
+}
+
+while IFS=$'\t' read -r directory command; do
+    while [ "$(jobs -rp | wc -l)" -ge "$parallelism" ]; do
+        wait -n
+    done
+    run "$directory" "$command" < /dev/null &
+done < runs
+wait
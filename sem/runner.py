@@ -1,17 +1,34 @@
+import glob
+import hashlib
 import importlib
+import multiprocessing
 import os
 import re
+import resource
+import shutil
+import signal
 import subprocess
+import tempfile
+import threading
 import time
 import uuid
+import warnings
 import sem.utils
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from importlib.machinery import SourceFileLoader
 import types
-from .utils import CallbackBase
+from .launcher import get_launcher, LaunchedProcess
+from .utils import (CallbackBase, get_combination_key, get_cached_value,
+                    set_cached_value, get_file_checksum,
+                    apply_retention_policy, RETENTION_POLICY_KEYS)
 
 from tqdm import tqdm
 
+# Number of threads moving output files from scratch folders to the campaign
+# directory
+OUTPUT_MOVERS = 4
+
 
 class SimulationRunner(object):
     """
@@ -19,12 +36,24 @@ class SimulationRunner(object):
     system.
     """
 
+    # Constructor arguments that from_runner copies from existing runners.
+    # Subclasses list the arguments they add, which are only copied between
+    # runners of that subclass.
+    settings: [str] = ['optimized', 'max_parallel_processes', 'timeout',
+                       'cpu_time_limit', 'memory_limit', 'pin_cpus',
+                       'script_executable', 'stage_dir', 'scratch_dir',
+                       'retention_policy', 'use_launcher']
+
     ##################
     # Initialization #
     ##################
 
     def __init__(self, path, script, optimized=True, skip_configuration=False,
-                 max_parallel_processes=None):
+                 max_parallel_processes=None, timeout=None,
+                 cpu_time_limit=None, memory_limit=None, pin_cpus=False,
+                 build_fingerprint=None, script_executable=None,
+                 stage_dir=None, scratch_dir=None, retention_policy=None,
+                 use_launcher=True):
         """
         Initialization function.
 
@@ -36,6 +65,46 @@ class SimulationRunner(object):
                 optimized profile.
             skip_configuration (bool): whether to skip the configuration step,
                 and only perform compilation.
+            timeout (float): maximum wall-clock time, in seconds, each
+                simulation is allowed to run for before being killed.
+            cpu_time_limit (int): maximum CPU time, in seconds, each
+                simulation is allowed to use.
+            memory_limit (int): maximum size, in bytes, of the address space
+                of each simulation.
+            pin_cpus (bool): whether to pin each simulation to a dedicated set
+                of CPUs, so that simulations running at the same time never
+                share a core.
+            build_fingerprint (str): fingerprint of the last build performed
+                on this ns-3 installation, as returned by
+                get_build_fingerprint. If the installation is still in the
+                same state, configuration and build are skipped.
+            script_executable (str): path of the already built executable of
+                the script. If specified, configuration and build are skipped
+                altogether.
+            stage_dir (str): if not None, node-local folder (e.g., /tmp or
+                /dev/shm) in which to copy the script executable and the ns-3
+                libraries before running simulations, so that each run does
+                not load them from a possibly shared ns-3 installation. Copies
+                are validated against the checksums of the originals, and
+                shared by all the runs on the same machine.
+            scratch_dir (str): if not None, node-local folder in which
+                simulations are run, instead of their folder in the campaign
+                directory. Output files are moved to the campaign directory
+                in the background once each simulation is over, so that
+                simulations do not write to a possibly shared file system
+                while they run.
+            retention_policy (dict): if not None, policy deciding which
+                output files of each simulation are kept, applied as soon as
+                the simulation is over. See sem.utils.RETENTION_POLICY_KEYS
+                for the available entries.
+            use_launcher (bool): whether to start simulations through a small
+                launcher process, started together with the runner, instead
+                of forking this process. This makes the time needed to start
+                simulations, and the peak memory they report, independent of
+                how much memory this process uses (e.g., because of the
+                results loaded by the user). If False, the peak memory of
+                simulations that never use more memory than this process is
+                not reported.
         """
 
         # Save member variables
@@ -43,6 +112,55 @@ class SimulationRunner(object):
         self.script = script
         self.optimized = optimized
         self.max_parallel_processes = max_parallel_processes
+        self.timeout = timeout
+        self.cpu_time_limit = cpu_time_limit
+        self.memory_limit = memory_limit
+        self.pin_cpus = pin_cpus
+        self.stage_dir = stage_dir
+        self.scratch_dir = scratch_dir
+
+        if retention_policy is not None:
+            unknown_entries = (set(retention_policy) -
+                               set(RETENTION_POLICY_KEYS))
+            if unknown_entries:
+                raise ValueError("Unknown retention policy entries: %s" %
+                                 sorted(unknown_entries))
+        self.retention_policy = retention_policy
+
+        # Start the launcher before large data structures are loaded
+        self.use_launcher = use_launcher
+        if use_launcher:
+            get_launcher()
+
+        # Executable and environment to use for the copy of the build in
+        # stage_dir, together with the state of the files they come from
+        self.staged_build = None
+        self.staging_lock = threading.Lock()
+
+        # Threads moving output files from scratch_dir to the campaign
+        # directory, and moves that are still in progress, indexed by the
+        # id of the simulation
+        self.output_movers = None
+        self.pending_outputs = {}
+        self.output_movers_lock = threading.Lock()
+
+        # Statistics about the runs of each parameter combination, used to
+        # predict the behavior of future simulations
+        self.run_statistics = {}
+
+        # Simulations that are currently running, indexed by their id, and
+        # lock held while reaping or killing their processes
+        self.running = {}
+        self.reaping_lock = threading.RLock()
+
+        # Pool of CPU sets that are not assigned to any running simulation.
+        # We use a multiprocessing queue so that the pool is also shared by
+        # runners executing simulations in separate processes.
+        self.cpu_slots = None
+        if pin_cpus:
+            self.cpu_slots = multiprocessing.Queue()
+            for cpus in self.get_cpu_sets():
+                self.cpu_slots.put(cpus)
 
         if optimized:
             # For old ns-3 installations, the library is in build, while for
@@ -61,38 +179,87 @@ class SimulationRunner(object):
             'LD_LIBRARY_PATH': library_path,
             'DYLD_LIBRARY_PATH': library_path}
 
-        # Configure and build ns-3
-        self.configure_and_build(path, optimized=optimized,
-                                 skip_configuration=skip_configuration)
+        # Configure and build ns-3, unless we know the build is up to date
+        if script_executable is not None:
+            self.script_executable = script_executable
+        elif not self.is_build_up_to_date(build_fingerprint):
+            self.configure_and_build(path, optimized=optimized,
+                                     skip_configuration=skip_configuration)
+            self.script_executable = self.find_script_executable()
+
+    @classmethod
+    def from_runner(cls, runner, **kwargs):
+        """
+        Create a runner of this class that uses the same ns-3 installation,
+        script and settings of an existing runner.
+
+        Since the existing runner already took care of building ns-3, the new
+        runner is ready to use immediately, which makes switching between
+        scheduling strategies inexpensive. The settings listed by the classes
+        both runners belong to are copied, and if both runners pin
+        simulations to CPUs, they share the pool of free CPU sets, so that
+        simulations they run at the same time never share a core.
 
+        Args:
+            runner (SimulationRunner): the runner to take the ns-3
+                installation and settings from.
+            kwargs: additional keyword arguments to pass to the constructor,
+                possibly overriding the settings of runner.
+        """
+        settings = {}
+        for runner_class in cls.__mro__:
+            if isinstance(runner, runner_class):
+                settings.update({name: getattr(runner, name) for name in
+                                 vars(runner_class).get('settings', [])})
+        settings.update(kwargs)
+        new_runner = cls(runner.path, runner.script, **settings)
+        new_runner.run_statistics = runner.run_statistics
+        if runner.cpu_slots is not None and new_runner.cpu_slots is not None:
+            new_runner.cpu_slots = runner.cpu_slots
+        return new_runner
+
+    def find_script_executable(self):
+        """
+        Return the path of the executable corresponding to this runner's
+        script, as listed in the ns-3 build status file.
+        """
         # ns-3's build status output is used to get the executable path for the
         # specified script.
         if os.path.exists(os.path.join(self.path, "ns3")):
             # In newer versions of ns-3 (3.36+), the name of the build status file is 
             # platform-dependent
             build_status_fname = ".lock-ns3_%s_build" % sys.platform
-            build_status_path = os.path.join(path, build_status_fname)
+            build_status_path = os.path.join(self.path, build_status_fname)
         else:
             build_status_fname = "build.py"
-            if optimized:
-                build_status_path = os.path.join(path,
+            if self.optimized:
+                build_status_path = os.path.join(self.path,
                                                 'build/optimized/build-status.py')
             else:
-                build_status_path = os.path.join(path,
+                build_status_path = os.path.join(self.path,
                                                 'build/build-status.py')
 
+        # Importing the build status file is expensive, so we reuse the
+        # executable we found the last time the file was in the same state
+        build_status = os.stat(build_status_path)
+        cache_key = [os.path.abspath(self.path), self.script, self.optimized,
+                     build_status_path, build_status.st_mtime_ns,
+                     build_status.st_size]
+        script_executable = get_cached_value('script_executable', cache_key)
+        if script_executable is not None:
+            return script_executable
+
         # By importing the file, we can naturally get the dictionary
         loader = importlib.machinery.SourceFileLoader(build_status_fname, build_status_path)
         mod = types.ModuleType(loader.name)
         loader.exec_module(mod)
-            
 
         # Search is simple: we look for the script name in the program field.
         # Note that this could yield multiple matches, in case the script name
         # string is contained in another script's name.
         # matches contains [program, path] for each program matching the script
         matches = [{'name': program,
-                    'path': os.path.abspath(os.path.join(path, program))} for
+                    'path': os.path.abspath(os.path.join(self.path, program))} for
                    program in mod.ns3_runnable_programs if self.script
                    in program]
 
@@ -107,31 +274,113 @@ class SimulationRunner(object):
                                            len(self.script)/len(x['name'])},
                                 matches)
 
-        self.script_executable = max(match_percentages,
-                                     key=lambda x: x['percentage'])['path']
+        script_executable = max(match_percentages,
+                                key=lambda x: x['percentage'])['path']
 
         # This step is not needed for CMake versions of ns-3
-        if "scratch" in self.script_executable and not os.path.exists(os.path.join(self.path, "ns3")):
-            path_with_subdir = self.script_executable.split("/scratch/")[-1]
+        if "scratch" in script_executable and not os.path.exists(os.path.join(self.path, "ns3")):
+            path_with_subdir = script_executable.split("/scratch/")[-1]
             if ("/" in path_with_subdir):  # Script is in a subdir
                 executable_subpath = "%s/%s" % (self.script, self.script)
             else:  # Script is in scratch root
                 executable_subpath = self.script
-            if optimized:
-                self.script_executable = os.path.abspath(
-                    os.path.join(path,
+            if self.optimized:
+                script_executable = os.path.abspath(
+                    os.path.join(self.path,
                                  "build/optimized/scratch",
                                  executable_subpath))
             else:
-                self.script_executable = os.path.abspath(
-                    os.path.join(path,
+                script_executable = os.path.abspath(
+                    os.path.join(self.path,
                                  "build/scratch",
                                  executable_subpath))
 
+        set_cached_value('script_executable', cache_key, script_executable)
+
+        return script_executable
+
     #############
     # Utilities #
     #############
 
+    def get_source_status(self):
+        """
+        Return the HEAD commit of the ns-3 installation, together with the
+        modification times of its modified or untracked files, or None if
+        they cannot be determined (e.g., because path is not a git
+        repository).
+
+        Building does not change the status of the sources, which can thus be
+        computed once and passed to get_build_fingerprint both before and
+        after a build. Untracked files are listed like in is_repo_dirty.
+        """
+        from git import Repo, exc
+        try:
+            repo = Repo(self.path)
+            head = repo.head.commit.hexsha
+            status = repo.git.execute(['git', '-c', 'core.untrackedCache=true',
+                                       'status', '--porcelain',
+                                       '--untracked-files=normal'])
+        except (exc.InvalidGitRepositoryError, exc.NoSuchPathError,
+                exc.GitCommandError, ValueError):
+            return None
+
+        # Each line has the form 'XY path' or 'XY original -> path'
+        dirty = []
+        for line in status.splitlines():
+            filename = line[3:].split(' -> ')[-1].strip('"')
+            filepath = os.path.join(self.path, filename)
+            mtime = os.stat(filepath).st_mtime_ns if os.path.exists(filepath) else None
+            dirty.append((filename, mtime))
+        return head, sorted(dirty)
+
+    def get_build_fingerprint(self, source_status=None):
+        """
+        Return a fingerprint of the state of the ns-3 installation that
+        determines the outcome of a build, or None if the state cannot be
+        determined (e.g., because path is not a git repository).
+
+        The fingerprint covers the HEAD commit, the modification times of any
+        modified or untracked file, the build profile and the modification
+        time of the script executable.
+
+        Args:
+            source_status (tuple): the status of the sources, as returned by
+                get_source_status. If None, it is computed by this function.
+        """
+        if source_status is None:
+            source_status = self.get_source_status()
+        if source_status is None:
+            return None
+        head, dirty = source_status
+
+        executable_mtime = None
+        if getattr(self, 'script_executable', None) is not None and \
+                os.path.exists(self.script_executable):
+            executable_mtime = os.stat(self.script_executable).st_mtime_ns
+
+        return hashlib.sha1(repr((head, dirty, self.optimized,
+                                  executable_mtime)).encode()).hexdigest()
+
+    def is_build_up_to_date(self, build_fingerprint):
+        """
+        Return whether the ns-3 installation is in the same state it was when
+        build_fingerprint was computed, in which case there is no need to
+        configure and build it again.
+
+        Args:
+            build_fingerprint (str): a fingerprint returned by
+                get_build_fingerprint, or None.
+        """
+        if build_fingerprint is None:
+            return False
+        try:
+            self.script_executable = self.find_script_executable()
+        except (OSError, ValueError):
+            # The build status file or the script are not available yet
+            return False
+        return self.get_build_fingerprint() == build_fingerprint
+
     def configure_and_build(self, show_progress=True, optimized=True,
                             skip_configuration=False):
         """
@@ -233,6 +482,22 @@ class SimulationRunner(object):
     def get_available_parameters(self):
         """
         Return a list of the parameters made available by the script.
+
+        Since discovering the parameters requires running the script, results
+        are cached on disk and reused as long as the executable is unchanged.
+        """
+        executable = os.stat(self.script_executable)
+        cache_key = [self.script_executable, executable.st_mtime_ns,
+                     executable.st_size]
+        params = get_cached_value('available_parameters', cache_key)
+        if params is None:
+            params = self.discover_available_parameters()
+            set_cached_value('available_parameters', cache_key, params)
+        return params
+
+    def discover_available_parameters(self):
+        """
+        Run the script to find out which parameters it makes available.
         """
 
         # At the moment, we rely on regex to extract the list of available
@@ -253,6 +518,20 @@ class SimulationRunner(object):
                                                  env=self.environment,
                                                  cwd=self.path).decode('utf-8')
 
+        return self.parse_available_parameters(options, global_options)
+
+    @staticmethod
+    def parse_available_parameters(options, global_options):
+        """
+        Return a dictionary pairing the parameters made available by a script
+        with their default values.
+
+        Args:
+            options (list): the list of program options, as isolated from the
+                output of the script's --PrintHelp command.
+            global_options (str): the output of the script's --PrintGlobals
+                command.
+        """
         # Get the single parameter names
         params = {}
         if len(options):
@@ -286,10 +565,359 @@ class SimulationRunner(object):
                              'SimulatorImplementationType', 'ChecksumEnabled']})
         return params  # Return a sorted list
 
+    ###########
+    # Staging #
+    ###########
+
+    def get_build_files(self):
+        """
+        Return a list of (source, destination) tuples describing the files to
+        copy in order to run the script from another folder: the script
+        executable, which is copied in the bin subfolder, and the ns-3
+        libraries, which are copied in the lib subfolder.
+        """
+        files = [(self.script_executable, os.path.join(
+            'bin', os.path.basename(self.script_executable)))]
+        for library_dir in self.environment['LD_LIBRARY_PATH'].split(':'):
+            for library in sorted(glob.glob(os.path.join(library_dir,
+                                                         'libns3*'))):
+                files.append((library, os.path.join(
+                    'lib', os.path.basename(library))))
+        return files
+
+    def get_staging_manifest(self):
+        """
+        Return a list of (source, destination, checksum) tuples describing
+        the files to stage, as listed by get_build_files.
+        """
+        return [(source, destination, get_file_checksum(source)) for source,
+                destination in self.get_build_files()]
+
+    @staticmethod
+    def get_staging_checksums(manifest):
+        """
+        Return the checksums of the files of a staging manifest, in the
+        format expected by sha1sum --check.
+        """
+        return ''.join('%s  %s\n' % (checksum, destination) for _,
+                       destination, checksum in manifest)
+
+    def stage_build(self):
+        """
+        Copy the script executable and the ns-3 libraries to stage_dir, unless
+        a copy of the same files is already there, and return the path of the
+        staged executable and the environment to run it with.
+
+        Copies are named after the checksums of the files they contain, and
+        are only made available once all their files were validated.
+        """
+        manifest = self.get_staging_manifest()
+        checksums = self.get_staging_checksums(manifest)
+        key = hashlib.sha1(checksums.encode()).hexdigest()
+        staged_dir = os.path.join(self.stage_dir, 'sem-%s' % key)
+
+        if not os.path.isdir(staged_dir):
+            os.makedirs(self.stage_dir, exist_ok=True)
+            temp_dir = tempfile.mkdtemp(prefix='.sem-', dir=self.stage_dir)
+            try:
+                for source, destination, checksum in manifest:
+                    os.makedirs(os.path.join(temp_dir,
+                                             os.path.dirname(destination)),
+                                exist_ok=True)
+                    shutil.copy2(source, os.path.join(temp_dir, destination))
+                    sha1 = hashlib.sha1()
+                    with open(os.path.join(temp_dir, destination),
+                              'rb') as staged_file:
+                        for chunk in iter(lambda: staged_file.read(1024 * 1024),
+                                          b''):
+                            sha1.update(chunk)
+                    if sha1.hexdigest() != checksum:
+                        raise OSError("Staged copy of %s is corrupted" %
+                                      source)
+                try:
+                    os.rename(temp_dir, staged_dir)
+                except OSError:
+                    # Another process staged the same files in the meantime
+                    pass
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        library_path = os.path.join(staged_dir, 'lib')
+        return (os.path.join(staged_dir, manifest[0][1]),
+                {'LD_LIBRARY_PATH': library_path,
+                 'DYLD_LIBRARY_PATH': library_path})
+
+    def get_executable_and_environment(self):
+        """
+        Return the executable to run simulations with and its environment,
+        which point to the copy of the build in stage_dir if staging is
+        enabled.
+
+        If the build can't be staged, the original executable is used.
+        """
+        if self.stage_dir is None:
+            return self.script_executable, self.environment
+
+        with self.staging_lock:
+            # Stage again if any file was rebuilt
+            state = []
+            for source, _ in self.get_build_files():
+                stat = os.stat(source)
+                state.append((source, stat.st_mtime_ns, stat.st_size))
+            if self.staged_build is None or self.staged_build[0] != state:
+                try:
+                    self.staged_build = (state, self.stage_build())
+                except OSError as e:
+                    warnings.warn("Could not stage the build in %s, running "
+                                  "from the original one: %s" %
+                                  (self.stage_dir, e))
+                    self.staged_build = (state, (self.script_executable,
+                                                 self.environment))
+            return self.staged_build[1]
+
+    ##################
+    # Run statistics #
+    ##################
+
+    def set_run_statistics(self, results):
+        """
+        Reset the run statistics of this runner, and compute them again from
+        a list of results (e.g., all the results of a campaign).
+
+        Args:
+            results (list): list of result dictionaries.
+        """
+        self.run_statistics = {}
+        for result in results:
+            self.update_run_statistics(result)
+
+    def update_run_statistics(self, result):
+        """
+        Update the run statistics of this runner with a new result.
+
+        For each parameter combination, we keep track of the number of runs,
+        their average elapsed time and the highest peak memory usage.
+
+        Args:
+            result (dict): a result dictionary.
+        """
+        key = get_combination_key(result['params'])
+        statistics = self.run_statistics.get(key, {'runs': 0,
+                                                   'elapsed_time': 0,
+                                                   'max_rss': None})
+        runs = statistics['runs'] + 1
+        elapsed_time = (statistics['elapsed_time'] * statistics['runs'] +
+                        float(result['meta'].get('elapsed_time', 0))) / runs
+        max_rss = statistics['max_rss']
+        if result['meta'].get('max_rss') is not None:
+            max_rss = max(max_rss or 0, result['meta']['max_rss'])
+        self.run_statistics[key] = {'runs': runs,
+                                    'elapsed_time': elapsed_time,
+                                    'max_rss': max_rss}
+
+    def predict(self, parameter, statistic):
+        """
+        Return the value of a statistic (e.g., elapsed_time or max_rss) that is
+        expected for a parameter combination, based on previous runs, or None
+        if the combination was never run.
+
+        Args:
+            parameter (dict): the parameter combination.
+            statistic (str): the name of the statistic.
+        """
+        statistics = self.run_statistics.get(get_combination_key(parameter))
+        if statistics is None:
+            return None
+        return statistics[statistic]
+
     ######################
     # Simulation running #
     ######################
 
+    def get_cpu_sets(self):
+        """
+        Split the CPUs this process is allowed to run on into disjoint sets,
+        one for each simulation that can run in parallel.
+
+        If there are more parallel simulations than CPUs, each set contains a
+        single CPU, and simulations wait for a free set before starting.
+        """
+        cpus = sorted(os.sched_getaffinity(0))
+        slots = self.max_parallel_processes or len(cpus)
+        cpus_per_slot = max(1, len(cpus) // slots)
+        # Consecutive CPUs are grouped together, since they are more likely
+        # to share caches
+        return [cpus[i:i + cpus_per_slot] for i in
+                range(0, len(cpus) - cpus_per_slot + 1, cpus_per_slot)][:slots]
+
+    def set_process_limits(self, pid, cpus=None):
+        """
+        Set the resource limits and CPU affinity of this runner on a
+        simulation process that was just started.
+
+        Limits are set from this process, rather than in the simulation
+        process before the ns-3 script is started, so that simulations can be
+        spawned without forking this process: the time they run
+        unconstrained is negligible.
+
+        Args:
+            pid (int): the process id of the simulation.
+            cpus (list): the CPUs the simulation should be pinned to.
+        """
+        try:
+            if cpus is not None:
+                os.sched_setaffinity(pid, cpus)
+            for limit, soft, hard in self.get_resource_limits():
+                resource.prlimit(pid, limit, (soft, hard))
+        except ProcessLookupError:
+            # The process already exited
+            pass
+
+    def get_resource_limits(self):
+        """
+        Return the resource limits of this runner, as a list of (resource,
+        soft limit, hard limit) tuples.
+        """
+        limits = []
+        if self.cpu_time_limit is not None:
+            # The soft limit triggers a SIGXCPU, the hard one a SIGKILL
+            limits.append((resource.RLIMIT_CPU, int(self.cpu_time_limit),
+                           int(self.cpu_time_limit) + 1))
+        if self.memory_limit is not None:
+            limits.append((resource.RLIMIT_AS, int(self.memory_limit),
+                           int(self.memory_limit)))
+        return limits
+
+    def was_killed_by_limit(self, return_code, stderr_file_path):
+        """
+        Return whether a simulation that did not time out was stopped because
+        it exceeded its CPU time or memory limits.
+
+        Args:
+            return_code (int): the exit code of the simulation.
+            stderr_file_path (str): path to the standard error of the
+                simulation.
+        """
+        if self.cpu_time_limit is not None and return_code in [
+                -signal.SIGXCPU, -signal.SIGKILL]:
+            return True
+        if self.memory_limit is not None and return_code != 0:
+            # Allocations beyond the address space limit fail, which in
+            # ns-3 typically results in an uncaught std::bad_alloc
+            with open(stderr_file_path, 'r') as stderr_file:
+                return 'std::bad_alloc' in stderr_file.read()
+        return False
+
+    def wait_for_process(self, process):
+        """
+        Wait for a simulation process to exit, and return its exit code
+        together with a dictionary describing the resources it used.
+
+        If this runner has a timeout, the process is killed once it has been
+        running for longer than that, and the timed_out entry of the returned
+        dictionary is set to True.
+
+        Resource usage is collected from the kernel when the process is
+        reaped, and contains the user and system CPU time (in seconds), the
+        peak resident set size (in kilobytes) and the number of block input and
+        output operations. Note that, on Linux, the kernel also accounts the
+        memory of the process the simulation was spawned from in the peak RSS.
+        If use_launcher is True, this is a small helper process, and the
+        reported value is the peak of the simulation itself (or the few
+        megabytes used by the launcher, for smaller simulations). Otherwise,
+        the simulation is spawned from this process, and its peak RSS is only
+        known, and reported, if it exceeds the peak RSS of this process: in
+        the other cases, max_rss is None.
+
+        Args:
+            process (subprocess.Popen, LaunchedProcess): the simulation
+                process to wait for.
+        """
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            self.kill_process(process)
+
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+
+        if isinstance(process, LaunchedProcess):
+            # The launcher reaps the process, and never signals a recycled
+            # process id
+            try:
+                _, rusage = process.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                    timer.join()
+        else:
+            # Wait for the process to exit without reaping it, so that the
+            # timer can never signal a recycled process id
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            if timer is not None:
+                timer.cancel()
+                timer.join()
+
+            with self.reaping_lock:
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+
+        # Linux reports the peak RSS in kilobytes, while macOS uses bytes
+        max_rss = rusage.ru_maxrss
+        if sys.platform == 'darwin':
+            max_rss = max_rss // 1024
+
+        # The peak RSS of a simulation forked from this process is the
+        # largest between its own and the one of this process
+        if not isinstance(process, LaunchedProcess) and rusage.ru_maxrss <= \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+            max_rss = None
+
+        return process.returncode, {
+            'user_time': rusage.ru_utime,
+            'system_time': rusage.ru_stime,
+            'max_rss': max_rss,
+            'block_input': rusage.ru_inblock,
+            'block_output': rusage.ru_oublock,
+            'timed_out': timed_out.is_set(),
+        }
+
+    def kill_process(self, process):
+        """
+        Kill a simulation process with SIGKILL, unless it was already reaped.
+
+        Args:
+            process (subprocess.Popen, LaunchedProcess): the simulation
+                process to kill.
+        """
+        if isinstance(process, LaunchedProcess):
+            process.kill()
+            return
+        # Processes are reaped while holding the lock, so that we never
+        # signal a recycled process id
+        with self.reaping_lock:
+            if process.returncode is None:
+                os.kill(process.pid, signal.SIGKILL)
+
+    def cancel_simulation(self, sim_uuid):
+        """
+        Kill a running simulation whose result is not needed anymore. The
+        result of cancelled simulations has the cancelled meta entry set to
+        True, and they are never reported as failed.
+
+        Args:
+            sim_uuid (str): the id of the simulation.
+        """
+        with self.reaping_lock:
+            simulation = self.running.get(sim_uuid)
+            if simulation is None:
+                return
+            simulation['cancelled'] = True
+            self.kill_process(simulation['process'])
+
     def run_simulations(self, parameter_list, data_folder, callbacks: [CallbackBase] = None, stop_on_errors=False):
         """
         Run several simulations using a certain combination of parameters.
@@ -310,74 +938,212 @@ class SimulationRunner(object):
                 if not cb.is_controlled_by_parent():
                     cb.on_simulation_start(len(list(enumerate(parameter_list))))
 
-        for _, parameter in enumerate(parameter_list):
-
-            current_result = {
-                'params': {},
-                'meta': {}
-                }
-            current_result['params'].update(parameter)
-
-            command = [self.script_executable] + ['--%s=%s' % (param, value)
-                                                  for param, value in
-                                                  parameter.items()]
-
-            # Run from dedicated temporary folder
-            sim_uuid = str(uuid.uuid4())
-            current_result['meta']['id'] = sim_uuid
-            temp_dir = os.path.join(data_folder, current_result['meta']['id'])
-            os.makedirs(temp_dir)
-
-            start = time.time()  # Time execution
-            stdout_file_path = os.path.join(temp_dir, 'stdout')
-            stderr_file_path = os.path.join(temp_dir, 'stderr')
-
-            if callbacks is not None:
-                for cb in callbacks:
-                    cb.on_run_start(parameter, sim_uuid)
-
-            with open(stdout_file_path, 'w') as stdout_file, open(
-                    stderr_file_path, 'w') as stderr_file:
-                return_code = subprocess.call(command, cwd=temp_dir,
-                                              env=self.environment,
-                                              stdout=stdout_file,
-                                              stderr=stderr_file)
-            end = time.time()  # Time execution
-
-            if callbacks is not None:
-                for cb in callbacks:
-                    cb.on_run_end(sim_uuid, return_code, end - start)
-
-            if return_code != 0:
-
-                with open(stdout_file_path, 'r') as stdout_file, open(
-                        stderr_file_path, 'r') as stderr_file:
-                    complete_command = sem.utils.get_command_from_result(self.script, current_result)
-                    complete_command_debug = sem.utils.get_command_from_result(self.script, current_result, debug=True)
-                    error_message = ('\nSimulation exited with an error.\n'
-                                     'Params: %s\n'
-                                     'Stderr: %s\n'
-                                     'Stdout: %s\n'
-                                     'Use this command to reproduce:\n'
-                                     '%s\n'
-                                     'Debug with gdb:\n'
-                                     '%s'
-                                     % (parameter,
-                                        stderr_file.read(),
-                                        stdout_file.read(),
-                                        complete_command,
-                                        complete_command_debug))
-                    if stop_on_errors:
-                        raise Exception(error_message)
-                    print(error_message) 
-
-            current_result['meta']['elapsed_time'] = end-start
-            current_result['meta']['exitcode'] = return_code
-
+        for parameter in parameter_list:
+            current_result = self.run_simulation(parameter, data_folder,
+                                                 callbacks, stop_on_errors)
+            self.wait_for_outputs(current_result)
             yield current_result
-        
+
         # Log simulation start if not already done by parent class
         if callbacks is not None:
             for cb in callbacks:
                 if not cb.is_controlled_by_parent():
                     cb.on_simulation_end()
+
+    def run_simulation(self, parameter, data_folder, callbacks=None,
+                       stop_on_errors=False, build=None):
+        """
+        Run a single simulation, and return its result.
+
+        If a scratch folder is used, the output files of the simulation may
+        still be being moved to data_folder when this function returns: use
+        wait_for_outputs to make sure they are available.
+
+        Args:
+            parameter (dict): the parameter combination to simulate.
+            data_folder (str): folder in which to save the subfolder
+                containing the simulation output.
+            callbacks (list): list of callbacks to be triggered.
+            stop_on_errors (bool): whether to raise an exception if the
+                simulation outputs an error.
+            build (tuple): the executable and environment to run the
+                simulation with, as returned by
+                get_executable_and_environment. If None, they are retrieved
+                by this function.
+        """
+        if build is None:
+            build = self.get_executable_and_environment()
+        executable, environment = build
+
+        current_result = {
+            'params': {},
+            'meta': {}
+            }
+        current_result['params'].update(parameter)
+
+        command = [executable] + ['--%s=%s' % (param, value)
+                                  for param, value in
+                                  parameter.items()]
+
+        # Run from dedicated temporary folder
+        sim_uuid = str(uuid.uuid4())
+        current_result['meta']['id'] = sim_uuid
+        temp_dir = os.path.join(data_folder, current_result['meta']['id'])
+        os.makedirs(temp_dir)
+
+        # Run from a node-local folder, if requested
+        run_dir = temp_dir
+        if self.scratch_dir is not None:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+            run_dir = tempfile.mkdtemp(prefix='sem-%s-' % sim_uuid,
+                                       dir=self.scratch_dir)
+
+        stdout_file_path = os.path.join(run_dir, 'stdout')
+        stderr_file_path = os.path.join(run_dir, 'stderr')
+
+        if callbacks is not None:
+            for cb in callbacks:
+                cb.on_run_start(parameter, sim_uuid)
+
+        # Wait for a free set of CPUs, if simulations are pinned
+        cpus = None
+        if self.cpu_slots is not None:
+            cpus = self.cpu_slots.get()
+
+        start = time.time()  # Time execution
+        try:
+            if self.use_launcher:
+                process = get_launcher().spawn(
+                    command, run_dir, environment, stdout_file_path,
+                    stderr_file_path, cpus=cpus,
+                    limits=self.get_resource_limits())
+            else:
+                with open(stdout_file_path, 'w') as stdout_file, open(
+                        stderr_file_path, 'w') as stderr_file:
+                    process = subprocess.Popen(command, cwd=run_dir,
+                                               env=environment,
+                                               stdout=stdout_file,
+                                               stderr=stderr_file)
+                self.set_process_limits(process.pid, cpus)
+            simulation = {'parameter': parameter,
+                          'pid': process.pid,
+                          'process': process,
+                          'thread': threading.get_ident(),
+                          'start': start}
+            self.running[sim_uuid] = simulation
+            try:
+                return_code, resource_usage = self.wait_for_process(process)
+            finally:
+                del self.running[sim_uuid]
+        finally:
+            if cpus is not None:
+                self.cpu_slots.put(cpus)
+        end = time.time()  # Time execution
+
+        if cpus is not None:
+            resource_usage['cpus'] = cpus
+
+        # Runs stopped because of their limits are saved, so that they
+        # can later be retried or excluded, and they don't stop the
+        # campaign. Cancelled runs are killed with the same signal as runs
+        # exceeding their CPU time, but are not attributed to limits.
+        cancelled = simulation.get('cancelled', False)
+        resource_usage['killed_by_limit'] = (
+            not resource_usage['timed_out'] and not cancelled and
+            self.was_killed_by_limit(return_code, stderr_file_path))
+        stopped = (resource_usage['timed_out'] or
+                   resource_usage['killed_by_limit'])
+
+        if callbacks is not None:
+            for cb in callbacks:
+                cb.on_run_end(sim_uuid, return_code, end - start)
+
+        if return_code != 0 and not cancelled:
+
+            with open(stdout_file_path, 'r') as stdout_file, open(
+                    stderr_file_path, 'r') as stderr_file:
+                complete_command = sem.utils.get_command_from_result(self.script, current_result)
+                complete_command_debug = sem.utils.get_command_from_result(self.script, current_result, debug=True)
+                if stopped:
+                    reason = 'Simulation exceeded its time or resource limits'
+                else:
+                    reason = 'Simulation exited with an error'
+                error_message = ('\n%s.\n'
+                                 'Params: %s\n'
+                                 'Stderr: %s\n'
+                                 'Stdout: %s\n'
+                                 'Use this command to reproduce:\n'
+                                 '%s\n'
+                                 'Debug with gdb:\n'
+                                 '%s'
+                                 % (reason,
+                                    parameter,
+                                    stderr_file.read(),
+                                    stdout_file.read(),
+                                    complete_command,
+                                    complete_command_debug))
+
+        # Drop unneeded files before moving them to the campaign directory
+        if self.retention_policy is not None:
+            apply_retention_policy(run_dir, self.retention_policy)
+
+        if run_dir != temp_dir:
+            self.move_outputs(sim_uuid, run_dir, temp_dir)
+
+        if return_code != 0 and not cancelled:
+            if stop_on_errors and not stopped:
+                # Outputs must be in the campaign directory when the error
+                # is reported, so that they can be inspected
+                self.wait_for_outputs(current_result)
+                raise Exception(error_message)
+            print(error_message)
+
+        current_result['meta']['elapsed_time'] = end-start
+        current_result['meta']['exitcode'] = return_code
+        current_result['meta'].update(resource_usage)
+
+        # Cancelled runs don't tell how long simulations take
+        if cancelled:
+            current_result['meta']['cancelled'] = True
+        else:
+            self.update_run_statistics(current_result)
+
+        return current_result
+
+    def move_outputs(self, sim_uuid, run_dir, output_dir):
+        """
+        Start moving the output files of a simulation from the folder it was
+        run in to its folder in the campaign directory, in the background.
+
+        Args:
+            sim_uuid (str): the id of the simulation.
+            run_dir (str): the folder the simulation was run in, which is
+                removed once its files are moved.
+            output_dir (str): the folder of the simulation in the campaign
+                directory.
+        """
+        def move():
+            for filename in os.listdir(run_dir):
+                shutil.move(os.path.join(run_dir, filename),
+                            os.path.join(output_dir, filename))
+            os.rmdir(run_dir)
+
+        with self.output_movers_lock:
+            if self.output_movers is None:
+                self.output_movers = ThreadPoolExecutor(
+                    max_workers=OUTPUT_MOVERS)
+            self.pending_outputs[sim_uuid] = self.output_movers.submit(move)
+
+    def wait_for_outputs(self, result):
+        """
+        Wait until the output files of a simulation are in its folder in the
+        campaign directory.
+
+        Args:
+            result (dict): the result of the simulation, as returned by
+                run_simulation.
+        """
+        with self.output_movers_lock:
+            move = self.pending_outputs.pop(result['meta']['id'], None)
+        if move is not None:
+            move.result()
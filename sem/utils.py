@@ -1,6 +1,13 @@
 import io
+import os
+import re
+import json
+import shutil
+import fnmatch
 import math
 import copy
+import hashlib
+import inspect
 import warnings
 from itertools import product
 from functools import wraps
@@ -19,6 +26,22 @@ try:
 except(RuntimeError):
     DRMAA_AVAILABLE = False
 
+# Entries of the retention policies deciding which output files of each
+# simulation are kept: include and exclude are lists of glob patterns (or
+# regular expressions, if prefixed with re:) the name of output files is
+# matched against, max_file_size is the size, in bytes, above which output
+# files are removed, and stdout_tail is the number of bytes at the end of
+# stdout to keep.
+RETENTION_POLICY_KEYS = ['include', 'exclude', 'max_file_size', 'stdout_tail']
+
+# Folder where information that is expensive to compute (e.g., the parameters
+# made available by a script) is cached across runs
+CACHE_DIR = os.environ.get('SEM_CACHE_DIR',
+                           os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                                       os.path.expanduser(
+                                                           '~/.cache')),
+                                        'sem'))
+
 def output_labels(argument):
     def decorator(function):
         function.__dict__["output_labels"] = argument
@@ -50,6 +73,37 @@ def yields_multiple_results(function):
     return wrapper
 
 
+def get_parser_identity(function):
+    """
+    Return a string identifying a result parsing function by its code and by
+    the arguments of the sem decorators applied to it, or None if the
+    function's code cannot be inspected.
+
+    The identity is stable across sessions and changes whenever the body of
+    the function is modified. Note that changes to other functions or global
+    variables the parsing function relies on are not detected.
+    """
+    unwrapped = inspect.unwrap(function)
+    code = getattr(unwrapped, '__code__', None)
+    if code is None:
+        return None
+
+    def hash_code(code):
+        # Nested functions appear among the constants as code objects, whose
+        # representation contains their memory address
+        constants = [hash_code(c) if inspect.iscode(c) else repr(c) for c in
+                     code.co_consts]
+        return hashlib.sha1(repr((code.co_code, constants, code.co_names,
+                                  code.co_varnames)).encode()).hexdigest()
+
+    decorator_arguments = [repr(function.__dict__.get(key)) for key in
+                           ['output_labels', 'files_to_load',
+                            'yields_multiple_results']]
+    return hashlib.sha1(repr((unwrapped.__qualname__, hash_code(code),
+                              repr(unwrapped.__defaults__),
+                              decorator_arguments)).encode()).hexdigest()
+
+
 def list_param_combinations(param_ranges):
     """
     Create a list of all parameter combinations from a dictionary specifying
@@ -101,6 +155,67 @@ def list_param_combinations(param_ranges):
     return [param_ranges_copy]
 
 
+def get_combination_key(params):
+    """
+    Return a hashable key identifying a parameter combination, regardless of
+    its RngRun value.
+
+    Example:
+
+        >>> get_combination_key({'b': 2, 'a': 1, 'RngRun': 3})
+        (('a', '1'), ('b', '2'))
+    """
+    return tuple(sorted((k, repr(v)) for k, v in params.items()
+                        if k != 'RngRun'))
+
+
+def get_meminfo_entry(name):
+    """
+    Return an entry of /proc/meminfo, in kilobytes, or None if this
+    information is not available.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith(name + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def get_available_memory():
+    """
+    Return the memory available for new processes on this machine, in
+    kilobytes, as reported by /proc/meminfo, or None if this information is
+    not available.
+    """
+    return get_meminfo_entry('MemAvailable')
+
+
+def get_total_memory():
+    """
+    Return the total memory of this machine, in kilobytes, as reported by
+    /proc/meminfo, or None if this information is not available.
+    """
+    return get_meminfo_entry('MemTotal')
+
+
+def get_process_rss(pid):
+    """
+    Return the current resident set size of a process, in kilobytes, or 0 if
+    it cannot be read (e.g., because the process already exited).
+    """
+    try:
+        with open('/proc/%s/status' % pid, 'r') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
 def get_command_from_result(script, result, debug=False):
     """
     Return the command that is needed to obtain a certain result.
@@ -307,6 +422,215 @@ def compute_sensitivity_analysis(
     return salib_analyze_function(problem, results)
 
 
+##############################
+# Code for budget allocation #
+##############################
+
+
+def compute_ocba_allocation(means, stds, total_runs, maximize=True):
+    """
+    Compute how many runs each parameter combination should receive out of a
+    total of total_runs, according to the Optimal Computing Budget Allocation
+    (OCBA) procedure.
+
+    OCBA distributes replications so as to maximize the probability of
+    correctly selecting the best combination: combinations whose mean is close
+    to the best one and whose variance is high receive more runs, while
+    combinations that are clearly worse receive few.
+
+    Example:
+
+        >>> compute_ocba_allocation([1, 2, 10], [1, 1, 1], 100, maximize=False)
+        [49.69..., 49.69..., 0.61...]
+
+    Args:
+        means (list): sample mean of the metric for each combination.
+        stds (list): sample standard deviation of the metric for each
+            combination.
+        total_runs (int): total number of runs to distribute.
+        maximize (bool): whether the best combination is the one with the
+            highest (True) or lowest (False) mean.
+    """
+    means = np.array(means, dtype=float)
+    stds = np.array(stds, dtype=float)
+    if not maximize:
+        means = -means
+
+    best = int(np.argmax(means))
+    others = np.arange(len(means)) != best
+    deltas = means[best] - means
+
+    # Ties with the best combination would require an infinite number of
+    # runs: replace them with a fraction of the smallest non-zero distance.
+    if np.any(deltas[others] > 0) and np.any(stds > 0):
+        smallest = np.min(deltas[others][deltas[others] > 0])
+        deltas[others & (deltas <= 0)] = smallest * 1e-3
+    else:
+        return [total_runs / len(means)] * len(means)
+
+    # Combinations whose samples are all equal would receive no runs, even
+    # if they are the best: floor standard deviations in the same way.
+    stds = np.maximum(stds, smallest * 1e-3)
+
+    ratios = np.zeros(len(means))
+    ratios[others] = (stds[others] / deltas[others]) ** 2
+    # The best combination gets a share that depends on the others' shares
+    ratios[best] = stds[best] * np.sqrt(np.sum(ratios[others] ** 2 /
+                                               stds[others] ** 2))
+
+    return (ratios / np.sum(ratios) * total_runs).tolist()
+
+
+############################
+# Code for on-disk caching #
+############################
+
+
+def get_cache_path(namespace, key):
+    """
+    Return the path of the file caching the value for key in namespace.
+
+    Args:
+        namespace (str): the kind of information that is cached.
+        key (list): a JSON-serializable list identifying the cached value.
+            It should include anything the value depends on, such as the path
+            and modification time of the files it was computed from.
+    """
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, namespace, '%s.json' % digest)
+
+
+def get_cached_value(namespace, key):
+    """
+    Return the value cached for key in namespace, or None if no such value is
+    available.
+    """
+    try:
+        with open(get_cache_path(namespace, key), 'r') as cache_file:
+            entry = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    # Guard against hash collisions
+    if entry.get('key') != key:
+        return None
+    return entry['value']
+
+
+def set_cached_value(namespace, key, value):
+    """
+    Cache value for key in namespace. Failures to write the cache are ignored,
+    since the value can always be computed again.
+    """
+    cache_path = get_cache_path(namespace, key)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partially written entry
+        temporary_path = '%s.%s.tmp' % (cache_path, os.getpid())
+        with open(temporary_path, 'w') as cache_file:
+            json.dump({'key': key, 'value': value}, cache_file)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        pass
+
+
+def get_file_checksum(path):
+    """
+    Return the SHA-1 checksum of a file. Checksums are cached, and only
+    computed again when the size or modification time of the file change.
+    """
+    stat = os.stat(path)
+    cache_key = [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+    checksum = get_cached_value('checksum', cache_key)
+    if checksum is None:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as checked_file:
+            for chunk in iter(lambda: checked_file.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        checksum = sha1.hexdigest()
+        set_cached_value('checksum', cache_key, checksum)
+    return checksum
+
+
+def matches_file_pattern(filename, pattern):
+    """
+    Return whether a filename matches a pattern, which is interpreted as a
+    regular expression if it starts with re:, and as a glob otherwise.
+    """
+    if pattern.startswith('re:'):
+        return re.fullmatch(pattern[3:], filename) is not None
+    return fnmatch.fnmatchcase(filename, pattern)
+
+
+def apply_retention_policy(folder, policy):
+    """
+    Remove the output files of a simulation that should not be kept, and
+    truncate its stdout, according to a retention policy.
+
+    The stdout and stderr files are never removed.
+
+    Args:
+        folder (str): the folder containing the output files.
+        policy (dict): the retention policy, as described in
+            RETENTION_POLICY_KEYS. Missing entries do not filter anything.
+    """
+    for filename in os.listdir(folder):
+        if filename in ['stdout', 'stderr']:
+            continue
+        path = os.path.join(folder, filename)
+        keep = True
+        if policy.get('include') is not None:
+            keep = any(matches_file_pattern(filename, pattern) for pattern
+                       in policy['include'])
+        if any(matches_file_pattern(filename, pattern) for pattern in
+               policy.get('exclude') or []):
+            keep = False
+        if (policy.get('max_file_size') is not None and
+                os.path.isfile(path) and
+                os.path.getsize(path) > policy['max_file_size']):
+            keep = False
+        if not keep:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+    # Only keep the end of stdout, which usually contains the final results
+    stdout_path = os.path.join(folder, 'stdout')
+    if (policy.get('stdout_tail') is not None and
+            os.path.isfile(stdout_path) and
+            os.path.getsize(stdout_path) > policy['stdout_tail']):
+        with open(stdout_path, 'rb+') as stdout_file:
+            stdout_file.seek(-policy['stdout_tail'], os.SEEK_END)
+            tail = stdout_file.read()
+            stdout_file.seek(0)
+            stdout_file.write(tail)
+            stdout_file.truncate()
+
+
+def is_repo_dirty(repo, paths=None):
+    """
+    Return whether a git repository contains modified or untracked files.
+
+    Modified files are detected through git's comparison of the working tree
+    with the index, which only reads files whose stat information changed.
+    The scan for untracked files uses git's untracked cache, which records
+    the mtime of each folder in the index, and only lists again the folders
+    that changed since the previous check.
+
+    Args:
+        repo (git.Repo): the repository to check.
+        paths (list): paths, relative to the root of the repository, to limit
+            the check to. If None, the whole repository is checked.
+    """
+    paths = list(paths) if paths is not None else []
+
+    # Changes to tracked files, both staged and unstaged, and untracked files
+    return bool(repo.git.execute(['git', '-c', 'core.untrackedCache=true',
+                                  'status', '--porcelain',
+                                  '--untracked-files=normal', '--', *paths]))
+
+
 class CallbackBase(ABC):
     """
     Base class for SEM callbacks.
@@ -3,7 +3,9 @@ import shutil
 import os
 import subprocess
 import collections
+import time
 from git import Repo
+import sem.utils
 from sem import CampaignManager
 
 ns_3_examples = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -214,6 +216,213 @@ def get_and_compile_ns_3():
                        stderr=subprocess.DEVNULL) > 0:
         raise Exception("Examples build failed.")
 
+#################
+# Mock DRMAA    #
+#################
+
+
+class MockJobTemplate:
+    PARAMETRIC_INDEX = '$drmaa_incr_ph$'
+
+    def __init__(self):
+        self.remoteCommand = None
+        self.args = []
+        self.jobEnvironment = None
+        self.workingDirectory = os.getcwd()
+        self.nativeSpecification = ''
+        self.outputPath = None
+        self.errorPath = None
+        self.joinFiles = False
+
+
+class MockSession:
+    """
+    A DRMAA session emulating a local queue: jobs run as local processes, at
+    most slots at a time, in submission order.
+    """
+    JOB_IDS_SESSION_ANY = 'DRMAA_JOB_IDS_SESSION_ANY'
+    JOB_IDS_SESSION_ALL = 'DRMAA_JOB_IDS_SESSION_ALL'
+    TIMEOUT_WAIT_FOREVER = -1
+    TIMEOUT_NO_WAIT = 0
+
+    slots = 2
+    # Job ids of the submitted bulk jobs, across all sessions
+    bulk_jobs = []
+    submitted = 0
+    sessions = 0
+
+    def initialize(self):
+        MockSession.sessions += 1
+        self.queued = collections.OrderedDict()
+        self.running = {}
+        self.done = collections.OrderedDict()
+
+    def exit(self):
+        pass
+
+    def createJobTemplate(self):
+        return MockJobTemplate()
+
+    def deleteJobTemplate(self, jt):
+        pass
+
+    def runJob(self, jt):
+        return self.submit(jt, [1])[0]
+
+    def runBulkJobs(self, jt, begin, end, step):
+        jobids = self.submit(jt, range(begin, end + 1, step))
+        MockSession.bulk_jobs.append(jobids)
+        return jobids
+
+    def submit(self, jt, indices):
+        jobids = []
+        for index in indices:
+            def expand(path):
+                return path.replace(MockJobTemplate.PARAMETRIC_INDEX,
+                                    str(index))
+            MockSession.submitted += 1
+            jobid = str(MockSession.submitted)
+            self.queued[jobid] = {
+                'command': [jt.remoteCommand] + list(jt.args),
+                'cwd': expand(jt.workingDirectory),
+                'env': jt.jobEnvironment,
+                'output': expand(jt.outputPath.lstrip(':')),
+                'submission_time': time.time(),
+            }
+            jobids.append(jobid)
+        self.schedule()
+        return jobids
+
+    def schedule(self):
+        for jobid, (process, usage) in list(self.running.items()):
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid == 0:
+                continue
+            process.returncode = os.waitstatus_to_exitcode(status)
+            usage.update({'end_time': time.time(),
+                          'ru_utime': rusage.ru_utime,
+                          'ru_stime': rusage.ru_stime,
+                          'ru_maxrss': rusage.ru_maxrss,
+                          'ru_inblock': rusage.ru_inblock,
+                          'ru_oublock': rusage.ru_oublock})
+            del self.running[jobid]
+            self.done[jobid] = (process.returncode,
+                                {k: str(v) for k, v in usage.items()})
+        while self.queued and len(self.running) < self.slots:
+            jobid, job = self.queued.popitem(last=False)
+            with open(job['output'], 'w') as output:
+                process = subprocess.Popen(
+                    job['command'], cwd=job['cwd'], env=job['env'],
+                    stdout=output, stderr=subprocess.STDOUT)
+            self.running[jobid] = (process, {
+                'submission_time': job['submission_time'],
+                'start_time': time.time()})
+
+    def wait(self, jobid, timeout=-1):
+        start = time.time()
+        while True:
+            self.schedule()
+            if jobid == self.JOB_IDS_SESSION_ANY and self.done:
+                jobid = next(iter(self.done))
+            if jobid in self.done:
+                return MockJobInfo(jobid, *self.done.pop(jobid))
+            if jobid == self.JOB_IDS_SESSION_ANY:
+                if not (self.queued or self.running):
+                    raise MockDrmaa.errors.InvalidJobException()
+            elif jobid not in self.queued and jobid not in self.running:
+                raise MockDrmaa.errors.InvalidJobException()
+            if 0 <= timeout < time.time() - start:
+                raise MockDrmaa.errors.ExitTimeoutException()
+            time.sleep(0.1)
+
+    def synchronize(self, jobids, timeout=-1, dispose=False):
+        if self.JOB_IDS_SESSION_ALL in jobids:
+            jobids = list(self.queued) + list(self.running) + list(self.done)
+        for jobid in jobids:
+            try:
+                self.wait(jobid, timeout)
+            except MockDrmaa.errors.InvalidJobException:
+                pass
+
+    def jobStatus(self, jobid):
+        self.schedule()
+        if jobid in self.queued:
+            return MockDrmaa.JobState.QUEUED_ACTIVE
+        if jobid in self.running:
+            return MockDrmaa.JobState.RUNNING
+        if jobid in self.done and self.done[jobid][0] < 0:
+            # Jobs terminated before they started
+            return MockDrmaa.JobState.FAILED
+        return MockDrmaa.JobState.DONE
+
+    def control(self, jobid, action):
+        for queued in list(self.queued):
+            if jobid in (queued, self.JOB_IDS_SESSION_ALL):
+                del self.queued[queued]
+                self.done[queued] = (-1, {})
+        for running, (process, _) in self.running.items():
+            if jobid in (running, self.JOB_IDS_SESSION_ALL):
+                process.kill()
+
+
+class MockJobInfo:
+    def __init__(self, jobid, returncode, resource_usage):
+        self.jobId = jobid
+        self.hasExited = returncode >= 0
+        self.exitStatus = returncode
+        self.resourceUsage = resource_usage
+
+
+class MockDrmaa:
+    """
+    A replacement for the drmaa module, using MockSession.
+    """
+    Session = MockSession
+    JobTemplate = MockJobTemplate
+    JOB_IDS_SESSION_ALL = MockSession.JOB_IDS_SESSION_ALL
+
+    class JobControlAction:
+        TERMINATE = 'terminate'
+
+    class JobState:
+        QUEUED_ACTIVE = 'queued_active'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    class errors:
+        class ExitTimeoutException(Exception):
+            pass
+
+        class InvalidJobException(Exception):
+            pass
+
+        class DrmCommunicationException(Exception):
+            pass
+
+        class NoActiveSessionException(Exception):
+            pass
+
+
+@pytest.fixture(autouse=True, scope='function')
+def cache_dir(tmpdir, monkeypatch):
+    # Keep cached values of each test separate, and out of the user's cache
+    cache_dir = str(tmpdir.join('cache'))
+    monkeypatch.setenv('SEM_CACHE_DIR', cache_dir)
+    monkeypatch.setattr(sem.utils, 'CACHE_DIR', cache_dir)
+    return cache_dir
+
+
+@pytest.fixture(scope='function')
+def mock_drmaa(monkeypatch):
+    import sem.gridrunner
+    import sem.hybridrunner
+    monkeypatch.setattr(sem.gridrunner, 'drmaa', MockDrmaa, raising=False)
+    monkeypatch.setattr(sem.hybridrunner, 'drmaa', MockDrmaa, raising=False)
+    monkeypatch.setattr(sem.gridrunner, 'session', None)
+    return MockDrmaa
+
+
 #########################################################################
 # Clean up after each session                                           #
 # Especially needed because we will copy ns-3 and disk space is limited #
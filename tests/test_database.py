@@ -1,4 +1,5 @@
 from sem import DatabaseManager
+import sem.database
 import pytest
 import os
 from copy import deepcopy
@@ -92,6 +93,19 @@ def test_getters(db, tmpdir, config):
     assert db.get_data_dir() == str(tmpdir.join('test_campaign', 'data'))
 
 
+def test_build_fingerprint(db, config):
+    # A new campaign has no fingerprint
+    assert db.get_build_fingerprint() is None
+
+    # Fingerprints are persisted, and don't alter the configuration
+    db.set_build_fingerprint('abc')
+    db.set_build_fingerprint('def')
+    db = DatabaseManager.load(config['campaign_dir'])
+    assert db.get_build_fingerprint() == 'def'
+    del config['campaign_dir']
+    assert db.get_config() == config
+
+
 def test_get_next_rngruns(db, result):
     # First rngrun of a new campaign should be 0
     assert next(db.get_next_rngruns()) == 0
@@ -111,6 +125,72 @@ def test_get_next_rngruns(db, result):
     assert list(itertools.islice(db.get_next_rngruns(), 3)) == [1, 3, 4]
 
 
+def test_results_with_additional_meta(db, result):
+    # Additional information about the run can be stored in meta
+    result['meta']['max_rss'] = 1024
+    db.insert_result(result)
+    assert db.get_results()[0]['meta']['max_rss'] == 1024
+
+    # Mandatory meta entries are still required
+    del result['meta']['elapsed_time']
+    with pytest.raises(ValueError):
+        db.insert_result(result)
+
+
+def test_parse_cache(db, result, monkeypatch):
+    # Missing caches are empty, and caching can be disabled with a None key
+    assert db.load_parse_cache('parser') == {}
+    db.save_parse_cache(None, {'id': 1})
+    assert db.load_parse_cache(None) == {}
+
+    db.save_parse_cache('parser', {'id1': [1, 2], 'id2': [3]})
+    db.save_parse_cache('other_parser', {'id1': 'a'})
+    assert db.load_parse_cache('parser') == {'id1': [1, 2], 'id2': [3]}
+
+    # Deleting a result invalidates its outputs
+    db.invalidate_parse_cache(['id1'])
+    assert db.load_parse_cache('parser') == {'id2': [3]}
+    assert db.load_parse_cache('other_parser') == {}
+
+    # The least recently used outputs are evicted when the cache is full
+    monkeypatch.setattr(sem.database, 'PARSE_CACHE_MAX_SIZE', 0)
+    db.save_parse_cache('new_parser', {'id2': [4]})
+    assert db.load_parse_cache('new_parser') == {'id2': [4]}
+    assert db.load_parse_cache('parser') == {}
+
+
+def test_shared_campaign(db, result, config):
+    # Results of journaling databases only appear in their journal
+    db.enable_journal()
+    db.insert_result(result)
+    other_db = DatabaseManager.load(config['campaign_dir'])
+    assert list(other_db.get_results()) == [result]
+    other_db.merge_journals()
+    assert list(other_db.get_results()) == [result]
+
+    # Saving the database includes the journals in the database file
+    db.set_build_fingerprint('fingerprint')
+    assert not os.path.exists(db.journal_path)
+    other_db = DatabaseManager.load(config['campaign_dir'])
+    assert list(other_db.get_results()) == [result]
+    assert other_db.get_build_fingerprint() == 'fingerprint'
+
+    # Results deleted by a host are not added back from the database file
+    db.wipe_results()
+    other_db = DatabaseManager.load(config['campaign_dir'])
+    assert list(other_db.get_results()) == []
+
+    # Simulations can only be claimed once, until claims become stale
+    params = dict(result['params'], RngRun=11)
+    assert db.claim_simulation(params, 60)
+    assert not other_db.claim_simulation(params, 60)
+    assert other_db.get_claimed_simulations(60) == [params]
+    assert other_db.get_claimed_simulations(-1) == []
+    assert other_db.claim_simulation(params, -1)
+    other_db.release_claims([params])
+    assert other_db.get_claimed_simulations(60) == []
+
+
 def test_results(db, result):
     # Test insertion of valid result
     db.insert_result(result)
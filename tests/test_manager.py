@@ -1,4 +1,5 @@
 import sem
+import json
 import os
 import pytest
 import numpy as np
@@ -78,6 +79,13 @@ def test_check_repo_ok(manager, config, ns_3_compiled):
     with pytest.raises(Exception):
         manager.check_repo_ok()
 
+    # Changes outside the checked paths are ignored
+    manager.repo_check_paths = ['src/wifi', 'scratch']
+    manager.check_repo_ok()
+    manager.repo_check_paths = ['src/core']
+    with pytest.raises(Exception):
+        manager.check_repo_ok()
+
 
 def test_non_existing_repo(manager, config, ns_3_compiled,
                            parameter_combination):
@@ -184,3 +192,175 @@ def test_only_load_some_files_decorator(tmpdir, manager, result, parameter_combi
         columns=['Label'],
         params=parameter_combination_no_rngrun,
         runs=1)  # Get one run per combination
+
+
+def test_run_missing_simulations_with_budget(manager,
+                                             parameter_combination_range):
+    def metric(result):
+        return len(result['output']['stdout'])
+
+    manager.run_missing_simulations(parameter_combination_range, runs=2,
+                                    budget=12, metric_function=metric)
+
+    # The whole budget is spent, and every combination gets the initial runs
+    results = manager.db.get_results()
+    assert len(results) == 12
+    for param_comb in sem.list_param_combinations(parameter_combination_range):
+        assert len(manager.db.get_results(param_comb)) >= 2
+
+
+def test_build_fingerprint(manager, parameter_combination):
+    # The fingerprint of the ns-3 build is saved in the campaign
+    fingerprint = manager.db.get_build_fingerprint()
+    assert fingerprint is not None
+    assert fingerprint == manager.runner.get_build_fingerprint()
+    assert manager.runner.is_build_up_to_date(fingerprint)
+
+    # Running simulations on an unchanged tree doesn't alter it
+    manager.run_simulations([parameter_combination])
+    assert manager.db.get_build_fingerprint() == fingerprint
+
+    # Touching the executable invalidates the fingerprint, even if the
+    # status of the sources was computed before
+    source_status = manager.runner.get_source_status()
+    os.utime(manager.runner.script_executable)
+    assert not manager.runner.is_build_up_to_date(fingerprint)
+    assert manager.runner.get_build_fingerprint(source_status) != fingerprint
+
+
+def test_retention_policy(ns_3_compiled, config, parameter_combination):
+    policy = {'exclude': ['*.pcap'], 'stdout_tail': 10}
+    manager = sem.CampaignManager.new(ns_3_compiled, config['script'],
+                                      config['campaign_dir'],
+                                      retention_policy=policy)
+    manager.run_simulations([parameter_combination])
+    result = manager.db.get_results()[0]
+    assert os.path.getsize(manager.db.get_result_files(result)['stdout']) <= 10
+
+    # The policy is recorded in the campaign, and used by default when the
+    # campaign is loaded again
+    assert manager.db.get_retention_policy() == policy
+    manager = sem.CampaignManager.load(config['campaign_dir'], ns_3_compiled)
+    assert manager.runner.retention_policy == policy
+
+    with pytest.raises(ValueError):
+        manager.set_runner_type('ParallelRunner',
+                                retention_policy={'keep': ['*']})
+
+
+def test_set_runner_type(manager, parameter_combination, monkeypatch):
+    # Switching runner must not configure or build ns-3 again
+    def fail(*args, **kwargs):
+        raise AssertionError("ns-3 was built again")
+    monkeypatch.setattr(sem.SimulationRunner, 'configure_and_build', fail)
+
+    script_executable = manager.runner.script_executable
+    for runner_type in ['SimulationRunner', 'LptRunner', 'ParallelRunner']:
+        manager.set_runner_type(runner_type)
+        assert type(manager.runner).__name__ == runner_type
+        assert manager.runner.script_executable == script_executable
+
+    # Only runner classes are accepted
+    for runner_type in ['NonExistingRunner', 'pd']:
+        with pytest.raises(ValueError):
+            manager.set_runner_type(runner_type)
+
+    manager.run_simulations([parameter_combination])
+    assert len(manager.db.get_complete_results()) == 1
+
+
+@sem.utils.output_labels(['Length'])
+def get_stdout_length(result):
+    return [len(result['output']['stdout'])]
+
+
+def test_parse_on_completion(manager, parameter_combination_range):
+    manager.run_missing_simulations(parameter_combination_range, runs=1,
+                                    result_parsing_functions=[get_stdout_length])
+    expected = manager.get_results_as_dataframe(get_stdout_length)
+
+    # Outputs are stored with each result
+    for result in manager.db.get_results():
+        assert list(result['meta']['parsed'].values()) == [
+            get_stdout_length(manager.db.get_complete_results(
+                result_id=result['meta']['id'])[0])]
+
+    # Stored outputs are used instead of parsing the output files again
+    for result in manager.db.get_results():
+        os.remove(manager.db.get_result_files(result)['stdout'])
+    assert manager.get_results_as_dataframe(get_stdout_length).equals(expected)
+
+
+@sem.utils.output_labels(['Files'])
+@sem.utils.only_load_some_files(['stdout'])
+def count_output_files(result):
+    return [len(result['output'])]
+
+
+def test_parse_on_completion_files_to_load(manager,
+                                           parameter_combination_range):
+    results = []
+
+    def generator():
+        for result in manager.runner.run_simulations(
+                manager.get_missing_simulations(
+                    sem.utils.list_param_combinations(
+                        parameter_combination_range), runs=1),
+                manager.db.get_data_dir()):
+            yield result
+            # Results are saved before their parsing is over
+            assert manager.db.get_results(result_id=result['meta']['id'])
+            results.append(result)
+
+    manager.run_and_save_results(generator(), batch_results=False,
+                                 result_parsing_functions=[count_output_files])
+    assert all(manager.db.get_results(result_id=r['meta']['id'])[0]['meta']
+               ['parsed'] for r in results)
+
+    # Stored outputs are only used if the function receives the same files
+    array = manager.get_results_as_numpy_array(parameter_combination_range,
+                                               count_output_files, runs=1)
+    assert all(files > 1 for files in array.flatten())
+    assert all(manager.get_results_as_dataframe(count_output_files)['Files'] ==
+               1)
+
+
+def test_parse_cache(manager, parameter_combination_range):
+    manager.run_missing_simulations(parameter_combination_range, runs=1)
+    expected = manager.get_results_as_dataframe(get_stdout_length)
+
+    # Parsed outputs are reused instead of parsing output files again
+    for result in manager.db.get_results():
+        os.remove(manager.db.get_result_files(result)['stdout'])
+    assert manager.get_results_as_dataframe(get_stdout_length).equals(expected)
+    array = manager.get_results_as_numpy_array(parameter_combination_range,
+                                               get_stdout_length, runs=1)
+    assert sorted(array.flatten()) == sorted(expected['Length'])
+
+
+def test_run_shared_simulations(manager, ns_3_compiled, config,
+                                parameter_combination_range):
+    # Simulations claimed by another host are not run again
+    other_manager = sem.CampaignManager.load(config['campaign_dir'],
+                                             ns_3_compiled)
+    claimed = dict(sem.list_param_combinations(parameter_combination_range)[0],
+                   RngRun=0)
+    assert other_manager.db.claim_simulation(claimed, 600)
+    missing = manager.get_missing_simulations(
+        sem.list_param_combinations(parameter_combination_range), runs=1,
+        in_progress=manager.db.get_claimed_simulations(600))
+    assert claimed not in missing
+    other_manager.db.release_claims([claimed])
+
+    # Hosts complete each other's sweeps without duplicating simulations
+    manager.run_missing_simulations(parameter_combination_range, runs=1,
+                                    shared=True)
+    other_manager.run_missing_simulations(parameter_combination_range,
+                                          runs=2, shared=True)
+    manager.db.merge_journals()
+    results = manager.db.get_results()
+    n_combinations = len(sem.list_param_combinations(
+        parameter_combination_range))
+    assert len(results) == 2 * n_combinations
+    assert len(set(json.dumps(r['params'], sort_keys=True)
+                   for r in results)) == len(results)
@@ -1,5 +1,14 @@
-from sem import SimulationRunner, ParallelRunner
+from sem import SimulationRunner, ParallelRunner, DistributedRunner
+from sem.distributedrunner import run_worker
+from sem.gridrunner import GridRunner
+from sem.hybridrunner import HybridRunner
+from multiprocessing.connection import Client
+import sem.utils
+import sem.parallelrunner
+import threading
+import resource
 import os
+import shutil
 import pytest
 
 ###################
@@ -19,10 +28,16 @@ def runner(ns_3_compiled, ns_3_compiled_debug, config, request):
                               optimized=request.param[1])
 
 
-def test_get_available_parameters(runner, config):
+def test_get_available_parameters(runner, config, monkeypatch):
     # Try getting the available parameters of the script
     assert runner.get_available_parameters() == config['params']
 
+    # Once cached, parameters are retrieved without running the script
+    def fail():
+        raise AssertionError("Script was run to get its parameters")
+    monkeypatch.setattr(runner, 'discover_available_parameters', fail)
+    assert runner.get_available_parameters() == config['params']
+
 
 @pytest.mark.parametrize('runner',
                          [
@@ -34,7 +49,12 @@ def test_run_simulations(runner, config,
                          parameter_combination):
     # Make sure that simulations run without any issue
     data_dir = os.path.join(config['campaign_dir'], 'data')
-    list(runner.run_simulations([parameter_combination], data_dir))
+    results = list(runner.run_simulations([parameter_combination], data_dir))
+
+    # Resource usage is recorded for each simulation
+    for key in ['user_time', 'system_time', 'max_rss', 'block_input',
+                'block_output']:
+        assert key in results[0]['meta']
 
 
 def test_scratch_script(ns_3_compiled, config):
@@ -56,3 +76,490 @@ def test_non_existent_script(ns_3_compiled):
 
 def test_script_without_args(ns_3_compiled):
     ParallelRunner(ns_3_compiled, 'sample-random-variable')
+
+
+def test_from_runner(ns_3_compiled, config):
+    runner = ParallelRunner(ns_3_compiled, config['script'], pin_cpus=True,
+                            memory_aware=True, speculative_factor=2)
+
+    # Settings of subclasses are copied between runners of the subclass
+    parallel_runner = ParallelRunner.from_runner(runner,
+                                                 adaptive_parallelism=True)
+    assert parallel_runner.memory_aware
+    assert parallel_runner.adaptive_parallelism
+    assert parallel_runner.speculative_factor == 2
+
+    # Runners share the CPUs simulations are pinned to
+    simulation_runner = SimulationRunner.from_runner(parallel_runner)
+    assert simulation_runner.pin_cpus
+    assert simulation_runner.cpu_slots is runner.cpu_slots
+
+
+def test_timeout(ns_3_compiled, config, parameter_combination):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = SimulationRunner(ns_3_compiled, config['script'], timeout=0.001)
+    # Simulations that time out are killed and flagged, but do not raise
+    result = next(runner.run_simulations([parameter_combination], data_dir,
+                                         stop_on_errors=True))
+    assert result['meta']['timed_out']
+    assert not result['meta']['killed_by_limit']
+    assert result['meta']['exitcode'] != 0
+
+
+def test_cancelled_simulation(ns_3_compiled, config, parameter_combination):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = SimulationRunner(ns_3_compiled, config['script'],
+                              cpu_time_limit=100)
+
+    # Simulations are cancelled as soon as they start
+    wait_for_process = runner.wait_for_process
+
+    def cancel_and_wait(process):
+        for sim_uuid in list(runner.running):
+            runner.cancel_simulation(sim_uuid)
+        return wait_for_process(process)
+    runner.wait_for_process = cancel_and_wait
+
+    # Cancelled simulations are killed, but not because of their limits
+    result = next(runner.run_simulations([parameter_combination], data_dir,
+                                         stop_on_errors=True))
+    assert result['meta']['cancelled']
+    assert not result['meta']['killed_by_limit']
+
+
+def test_launcher(ns_3_compiled, config, parameter_combination):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            use_launcher=True)
+    results = list(runner.run_simulations([parameter_combination] * 2,
+                                          data_dir))
+    assert all(r['meta']['exitcode'] == 0 for r in results)
+
+    # The memory of this process is not accounted in the simulations' one
+    assert all(r['meta']['max_rss'] < resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss for r in results)
+
+    # Timeouts are enforced on simulations started by the launcher
+    runner = SimulationRunner.from_runner(runner, timeout=0.001)
+    result = next(runner.run_simulations([parameter_combination], data_dir))
+    assert result['meta']['timed_out']
+
+    # Simulations forked from this process only report a peak memory that
+    # is not inflated by the one of this process
+    runner = SimulationRunner.from_runner(runner, timeout=None,
+                                          use_launcher=False)
+    result = next(runner.run_simulations([parameter_combination], data_dir))
+    assert result['meta']['max_rss'] is None or result['meta']['max_rss'] > \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def test_launcher_relative_paths(ns_3_compiled, config, parameter_combination,
+                                 monkeypatch):
+    # Relative paths resolve from the folder of this process, regardless of
+    # the folder the launcher ran the previous simulations in
+    monkeypatch.chdir(config['campaign_dir'])
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            use_launcher=True)
+    results = list(runner.run_simulations([parameter_combination] * 4,
+                                          'data'))
+    for result in results:
+        assert result['meta']['exitcode'] == 0
+        assert os.path.exists(os.path.join(config['campaign_dir'], 'data',
+                                           result['meta']['id'], 'stdout'))
+
+
+def test_memory_aware_parallel_runner(ns_3_compiled, config,
+                                      parameter_combination):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            memory_aware=True)
+    results = list(runner.run_simulations([parameter_combination] * 4,
+                                          data_dir))
+    assert len(results) == 4
+    # Peak memory is learned from the completed runs
+    assert runner.predict(parameter_combination, 'max_rss') > 0
+    assert not runner.reservations
+
+
+def test_memory_aware_large_parent(ns_3_compiled, config,
+                                   parameter_combination):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            memory_aware=True)
+    # The memory used by this process is not part of the predictions, so
+    # that simulations are not serialized because of it
+    ballast = b'\x01' * (512 * 1024 * 1024)
+    results = list(runner.run_simulations([parameter_combination] * 2,
+                                          data_dir))
+    assert all(r['meta']['max_rss'] < len(ballast) // 1024 for r in results)
+    assert 0 < runner.predict_peak_memory(parameter_combination) < \
+        len(ballast) // 1024
+    del ballast
+
+
+def test_parallel_runner_batches(ns_3_compiled, config, parameter_combination):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            max_parallel_processes=2)
+
+    # Batches grow with short simulations, but leave work for all threads
+    pending = [dict(parameter_combination, RngRun=run) for run in range(100)]
+    assert runner.get_batch_size(pending, 2, {'completed': 0, 'time': 0}) == 1
+    assert runner.get_batch_size(pending, 2,
+                                 {'completed': 10, 'time': 0.1}) == 25
+    assert runner.get_batch_size(pending, 2,
+                                 {'completed': 1, 'time': 10}) == 1
+
+    # Running times of previous runs are used before any simulation
+    # completes, and long simulations are taken one at a time
+    runner.set_run_statistics([{'params': pending[0],
+                                'meta': {'elapsed_time': 0.2,
+                                         'max_rss': None}}])
+    assert runner.get_batch_size(pending, 2, {'completed': 0, 'time': 0}) == 2
+    runner.set_run_statistics([{'params': pending[0],
+                                'meta': {'elapsed_time': 10,
+                                         'max_rss': None}}])
+    assert runner.get_batch_size(pending, 2,
+                                 {'completed': 10, 'time': 0.1}) == 1
+    runner.set_run_statistics([])
+
+    batches = []
+    launch_batch = runner.launch_batch
+
+    def record_batch(batch, results, original=None):
+        batches.append(len(batch))
+        launch_batch(batch, results, original)
+    runner.launch_batch = record_batch
+
+    # Results are still yielded one at a time
+    parameter_list = [dict(parameter_combination, RngRun=run) for run in
+                      range(40)]
+    results = list(runner.run_simulations(parameter_list, data_dir))
+    assert sorted(r['params']['RngRun'] for r in results) == list(range(40))
+    assert sum(batches) == 40
+    assert max(batches) > 1
+
+    # Simulations are stopped when the caller stops early, and only the
+    # outputs of the yielded results are kept
+    for folder in os.listdir(data_dir):
+        shutil.rmtree(os.path.join(data_dir, folder))
+    generator = runner.run_simulations(parameter_list, data_dir)
+    first = next(generator)
+    generator.close()
+    assert not runner.running
+    assert os.listdir(data_dir) == [first['meta']['id']]
+
+
+def test_adaptive_parallelism(ns_3_compiled, config, parameter_combination,
+                              monkeypatch):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            max_parallel_processes=4,
+                            adaptive_parallelism=True)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    monkeypatch.setattr(os, 'getloadavg', lambda: (0, 0, 0))
+    monkeypatch.setattr(sem.parallelrunner, 'get_available_memory',
+                        lambda: 1000)
+    monkeypatch.setattr(sem.parallelrunner, 'get_total_memory', lambda: 1000)
+
+    # Parallelism keeps changing in the same direction while throughput
+    # grows, and reverts when it decreases
+    adaptation = {'parallelism': 2, 'direction': 1, 'throughput': None}
+    runner.adapt_parallelism(adaptation, 1, 4)
+    assert adaptation['parallelism'] == 3
+    runner.adapt_parallelism(adaptation, 0.5, 4)
+    assert adaptation['parallelism'] == 2
+
+    # Other processes loading the CPUs lower the cap
+    monkeypatch.setattr(os, 'getloadavg', lambda: (3, 3, 3))
+    adaptation = {'parallelism': 4, 'direction': 1, 'throughput': None}
+    runner.adapt_parallelism(adaptation, 1, 4)
+    assert adaptation['parallelism'] == 1
+
+    # Memory pressure always reduces parallelism
+    monkeypatch.setattr(os, 'getloadavg', lambda: (0, 0, 0))
+    monkeypatch.setattr(sem.parallelrunner, 'get_available_memory',
+                        lambda: 50)
+    adaptation = {'parallelism': 3, 'direction': 1, 'throughput': 0.1}
+    runner.adapt_parallelism(adaptation, 1, 4)
+    assert adaptation['parallelism'] == 2
+
+    # Simulations complete while parallelism is adjusted
+    monkeypatch.setattr(ParallelRunner, 'adaptation_interval', 0.01)
+    results = list(runner.run_simulations([parameter_combination] * 8,
+                                          data_dir))
+    assert len(results) == 8
+    assert runner.active == 0
+    assert 1 <= runner.parallelism <= 4
+
+
+def test_speculative_execution(ns_3_compiled, config, parameter_combination,
+                               monkeypatch):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            max_parallel_processes=2, speculative_factor=1)
+    monkeypatch.setattr(ParallelRunner, 'speculation_interval', 0.001)
+
+    # Previous runs were much faster, so the simulation is copied as soon as
+    # the idle thread checks for stragglers
+    runner.set_run_statistics([{'params': parameter_combination,
+                                'meta': {'elapsed_time': 1e-6,
+                                         'max_rss': None}}])
+    results = list(runner.run_simulations([parameter_combination], data_dir))
+    assert runner.speculations
+
+    # Only one copy of the simulation is kept
+    assert len(results) == 1
+    assert all(r['meta']['exitcode'] == 0 for r in results)
+    assert not any(r['meta'].get('cancelled') for r in results)
+    assert sorted(os.listdir(data_dir)) == sorted(r['meta']['id'] for r in
+                                                  results)
+
+
+def test_cpu_pinning(ns_3_compiled, config, parameter_combination):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'], pin_cpus=True,
+                            max_parallel_processes=2)
+    # CPU sets are disjoint
+    cpu_sets = runner.get_cpu_sets()
+    assert len(sum(cpu_sets, [])) == len(set(sum(cpu_sets, [])))
+
+    results = list(runner.run_simulations([parameter_combination] * 4,
+                                          data_dir))
+    for result in results:
+        assert result['meta']['cpus'] in cpu_sets
+
+
+def test_distributed_runner(ns_3_compiled, config, parameter_combination,
+                            monkeypatch):
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = DistributedRunner(ns_3_compiled, config['script'],
+                               address=('localhost', 0), authkey='secret',
+                               heartbeat_timeout=1)
+    runner.listen()
+
+    # A worker that disconnects as soon as it receives a simulation
+    def lost_worker():
+        connection = Client(runner.address, authkey=runner.authkey.encode())
+        connection.recv()  # Settings
+        connection.recv()  # Simulation
+        connection.close()
+    threading.Thread(target=lost_worker).start()
+
+    # Two workers running two simulations each on this machine
+    workers = [threading.Thread(target=run_worker,
+                                args=(runner.address, runner.authkey,
+                                      ns_3_compiled, 2))
+               for _ in range(2)]
+    for worker in workers:
+        worker.start()
+
+    parameters = [dict(parameter_combination, RngRun=run) for run in
+                  range(8)]
+    results = list(runner.run_simulations(parameters, data_dir))
+
+    # Every simulation is run exactly once, and its outputs are sent back
+    assert sorted(r['params']['RngRun'] for r in results) == list(range(8))
+    for result in results:
+        assert os.path.exists(os.path.join(data_dir, result['meta']['id'],
+                                           'stdout'))
+
+    # Exceptions raised while running simulations on workers are raised by
+    # the runner
+    def fail(*args, **kwargs):
+        raise RuntimeError("Simulation could not be started")
+    monkeypatch.setattr(SimulationRunner, 'run_simulation', fail)
+    with pytest.raises(Exception, match="could not be started"):
+        list(runner.run_simulations([parameter_combination], data_dir))
+    monkeypatch.undo()
+
+    # Workers exit when the runner is closed
+    runner.close()
+    for worker in workers:
+        worker.join()
+
+
+def test_grid_runner(ns_3_compiled, config, parameter_combination,
+                     mock_drmaa):
+    script_executable = SimulationRunner(ns_3_compiled,
+                                         config['script']).script_executable
+    runner = GridRunner(ns_3_compiled, config['script'],
+                        script_executable=script_executable)
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+
+    # Simulations are submitted as a single bulk job, and all complete
+    results = list(runner.run_simulations([parameter_combination] * 5,
+                                          data_dir))
+    assert len(mock_drmaa.Session.bulk_jobs[-1]) == 5
+    assert len(results) == 5
+    for result in results:
+        assert result['meta']['exitcode'] == 0
+        assert result['meta']['elapsed_time'] > 0
+        for key in ['queue_time', 'user_time', 'system_time', 'max_rss',
+                    'block_input', 'block_output']:
+            assert key in result['meta']
+        with open(os.path.join(data_dir, result['meta']['id'],
+                               'stdout')) as stdout:
+            assert stdout.read()
+
+    # Only result folders are left in the data folder
+    assert sorted(os.listdir(data_dir)) == sorted(r['meta']['id'] for r in
+                                                  results)
+
+
+def test_grid_runner_timeout(ns_3_compiled, config, parameter_combination,
+                             mock_drmaa):
+    script_executable = SimulationRunner(ns_3_compiled,
+                                         config['script']).script_executable
+    runner = GridRunner(ns_3_compiled, config['script'],
+                        script_executable=script_executable, timeout=0.001)
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    # Simulations that time out on the grid are flagged, but do not raise
+    result = next(runner.run_simulations([parameter_combination], data_dir,
+                                         stop_on_errors=True))
+    assert result['meta']['timed_out']
+    assert not result['meta']['killed_by_limit']
+    assert result['meta']['exitcode'] != 0
+
+
+def test_grid_runner_packing(ns_3_compiled, config, parameter_combination,
+                             mock_drmaa):
+    script_executable = SimulationRunner(ns_3_compiled,
+                                         config['script']).script_executable
+    runner = GridRunner(ns_3_compiled, config['script'],
+                        script_executable=script_executable,
+                        job_duration=3600)
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    parameter_list = [parameter_combination] * 4
+
+    # Simulations that never ran before get a job each
+    assert len(runner.pack_simulations(parameter_list)) == 4
+    list(runner.run_simulations(parameter_list, data_dir))
+
+    # Once their running time is known, short simulations share a job
+    assert len(runner.pack_simulations(parameter_list)) == 1
+    results = list(runner.run_simulations(parameter_list, data_dir))
+    assert len(mock_drmaa.Session.bulk_jobs[-1]) == 1
+    assert len(results) == 4
+    for result in results:
+        assert result['meta']['exitcode'] == 0
+        assert result['meta']['elapsed_time'] > 0
+
+
+def test_hybrid_runner(ns_3_compiled, config, parameter_combination,
+                       mock_drmaa, monkeypatch):
+    script_executable = SimulationRunner(ns_3_compiled,
+                                         config['script']).script_executable
+    runner = HybridRunner(ns_3_compiled, config['script'],
+                          script_executable=script_executable,
+                          max_parallel_processes=2)
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+
+    # The longest simulations are submitted to the grid, and those still
+    # waiting in its queue are taken back to be run locally
+    monkeypatch.setattr(mock_drmaa.Session, 'slots', 1)
+    submitted = mock_drmaa.Session.submitted
+    results = list(runner.run_simulations([parameter_combination] * 8,
+                                          data_dir))
+    assert len(results) == 8
+    assert len(set(r['meta']['id'] for r in results)) == 8
+    assert mock_drmaa.Session.submitted - submitted == 6
+    for result in results:
+        assert result['meta']['exitcode'] == 0
+        assert os.path.exists(os.path.join(data_dir, result['meta']['id'],
+                                           'stdout'))
+
+    # Simulations taken back from the grid leave no output behind
+    assert sorted(os.listdir(data_dir)) == sorted(r['meta']['id'] for r in
+                                                  results)
+
+    # Jobs that start while they are being terminated are left on the grid
+    class StartingSession(mock_drmaa.Session):
+        def __init__(self):
+            self.states = iter([mock_drmaa.JobState.QUEUED_ACTIVE,
+                                mock_drmaa.JobState.RUNNING])
+
+        def jobStatus(self, jobid):
+            return next(self.states)
+
+        def control(self, jobid, action):
+            pass
+
+    jobs = {'1': {'results': [{'params': parameter_combination,
+                               'meta': {'id': 'started'}}]}}
+    pending = []
+    runner.take_back_queued_jobs(StartingSession(), jobs, pending, 1,
+                                 data_dir)
+    assert list(jobs) == ['1']
+    assert not pending
+
+
+def test_grid_runner_session(ns_3_compiled, config, parameter_combination,
+                             mock_drmaa):
+    sessions = mock_drmaa.Session.sessions
+    submitted = mock_drmaa.Session.submitted
+
+    # Configuration and build are performed by a single grid job
+    runner = GridRunner(ns_3_compiled, config['script'])
+    assert mock_drmaa.Session.submitted - submitted == 1
+
+    # Parameters are discovered without going through the grid
+    assert runner.get_available_parameters() == config['params']
+    assert mock_drmaa.Session.submitted - submitted == 1
+
+    # All jobs are submitted through the same session
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    list(runner.run_simulations([parameter_combination], data_dir))
+    list(runner.run_simulations([parameter_combination], data_dir))
+    assert mock_drmaa.Session.sessions - sessions == 1
+
+
+def test_staging(ns_3_compiled, config, parameter_combination, tmpdir,
+                 mock_drmaa):
+    stage_dir = str(tmpdir.join('stage'))
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            stage_dir=stage_dir)
+
+    # Simulations run from a copy of the build in the staging folder
+    executable, environment = runner.get_executable_and_environment()
+    assert executable.startswith(stage_dir)
+    assert environment['LD_LIBRARY_PATH'].startswith(stage_dir)
+    results = list(runner.run_simulations([parameter_combination], data_dir))
+    assert results[0]['meta']['exitcode'] == 0
+
+    # Grid jobs stage the build on their node, reusing existing copies
+    grid_runner = GridRunner.from_runner(runner)
+    results = list(grid_runner.run_simulations([parameter_combination],
+                                               data_dir))
+    assert results[0]['meta']['exitcode'] == 0
+    assert len(os.listdir(stage_dir)) == 1
+
+
+def test_scratch_dir(ns_3_compiled, config, parameter_combination, tmpdir,
+                     mock_drmaa):
+    scratch_dir = str(tmpdir.join('scratch'))
+    data_dir = os.path.join(config['campaign_dir'], 'data')
+    runner = ParallelRunner(ns_3_compiled, config['script'],
+                            scratch_dir=scratch_dir)
+
+    # Outputs are moved to the campaign directory, and scratch folders are
+    # removed
+    for current_runner in [runner, SimulationRunner.from_runner(runner),
+                           GridRunner.from_runner(runner)]:
+        results = list(current_runner.run_simulations(
+            [parameter_combination] * 2, data_dir))
+        for result in results:
+            assert result['meta']['exitcode'] == 0
+            assert {'stdout', 'stderr'} <= set(os.listdir(os.path.join(
+                data_dir, result['meta']['id'])))
+        assert os.listdir(scratch_dir) == []
+
+    # Outputs of failing simulations are moved before the error is raised
+    with pytest.raises(Exception, match="exited with an error"):
+        list(runner.run_simulations([dict(parameter_combination, fail=1)],
+                                    data_dir, stop_on_errors=True))
+    assert os.listdir(scratch_dir) == []
+    for output_dir in os.listdir(data_dir):
+        assert {'stdout', 'stderr'} <= set(os.listdir(os.path.join(
+            data_dir, output_dir)))
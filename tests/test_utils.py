@@ -1,5 +1,7 @@
 from sem import list_param_combinations, automatic_parser, stdout_automatic_parser, CallbackBase, CampaignManager
+from sem.utils import compute_ocba_allocation, apply_retention_policy
 import json
+import os
 import numpy as np
 from operator import getitem
 
@@ -102,6 +104,50 @@ def test_automatic_parser(result):
     assert parsed['stderr'] == []
 
 
+def test_compute_ocba_allocation():
+    # Allocation always sums to the total number of runs
+    allocation = compute_ocba_allocation([1, 2, 10], [1, 1, 1], 100)
+    assert np.isclose(sum(allocation), 100)
+
+    # Combinations that are clearly worse than the best receive fewer runs
+    assert allocation[0] < allocation[1] < allocation[2]
+    allocation = compute_ocba_allocation([1, 2, 10], [1, 1, 1], 100,
+                                         maximize=False)
+    assert allocation[2] < allocation[0]
+
+    # Without variance or with all ties we fall back to a uniform allocation
+    assert compute_ocba_allocation([1, 2, 3], [0, 0, 0], 9) == [3, 3, 3]
+    assert compute_ocba_allocation([1, 1], [1, 1], 10) == [5, 5]
+
+    # Combinations whose samples are all equal still receive runs
+    allocation = compute_ocba_allocation([1, 2, 10], [1, 1, 0], 100)
+    assert allocation[2] > 0
+
+
+def test_apply_retention_policy(tmpdir):
+    def create_outputs():
+        for filename, size in [('stdout', 100), ('stderr', 10),
+                               ('trace-0-1.pcap', 50), ('trace.tr', 10),
+                               ('results.txt', 10), ('big.txt', 1000)]:
+            tmpdir.join(filename).write('x' * (size - 1) + '\n')
+
+    # Excluded and oversized files are removed
+    create_outputs()
+    apply_retention_policy(str(tmpdir), {'exclude': ['*.pcap', r're:.*\.tr'],
+                                         'max_file_size': 100})
+    assert sorted(os.listdir(str(tmpdir))) == ['results.txt', 'stderr',
+                                                'stdout']
+
+    # Only included files are kept, besides stdout and stderr, and only the
+    # end of stdout is kept
+    create_outputs()
+    apply_retention_policy(str(tmpdir), {'include': ['results.*'],
+                                         'stdout_tail': 10})
+    assert sorted(os.listdir(str(tmpdir))) == ['results.txt', 'stderr',
+                                                'stdout']
+    assert tmpdir.join('stdout').read() == 'x' * 9 + '\n'
+
+
 class TestCallback(CallbackBase):
 
     # Prevent pytest from trying to collect this function as a test